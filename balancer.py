@@ -0,0 +1,175 @@
+"""
+Load-balancing broker
+
+Clients talk to the frontend ROUTER with REQ (or REQ-style DEALER) sockets and
+workers talk to the backend ROUTER with DEALER sockets. A worker announces
+itself with READY and is handed requests least recently used first. Workers and
+broker exchange HEARTBEAT while nothing else is going on; a worker that stays
+silent for HEARTBEAT_LIVENESS intervals is expired and the request it was
+working on is put back at the head of the queue for the next worker.
+
+Backend messages, as seen by the broker:
+    [worker, b'', READY]
+    [worker, b'', HEARTBEAT]
+    [worker, b'', client, b'', reply...]
+"""
+
+import time
+from collections import deque
+
+import zmq
+
+HEARTBEAT_INTERVAL = 1.0  # seconds between heartbeats
+HEARTBEAT_LIVENESS = 3  # heartbeats a worker may miss before it is expired
+
+BATCH = 64  # messages drained from a socket per poll, amortizes the poll call
+
+READY = b"READY"
+HEARTBEAT = b"HEARTBEAT"
+
+
+class LoadBalancer(object):
+    """Least recently used routing of client requests to workers, with worker expiry"""
+    def __init__(self, frontend, backend, interval=HEARTBEAT_INTERVAL, liveness=HEARTBEAT_LIVENESS):
+        self.frontend = frontend
+        self.backend = backend
+        self.interval = interval
+        self.liveness = liveness
+        self.ready = deque()  # idle workers, least recently used first; may hold expired ones
+        self.idle = set()  # workers that are really idle, used to skip stale entries in ready
+        self.expiry = {}  # worker -> POSIX time after which it is considered dead
+        self.busy = {}  # worker -> (client, request) it is working on
+        self.pending = deque()  # (client, request) waiting for a worker
+        self.heartbeat_at = time.time() + interval
+        self.replies = 0
+        self.requeued = 0
+        self.expired = 0
+        # Only poll clients while a worker is free, without re-registering sockets
+        self.poll_workers = zmq.Poller()
+        self.poll_workers.register(backend, zmq.POLLIN)
+        self.poll_both = zmq.Poller()
+        self.poll_both.register(backend, zmq.POLLIN)
+        self.poll_both.register(frontend, zmq.POLLIN)
+
+    def __repr__(self):
+        return "LoadBalancer(workers={},idle={},busy={},pending={})".format(len(self.expiry), len(self.idle), len(self.busy), len(self.pending))
+
+    def worker_ready(self, worker):
+        if worker not in self.idle:
+            self.idle.add(worker)
+            self.ready.append(worker)
+
+    def next_worker(self):
+        """Pop the least recently used idle worker, or None"""
+        while self.ready:
+            worker = self.ready.popleft()
+            if worker in self.idle:
+                self.idle.remove(worker)
+                return worker
+        return None
+
+    def dispatch(self):
+        """Hand pending requests to idle workers"""
+        while self.pending and self.idle:
+            worker = self.next_worker()
+            client, request = self.pending.popleft()
+            self.busy[worker] = (client, request)
+            self.backend.send_multipart([worker, b"", client, b""] + request)
+
+    def expire(self, now):
+        """Forget workers that missed their heartbeats and requeue their requests"""
+        for worker, expiry in list(self.expiry.items()):
+            if expiry < now:
+                del self.expiry[worker]
+                self.idle.discard(worker)
+                self.expired += 1
+                if worker in self.busy:
+                    self.pending.appendleft(self.busy.pop(worker))
+                    self.requeued += 1
+
+    def drain(self, socket, handler):
+        for i in range(BATCH):
+            try:
+                msg = socket.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            handler(msg)
+
+    def handle_backend(self, msg):
+        worker = msg[0]
+        self.expiry[worker] = time.time() + self.interval * self.liveness
+        if msg[2] == READY:
+            if worker in self.busy:  # worker restarted while working
+                self.pending.appendleft(self.busy.pop(worker))
+                self.requeued += 1
+            self.worker_ready(worker)
+        elif msg[2] == HEARTBEAT:
+            if worker not in self.busy:
+                self.worker_ready(worker)
+        else:
+            client = msg[2]
+            job = self.busy.get(worker)
+            if job is not None and job[0] == client:
+                del self.busy[worker]
+                self.frontend.send_multipart([client, b""] + msg[4:])
+                self.replies += 1
+                self.worker_ready(worker)
+            elif job is None:
+                # the worker was expired and its request already went elsewhere
+                self.worker_ready(worker)
+
+    def handle_frontend(self, msg):
+        self.pending.append((msg[0], msg[2:]))
+
+    def poll(self, timeout=None):
+        """Run one iteration of the broker loop, timeout in milliseconds"""
+        now = time.time()
+        wait = max(0, self.heartbeat_at - now) * 1000
+        if timeout is not None:
+            wait = min(wait, timeout)
+        poller = self.poll_both if self.idle else self.poll_workers
+        sockets = dict(poller.poll(wait))
+        if self.backend in sockets:
+            self.drain(self.backend, self.handle_backend)
+        if self.frontend in sockets:
+            self.drain(self.frontend, self.handle_frontend)
+        self.dispatch()
+        now = time.time()
+        if now >= self.heartbeat_at:
+            for worker in self.expiry:
+                self.backend.send_multipart([worker, b"", HEARTBEAT])
+            self.heartbeat_at = now + self.interval
+            self.expire(now)
+            self.dispatch()
+
+
+class Worker(object):
+    """Worker side of the protocol, wraps a DEALER socket connected to the backend"""
+    def __init__(self, socket, interval=HEARTBEAT_INTERVAL):
+        self.socket = socket
+        self.interval = interval
+        self.heartbeat_at = 0
+        self.poller = zmq.Poller()
+        self.poller.register(socket, zmq.POLLIN)
+
+    def ready(self):
+        self.socket.send_multipart([b"", READY])
+        self.heartbeat_at = time.time() + self.interval
+
+    def recv(self, timeout=None):
+        """Return (client, request) or None if nothing arrived, answering heartbeats on the way"""
+        if timeout is None:
+            timeout = self.interval * 1000
+        sockets = dict(self.poller.poll(timeout))
+        if self.socket in sockets:
+            msg = self.socket.recv_multipart()
+            if msg[1] != HEARTBEAT:
+                return msg[1], msg[3:]
+        if time.time() >= self.heartbeat_at:
+            self.socket.send_multipart([b"", HEARTBEAT])
+            self.heartbeat_at = time.time() + self.interval
+        return None
+
+    def reply(self, client, reply):
+        self.socket.send_multipart([b"", client, b""] + reply)
+        self.heartbeat_at = time.time() + self.interval
@@ -0,0 +1,129 @@
+"""
+Benchmark for balancer.LoadBalancer
+
+Runs thousands of clients and hundreds of workers in-process over inproc
+sockets. Each client keeps one request outstanding; workers answer at once.
+Part way through, --kill workers stop answering and heartbeating, so their
+requests have to be requeued once they expire.
+
+Also compares the old list.pop(0) ready queue against collections.deque.
+"""
+
+import argparse
+import threading
+import time
+import timeit
+
+import zmq
+
+from balancer import LoadBalancer, HEARTBEAT, READY
+
+
+def queue_bench(nbr_workers, rounds=20000):
+    """Time one pop/append of the ready queue, the way the examples rotate workers"""
+    setup = "from collections import deque; q = {}(range({}))"
+    lst = timeit.timeit("q.append(q.pop(0))", setup.format("list", nbr_workers), number=rounds)
+    deq = timeit.timeit("q.append(q.popleft())", setup.format("deque", nbr_workers), number=rounds)
+    print("ready queue with {} workers: list.pop(0) {:.3f} us, deque.popleft() {:.3f} us".format(
+        nbr_workers, lst / rounds * 1e6, deq / rounds * 1e6))
+
+
+def client_task(context, nbr_clients, stop, counts):
+    sockets = []
+    poller = zmq.Poller()
+    for i in range(nbr_clients):
+        sock = context.socket(zmq.DEALER)
+        sock.setsockopt(zmq.LINGER, 0)
+        sock.identity = u"Client-{}".format(i).encode("ascii")
+        sock.connect("inproc://frontend")
+        poller.register(sock, zmq.POLLIN)
+        sockets.append(sock)
+    for sock in sockets:
+        sock.send_multipart([b"", b"HELLO"])
+    while not stop.is_set():
+        for sock, event in poller.poll(100):
+            sock.recv_multipart()
+            counts[0] += 1
+            sock.send_multipart([b"", b"HELLO"])
+    for sock in sockets:
+        sock.close()
+
+
+def worker_task(context, nbr_workers, interval, stop, kill, kill_now):
+    dead = set()
+    sockets = []
+    poller = zmq.Poller()
+    for i in range(nbr_workers):
+        sock = context.socket(zmq.DEALER)
+        sock.setsockopt(zmq.LINGER, 0)
+        sock.identity = u"Worker-{}".format(i).encode("ascii")
+        sock.connect("inproc://backend")
+        poller.register(sock, zmq.POLLIN)
+        sockets.append(sock)
+        sock.send_multipart([b"", READY])
+    heartbeat_at = time.time() + interval
+    while not stop.is_set():
+        for sock, event in poller.poll(interval * 1000):
+            msg = sock.recv_multipart()
+            if msg[1] != HEARTBEAT and sock not in dead:
+                sock.send_multipart([b"", msg[1], b"", b"OK"])
+        if time.time() >= heartbeat_at:
+            for sock in sockets:
+                if sock not in dead:
+                    sock.send_multipart([b"", HEARTBEAT])
+            heartbeat_at = time.time() + interval
+        if kill_now.is_set() and not dead:
+            dead.update(sockets[:kill])
+    for sock in sockets:
+        sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=2000)
+    parser.add_argument("--workers", type=int, default=200)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--kill", type=int, default=20, help="workers that die half way through")
+    parser.add_argument("--interval", type=float, default=0.25, help="heartbeat interval in seconds")
+    args = parser.parse_args()
+
+    queue_bench(args.workers)
+
+    context = zmq.Context.instance()
+    context.max_sockets = args.clients + args.workers + 16
+    frontend = context.socket(zmq.ROUTER)
+    frontend.bind("inproc://frontend")
+    backend = context.socket(zmq.ROUTER)
+    backend.bind("inproc://backend")
+    balancer = LoadBalancer(frontend, backend, interval=args.interval)
+
+    stop = threading.Event()
+    kill_now = threading.Event()
+    counts = [0]
+    threads = [threading.Thread(target=client_task, args=(context, args.clients, stop, counts)),
+               threading.Thread(target=worker_task, args=(context, args.workers, args.interval, stop, args.kill, kill_now))]
+    for thread in threads:
+        thread.start()
+
+    start = time.time()
+    while time.time() - start < args.seconds:
+        balancer.poll(100)
+        if time.time() - start > args.seconds / 2:
+            kill_now.set()
+    elapsed = time.time() - start
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    print("{} clients, {} workers, {:.1f} s".format(args.clients, args.workers, elapsed))
+    print("replies: {} ({:.0f}/s)".format(balancer.replies, balancer.replies / elapsed))
+    print("expired workers: {}, requeued requests: {}".format(balancer.expired, balancer.requeued))
+    print(balancer)
+
+    frontend.close()
+    backend.close()
+    context.term()
+
+
+if __name__ == "__main__":
+    main()
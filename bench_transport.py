@@ -0,0 +1,83 @@
+"""
+Latency of the tcp, ipc and inproc transports
+
+A DEALER sends a message to an echoing ROUTER thread and waits for it to come
+back, one round trip at a time, for each transport and payload size. This is
+the hop a device saves by picking ipc or inproc, see endpoints.py.
+"""
+
+import argparse
+import threading
+import time
+
+import zmq
+
+import endpoints
+
+ENDPOINTS = ['tcp://127.0.0.1:5599', 'ipc:///tmp/labzmq-bench.ipc', 'inproc://labzmq-bench']
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+def echo_task(sock, stop):
+    poller = zmq.Poller()
+    poller.register(sock, zmq.POLLIN)
+    while not stop.is_set():
+        if poller.poll(100):
+            sock.send_multipart(sock.recv_multipart())
+    sock.close()
+
+
+def round_trips(context, endpoint, size, count):
+    """Round trip times in microseconds"""
+    server = context.socket(zmq.ROUTER)
+    server.setsockopt(zmq.LINGER, 0)
+    server.bind(endpoint)
+    stop = threading.Event()
+    thread = threading.Thread(target=echo_task, args=(server, stop))
+    thread.start()
+    client = context.socket(zmq.DEALER)
+    client.setsockopt(zmq.LINGER, 0)
+    client.connect(endpoint)
+    msg = [b'', b'x' * size]
+    for i in range(min(100, count)):  # warm up, e.g. the tcp handshake
+        client.send_multipart(msg)
+        client.recv_multipart()
+    times = []
+    for i in range(count):
+        start = time.perf_counter()
+        client.send_multipart(msg)
+        client.recv_multipart()
+        times.append((time.perf_counter() - start) * 1e6)
+    client.close()
+    stop.set()
+    thread.join()
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--count', type=int, default=5000, help='round trips per transport and size')
+    parser.add_argument('--sizes', default='64,4096,65536,1048576', help='comma separated payload sizes in bytes')
+    args = parser.parse_args()
+
+    context = zmq.Context.instance()
+    row_fmt = '{:>8} {:>10} {:>10} {:>10} {:>10}'
+    print(row_fmt.format('', 'bytes', 'mean us', 'p50 us', 'p99 us'))
+    for endpoint in ENDPOINTS:
+        if not endpoints.supported(endpoint):
+            print('{:>8} not supported on this platform'.format(endpoints.transport(endpoint)))
+            continue
+        for size in [int(x) for x in args.sizes.split(',')]:
+            count = args.count if size < 65536 else max(1, args.count // 10)
+            times = round_trips(context, endpoint, size, count)
+            print(row_fmt.format(endpoints.transport(endpoint), size, '{:.1f}'.format(sum(times) / len(times)),
+                                 '{:.1f}'.format(percentile(times, 50)), '{:.1f}'.format(percentile(times, 99))))
+    context.term()
+
+
+if __name__ == '__main__':
+    main()
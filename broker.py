@@ -6,11 +6,37 @@ import names
 import time
 import random
 import logger
+import journal
+import capture
+import shm
+import stream
+import endpoints
+import codec
+import values
+import telemetry
+import metrics
+import profiler
+import schema
 import errno
+import zlib
+import lzma
+import argparse
+import signal
+import threading
 import tkinter as tk
 
 NBR_DEVS = names.NBR_DEVS
 
+RECOVER_WAIT = 5  # seconds after a restart to wait for devices before failing journaled requests
+STATS_PERIOD = 10  # seconds between logs of the time spent per stage and command
+URGENT_BATCH = 100  # most urgent messages handled before the next normal one
+GET_COALESCE_AGE = 1  # seconds a GET in flight takes identical GETs, an older one may be lost and the next is forwarded
+URGENT_HOLD = 1  # seconds an urgent message waits for room on a full urgent lane before it is dropped
+
+OTHER = b'other'  # command_stats key of commands the broker does not know
+
+MIN_FRAMES = {b'WHERE': 4, b'SCHEMA': 4, b'CHK': 6, b'CRD': 5}  # frames a broker command needs, identity included
+
 app_log = logger.make_logger('broker.log')
 
 """
@@ -19,78 +45,828 @@ the key is a uuid generated by uuid.uuid4(), used to uniquely identify messages
 the value for each key is a tuple (from_addr, to_addr, msg)
 
 devs is a python set which contain bytes representation of names
+
+services maps a service name to the identities of the devices that joined as its
+replicas; a request addressed to a service goes to its least-loaded replica
+
+schemas holds the parameter schema each device published at HI, so clients can
+send parameter IDs instead of names (SCHEMA lookup)
+
+directory maps devices to the endpoints where they take requests directly; a
+device looks a peer up with WHERE and then talks to it without the broker
+
+streams maps the id of a chunked stream to the two devices it connects, so CHK
+and CRD messages are passed between them without a mail_table entry
+
+gets maps a GET in flight, by its destination and frames, to its msg_id; an
+identical GET that arrives meanwhile is not forwarded but waits in waiters for
+the same reply, which is copied to it under its own msg_id
 """
 
-class Broker():
-    def __init__(self):
-        self.logger = logger.make_logger('broker.log')
+class Job(object):
+    """One received message on its way through the broker's stages"""
+    def __init__(self, msg, urgent=False):
+        self.msg = msg
+        self.urgent = urgent  # came in on the urgent lane
+        self.from_addr = None
+        self.cmd = None  # HI, BYE... or the msg_id of mail
+        self.to_addr = None
+        self.mail = []  # (msg_id, from_addr, to_addr, msg) to track, (None, msg_id) to untrack
+        self.done = False  # set by a stage to skip the rest
+        self.acked = False  # the requester already got its ACK, e.g. a coalesced GET routed again
+
+
+class Broker(object):
+    """
+    Routes messages between devices
+
+    run() serves in the calling thread until stop() is called. start() runs the
+    same loop on a background thread, so a host application can embed the
+    broker and reach it from its own Device objects over inproc, as they share
+    zmq.Context.instance(). Remote peers still connect over tcp.
+    With journal_path, mail_table is journaled there and recovered on restart.
+    With capture_path, every message received and sent is recorded there for replay.py.
+    With telemetry, samples that devices publish are forwarded to subscribers, see telemetry.py.
+    With metrics_port, metrics.REGISTRY is served at http://127.0.0.1:metrics_port/metrics.
+    PROF, or profile(), profiles the broker's loop for a while, see profiler.py.
+    Requests that come in on the urgent lane (a second ROUTER) are served before
+    the others, and they and their replies travel on the urgent lane of the peers
+    that have one.
+    """
+    def __init__(self, endpoints=None, journal_path=None, capture_path=None, telemetry=True, urgent_endpoints=None,
+                 metrics_port=None):
         self.ctx = zmq.Context.instance()
-        self.mailbox = make_socket(self.ctx)
-        self.devs = set()
+        self.endpoints = names.BROKER_ENDPOINTS if endpoints is None else endpoints
+        self.urgent_endpoints = names.BROKER_URGENT_ENDPOINTS if urgent_endpoints is None else urgent_endpoints
+        self.urgent = None  # ROUTER of the urgent lane
+        self.urgent_bound = []
+        self.urgent_ids = set()  # msg_ids of the mail_table entries that came in on the urgent lane
+        self.gets = {}  # (urgent, destination, GET frames) -> msg_id of the GET in flight for them
+        self.waiters = {}  # msg_id of a GET in flight -> (its gets key, [(requester, msg_id, urgent, msg)] coalesced with it)
+        self.forwarded_gets = 0
+        self.coalesced_gets = 0
+        self.journal_path = journal_path
+        self.capture_path = capture_path
+        self.telemetry = telemetry
+        self.proxy = None  # telemetry.Proxy while open
+        self.metrics_port = metrics_port
+        self.metrics_server = None  # metrics HTTP server while open
+        self.profile_dir = profiler.DIRECTORY
+        self.profiling = None  # profiler.Profile of the window in progress
+        self.profile_requester = None  # identity the PROF reply goes to, None if started by a signal
+        self.profile_task = None
+        self.frontend = None
         self.poller = zmq.Poller()
-        self.top = tk.Tk()
-        self.setup_ui()
+        self.bound = []
+        self.devs = set()
         self.mail_table = {}
-        self.ui_running = True
-    
-    def setup_ui(self):
-        self.top.geometry("1000x250")
-        self.devs_frame = tk.Frame(self.top)
-        self.lbl = tk.Label(self.devs_frame, text="Connected Devices")
-        self.listbox = tk.Listbox(self.devs_frame)
-        self.lbl.pack()
-        self.listbox.pack()
-        self.devs_frame.pack(side=tk.LEFT)
-        self.log_frame = tk.Frame(self.top)
-        self.msg_log = tk.Text(self.log_frame)
-        self.msg_log.pack()
-        self.log_frame.pack(side=tk.LEFT)
-        top.protocol("WM_DELETE_WINDOW", self.on_closing)
-
-    def update_ui(self):
-        self.listbox.delete(0, tk.END)
-        i = 1
-        for dev in self.devs:
-            self.listbox.insert(i, dev.decode('utf-8'))
-            i = i + 1
-        self.top.update_idletasks()
-        self.top.update()
-    
-    def on_closing(self):
-        self.ui_running = False
-    
-    def connect(self):
-        try:
-            self.mailbox.bind(names.BROKER_IN)
-        except zmq.ZMQBaseError as err:
-            raise err
-        self.poller.register(self.mailbox, zmq.POLLIN)
-    
-    def disconnect(self):
+        self.sessions = {}  # device identity -> session token issued in the OK reply
+        self.services = {}  # service name -> list of replica identities
+        self.inflight = {}  # device identity -> number of mail_table entries addressed to it
+        self.last_used = {}  # device identity -> POSIX time a request was last dispatched to it
+        self.hosts = {}  # device identity -> host name it announced at HI
+        self.streams = {}  # stream id -> [sender, receiver, POSIX time of the last chunk or credit]
+        self.peer_codecs = {}  # device identity -> codecs it can decompress, from HI
+        self.directory = {}  # device identity -> endpoint where it accepts direct requests, from HI
+        self.schemas = {}  # device identity -> schema frame it published at HI, see schema.py
+        self.schema_tags = schema.Registry()  # every schema a device published, to catch tag collisions
+        self.codecs = codec.Codecs()  # decompresses frames for peers without their codec
+        self.jrnl = None
+        self.cap = None
+        self.started = None
+        self.replayed = set()  # msg_ids of journaled requests that were retried after a restart
+        self.seen = set()  # identities heard from since a restart, whether or not they said HI again
+        # periodic tasks as [function, period in seconds, seconds left]
+        self.tasks = [[self.print_connections, 1, 1], [self.maintain, 1, 1],
+                      [self.report_stats, STATS_PERIOD, STATS_PERIOD]]
+        self.outbox = []  # messages queued by the stages and tasks, sent by flush()
+        self.held = []  # (msg, POSIX time) encoded urgent messages the lane had no room for, sent again by flush()
+        # every received message goes through these stages as [name, function, seconds, calls]
+        self.stages = []
+        self.register_stage('decode', self.decode)
+        self.register_stage('validate', self.validate)
+        self.register_stage('route', self.dispatch)
+        self.register_stage('mail', self.update_mail)
+        self.register_stage('send', self.flush)
+        # dispatch tables: broker commands, new requests by command, replies by command
+        self.handlers = {b'HI': self.on_hello, b'BYE': self.on_bye, b'CHK': self.on_chunk, b'CRD': self.on_chunk,
+                         b'WHERE': self.on_where, b'SCHEMA': self.on_schema, b'PROF': self.on_profile}
+        self.requests = {b'GET': self.forward_request, b'SET': self.forward_request, b'HIST': self.forward_request,
+                         b'PROF': self.forward_request}
+        self.replies = {b'RET': self.forward_reply, b'MET': self.forward_reply, b'HST': self.forward_reply,
+                        b'PRF': self.forward_reply, b'ERR': self.forward_reply}
+        self.command_stats = {}  # command -> [calls, seconds] in its handler
+        self.register_metrics(metrics.REGISTRY)
+        self.running = False
+        self.thread = None
+        self.ready = threading.Event()  # set once the endpoints are bound, or binding failed
+        self.error = None
+
+    def __repr__(self):
+        return "Broker(endpoints={},devs={},mail={})".format(self.bound, len(self.devs), len(self.mail_table))
+
+    def open(self):
+        """Bind the endpoints and open the journal and capture files"""
+        self.frontend = self.ctx.socket(zmq.ROUTER)
+        self.frontend.identity = 'BROKER'.encode('utf-8')
+        self.frontend.setsockopt(zmq.LINGER, 0)
+        self.frontend.setsockopt(zmq.ROUTER_HANDOVER, 1)  # a restarted device takes over its old identity
+        self.bound = endpoints.bind_all(self.frontend, self.endpoints)
+        self.poller.register(self.frontend, zmq.POLLIN)
+        app_log.info('listening on {}'.format(self.bound))
+        self.urgent = self.ctx.socket(zmq.ROUTER)
+        self.urgent.setsockopt(zmq.LINGER, 0)
+        self.urgent.setsockopt(zmq.ROUTER_HANDOVER, 1)
+        self.urgent.setsockopt(zmq.ROUTER_MANDATORY, 1)  # fail, rather than drop, sends to peers without an urgent lane
+        self.urgent_bound = endpoints.bind_all(self.urgent, self.urgent_endpoints)
+        self.poller.register(self.urgent, zmq.POLLIN)
+        app_log.info('urgent lane on {}'.format(self.urgent_bound))
+        if self.telemetry:
+            self.proxy = telemetry.Proxy(self.ctx, names.TELEMETRY_IN_ENDPOINTS, names.TELEMETRY_OUT_ENDPOINTS)
+            try:
+                self.proxy.start()
+                app_log.info('forwarding telemetry on {}'.format(self.proxy.bound))
+            except zmq.ZMQError as err:
+                app_log.warning('not forwarding telemetry, could not bind: {}'.format(err))
+                self.proxy = None
+        if self.metrics_port is not None:
+            try:
+                self.metrics_server = metrics.serve(self.metrics_port)
+                app_log.info('serving metrics on http://127.0.0.1:{}/metrics'.format(self.metrics_server.server_address[1]))
+            except OSError as err:
+                app_log.warning('not serving metrics, could not bind port {}: {}'.format(self.metrics_port, err))
+        if self.journal_path is not None:
+            self.jrnl = journal.Journal(self.journal_path, self.mail_table)
+            app_log.info('recovered {} requests from {}'.format(len(self.jrnl.recovered), self.jrnl))
+        if self.capture_path is not None:
+            self.cap = capture.Capture(self.capture_path)
+        self.started = time.time()
+
+    def close(self):
+        """Fail the requests in flight unless they are journaled, then release sockets and files; safe after a failed open()"""
+        if self.profiling is not None:
+            self.finish_profile()
+        if self.frontend is None:
+            self.outbox = []
+            self.held = []
+        elif self.jrnl is None:
+            for msg_id, (from_addr, to_addr, timestamp, msg) in list(self.mail_table.items()):
+                self.send([from_addr, b'', msg_id, b'ERR', b'Broker stopped'], msg_id in self.urgent_ids)
+                self.fan_out(msg_id, [b'ERR', b'Broker stopped'])
+                self.untrack(msg_id)
+            self.flush()
+        else:
+            self.jrnl.close()
+            self.jrnl = None
+        if self.cap is not None:
+            self.cap.close()
+            self.cap = None
+        if self.proxy is not None:
+            self.proxy.stop()
+            self.proxy = None
+        if self.metrics_server is not None:
+            metrics.stop(self.metrics_server.server_address[1])
+            self.metrics_server = None
+        self.held = []
+        self.close_router(self.urgent, self.urgent_bound)
+        self.urgent = None
+        self.urgent_bound = []
+        self.close_router(self.frontend, self.bound)
+        self.frontend = None
+        self.bound = []
+        app_log.info('broker stopped')
+
+    def close_router(self, sock, bound):
+        if sock is None:
+            return
         try:
-            self.poller.unregister(self.mailbox)
+            self.poller.unregister(sock)
         except KeyError:
-            pass
-        self.mailbox.close()
-        self.mailbox = make_socket(self.ctx, self.name)  # pre-emptive in case user wants to connect again
-    
-    def reset_connection(self):
-        self.disconnect()
-        self.connect()
-
-    def make_socket(ctx):
-        sock = ctx.socket(zmq.ROUTER)
-        sock.identity = 'BROKER'.encode('utf-8')
-        return sock
-    
-    def log_connections(self):
+            pass  # open() failed before registering it
+        endpoints.unbind_all(sock, bound)
+        sock.close()
+
+    def run(self):
+        """Serve until stop() is called"""
+        self.running = True
+        try:
+            try:
+                self.open()
+            except Exception as err:
+                self.error = err  # before ready, start() raises it once close() is done
+                raise
+            finally:
+                self.ready.set()
+            while self.running:
+                self.step()
+        finally:
+            self.close()
+
+    def serve(self):
+        try:
+            self.run()
+        except Exception as err:
+            self.error = err
+            self.ready.set()
+            app_log.critical('broker thread failed: {}'.format(err))
+
+    def start(self, timeout=5):
+        """Run the broker on a background thread, return once its endpoints are bound"""
+        if self.thread is not None:
+            return 0
+        self.ready.clear()
+        self.error = None
+        self.thread = threading.Thread(target=self.serve, name='broker', daemon=True)
+        self.thread.start()
+        self.ready.wait(timeout)
+        if self.error is not None:
+            self.thread.join()
+            self.thread = None
+            raise self.error
+        return 0
+
+    def stop(self, timeout=5):
+        """Stop serving and wait for the background thread, if any, to close everything"""
+        self.running = False
+        if self.thread is not None:
+            self.thread.join(timeout)
+            self.thread = None
+        return 0
+
+    def step(self, timeout=20):
+        """Handle at most one message, then run the periodic tasks that are due"""
+        start_time = time.time()
+        sockets = dict(self.poller.poll(timeout))
+        busy = time.perf_counter()
+        if self.urgent in sockets:
+            for i in range(URGENT_BATCH):
+                try:
+                    msg = self.urgent.recv_multipart(zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                self.handle(msg, urgent=True)
+        if self.frontend in sockets:
+            self.handle(self.frontend.recv_multipart())
+        dt = time.time() - start_time
+        for task in self.tasks[:]:  # a task may remove itself
+            task[2] -= dt
+            if task[2] < 0:
+                task[0]()
+                task[2] = task[1]
+        self.flush()  # what the tasks queued
+        self.loop_time.observe(time.perf_counter() - busy)
+
+    def track(self, msg_id, from_addr, to_addr, msg):
+        timestamp = time.time()
+        self.mail_table[msg_id] = (from_addr, to_addr, timestamp, msg)
+        self.inflight[to_addr] = self.inflight.get(to_addr, 0) + 1
+        if self.jrnl is not None:
+            self.jrnl.insert(msg_id, from_addr, to_addr, timestamp, msg)
+
+    def untrack(self, msg_id):
+        entry = self.mail_table.pop(msg_id)
+        self.urgent_ids.discard(msg_id)
+        self.take_waiters(msg_id)
+        self.inflight[entry[1]] -= 1
+        if self.jrnl is not None:
+            self.jrnl.delete(msg_id)
+        return entry
+
+    def recover(self):
+        """Retry journaled requests whose device is back, fail the rest once RECOVER_WAIT is over"""
+        if self.jrnl is None or not self.jrnl.recovered:
+            self.seen.clear()
+            return
+        expired = time.time() - self.started > RECOVER_WAIT
+        for msg_id, (from_addr, to_addr, timestamp, msg) in list(self.jrnl.recovered.items()):
+            # a device that stayed up while the broker restarted does not say HI again, but it talks
+            if to_addr in self.devs or to_addr in self.seen:
+                del self.jrnl.recovered[msg_id]
+                self.track(msg_id, from_addr, to_addr, msg)
+                self.replayed.add(msg_id)
+                self.send([to_addr, b'', msg_id] + msg)
+                app_log.info('retrying journaled request {} to {}'.format(msg_id.hex(), to_addr))
+            elif expired:
+                del self.jrnl.recovered[msg_id]
+                self.send([from_addr, b'', msg_id, b'ERR', b'Broker restarted'])
+                app_log.info('failed journaled request {} to {}'.format(msg_id.hex(), to_addr))
+
+    def pick_replica(self, service):
+        """Least-loaded replica of a service, least recently used among equals"""
+        addr = min(self.services[service], key=lambda x: (self.inflight.get(x, 0), self.last_used.get(x, 0)))
+        self.last_used[addr] = time.time()
+        return addr
+
+    def schema_of(self, name):
+        """Schema frame of a device, or of a service whose replicas all published the same one"""
+        if name in self.devs:
+            return self.schemas.get(name)
+        frames = set(self.schemas.get(addr) for addr in self.services.get(name, []))
+        if len(frames) == 1:
+            return frames.pop()
+        return None
+
+    def send(self, msg, urgent=False):
+        """Queue a message for the send stage, on the urgent lane if urgent"""
+        self.outbox.append((msg, urgent))
+
+    def flush(self, job=None):
+        """Send stage: encode the queued messages for their receivers and send them"""
+        self.send_held()
+        outbox, self.outbox = self.outbox, []
+        for msg, urgent in outbox:
+            self.encode_send(msg, urgent)
+
+    def encode_send(self, msg, urgent=False):
+        try:
+            found = values.indices(msg, 3)  # mail: [to, b'', msg_id, command, ...]
+            if found:
+                if self.hosts.get(msg[0]) != shm.HOSTNAME:
+                    shm.inline(msg, found)  # shared memory handles only work on this host
+                self.codecs.transcode(msg, found, self.peer_codecs.get(msg[0], ()))
+            if self.cap is not None:
+                self.cap.write(capture.SEND, msg, time.time(), capture.URGENT if urgent else capture.NORMAL)
+            if urgent:
+                try:
+                    self.urgent.send_multipart(msg, zmq.NOBLOCK)
+                except zmq.Again:
+                    self.hold(msg)  # the peer's queue on the urgent lane is full
+                    return
+                except zmq.ZMQError as err:
+                    if err.errno != zmq.EHOSTUNREACH:
+                        raise
+                    urgent = False  # the peer has no urgent lane
+            if not urgent:
+                self.frontend.send_multipart(msg)
+            self.sent_count[urgent].inc()
+            if msg[3:4] == [b'ERR']:
+                self.errors_sent.inc()
+            app_log.debug('sending {}'.format(msg[:4] if msg[2] == b'CHK' else msg))
+        except zmq.ZMQBaseError as err:
+            app_log.debug('failed to send {} with error: {}'.format(msg, err))
+        except OSError as err:
+            app_log.warning('could not read shared memory payload for {}: {}'.format(msg[:3], err))
+        except (zlib.error, lzma.LZMAError) as err:
+            app_log.warning('could not decompress a payload for {}: {}'.format(msg[:3], err))
+
+    def hold(self, msg, since=None):
+        """Keep an urgent message the lane had no room for, to send it again, until URGENT_HOLD is over"""
+        now = time.time()
+        since = now if since is None else since
+        if now - since < URGENT_HOLD:
+            self.held.append((msg, since))
+        else:
+            self.urgent_dropped.inc()
+            app_log.warning('dropped urgent {}, no room on the urgent lane for {} s'.format(msg[:4], URGENT_HOLD))
+
+    def send_held(self):
+        """Send the held urgent messages again, oldest first"""
+        held, self.held = self.held, []
+        for msg, since in held:
+            try:
+                self.urgent.send_multipart(msg, zmq.NOBLOCK)
+            except zmq.Again:
+                self.hold(msg, since)
+            except zmq.ZMQError as err:
+                app_log.debug('failed to send {} with error: {}'.format(msg, err))
+            else:
+                self.sent_count[True].inc()
+
+    def note_streams(self, from_addr, out_msg):
+        """Remember the streams announced by the value frames of a forwarded message"""
+        for i in values.indices(out_msg, 3):
+            if stream.is_header(out_msg[i]):
+                self.streams[stream.stream_id(out_msg[i])] = [from_addr, out_msg[0], time.time()]
+
+    def relay_stream(self, from_addr, cmd, msg):
+        """Pass a CHK or CRD on to the other end of its stream"""
+        entry = self.streams.get(msg[3])
+        if entry is None or from_addr not in entry[:2]:
+            app_log.debug('{} from {} for unknown stream {}'.format(cmd, from_addr, msg[3].hex()))
+            return
+        peer = entry[1] if from_addr == entry[0] else entry[0]
+        entry[2] = time.time()
+        if cmd == b'CRD' and stream.is_done(msg[4]):
+            del self.streams[msg[3]]
+        self.send([peer, b'', cmd] + msg[3:])
+
+    def evict(self, addr):
+        """Forget a device, drop its requests and fail the requests waiting on it"""
+        self.devs.discard(addr)
+        for sid, entry in list(self.streams.items()):
+            if addr in entry[:2]:
+                del self.streams[sid]
+        self.sessions.pop(addr, None)
+        self.last_used.pop(addr, None)
+        self.hosts.pop(addr, None)
+        self.peer_codecs.pop(addr, None)
+        self.directory.pop(addr, None)
+        self.schemas.pop(addr, None)
+        for service, replicas in list(self.services.items()):
+            if addr in replicas:
+                replicas.remove(addr)
+                if not replicas:
+                    del self.services[service]
+        for key, waiting in self.waiters.values():
+            waiting[:] = [waiter for waiter in waiting if waiter[0] != addr]
+        for msg_id, (from_addr, to_addr, timestamp, msg) in list(self.mail_table.items()):
+            if to_addr == addr:
+                if from_addr in self.devs:
+                    self.send([from_addr, b'', msg_id, b'ERR', b'Device disconnected'], msg_id in self.urgent_ids)
+                self.fan_out(msg_id, [b'ERR', b'Device disconnected'])  # and drops it from gets and waiters
+                self.untrack(msg_id)
+            elif from_addr == addr:
+                # the GETs coalesced with this one still want an answer, one of them is forwarded instead
+                waiting = self.take_waiters(msg_id)
+                self.untrack(msg_id)
+                self.redispatch(waiting)
+
+    def print_connections(self):
         for id, (from_addr, to_addr, timestamp, msg) in self.mail_table.items():
             if time.time() - timestamp > 5:
-                self.logger.debug('Message from {} to {} is older than 5 seconds'.format(from_addr.decode('utf-8'), to_addr.decode('utf-8')))
-        if len(devs) > 0:
-            self.logger.info('connected devices: {}'.format(self.devs))
+                app_log.debug('Message from {} to {} is older than 5 seconds'.format(from_addr.decode('utf-8'), to_addr.decode('utf-8')))
+        if len(self.devs) > 0:
+            app_log.info('connected devices: {}'.format(self.devs))
+        else:
+            app_log.info('no connected devices.')
+        if self.codecs.decompressed > 0:
+            app_log.info('decompressed for peers without the codec: {}'.format(self.codecs))
+
+    def maintain(self):
+        for sid, entry in list(self.streams.items()):
+            if time.time() - entry[2] > stream.STREAM_TTL:
+                del self.streams[sid]
+        if self.jrnl is not None:
+            self.recover()
+            self.jrnl.maybe_compact()
+        if self.cap is not None:
+            self.cap.flush()
+
+    def register_stage(self, name, fn, before=None):
+        """Add a stage fn(job) to the pipeline, at the end or before the stage called before"""
+        stage = [name, fn, 0, 0]
+        if before is None:
+            self.stages.append(stage)
+        else:
+            self.stages.insert([x[0] for x in self.stages].index(before), stage)
+
+    def register(self, cmd, fn, table=None):
+        """Handle cmd with fn(job); table is self.handlers, self.requests or self.replies"""
+        (self.handlers if table is None else table)[cmd] = fn
+
+    def handle(self, msg, urgent=False):
+        """Run one message received on the frontend, or the urgent lane, through the stages, timing each of them"""
+        job = Job(msg, urgent)
+        for stage in self.stages:
+            start = time.perf_counter()
+            stage[1](job)
+            stage[2] += time.perf_counter() - start
+            stage[3] += 1
+            if job.done:
+                break
+
+    def decode(self, job):
+        # msg will be [socket identity, b'', b'HI' or b'BYE' or msg_id]
+        msg = job.msg
+        if self.cap is not None:
+            self.cap.write(capture.RECV, msg, time.time(), capture.URGENT if job.urgent else capture.NORMAL)
+        if len(msg) < 3:
+            job.done = True
+            app_log.warning('dropped a message without command: {}'.format(msg))
+            return
+        job.from_addr = msg[0]
+        job.cmd = msg[2]
+        if self.jrnl is not None and self.jrnl.recovered:
+            self.seen.add(job.from_addr)  # recover() retries what is addressed to it
+        if job.cmd == b'CHK':
+            app_log.debug('received: {}'.format(msg[:4]))
         else:
-            self.logger.info('no connected devices.')
+            app_log.info('received: {}'.format(msg))
+
+    def validate(self, job):
+        """Drop messages too short for their command"""
+        needed = MIN_FRAMES.get(job.cmd)
+        if needed is None and job.cmd not in self.handlers:
+            # msg_id, then to_addr and command for a request or the command for a reply
+            needed = 4 if job.cmd in self.mail_table else 5
+        if needed is not None and len(job.msg) < needed:
+            job.done = True
+            app_log.warning('dropped a malformed {} from {}: {}'.format(job.cmd, job.from_addr, job.msg[:6]))
+        elif job.urgent and job.cmd in self.handlers:
+            job.done = True
+            app_log.warning('dropped {} from {}, the urgent lane only carries mail'.format(job.cmd, job.from_addr))
+
+    def dispatch(self, job):
+        """Route stage: the handler registered for the command, or mail routing by msg_id"""
+        handler = self.handlers.get(job.cmd)
+        if handler is None:
+            self.route(job)
+        else:
+            self.timed(job.cmd, handler, job)
+
+    def update_mail(self, job):
+        """Mail stage: apply the mail_table changes the route stage decided on"""
+        for op in job.mail:
+            if op[0] is None:
+                self.untrack(op[1])
+            else:
+                self.track(*op)
+
+    def stage_stats(self):
+        """[(stage, calls, total seconds)] and {command: [calls, total seconds]} of the handlers"""
+        return [(name, calls, seconds) for name, fn, seconds, calls in self.stages], dict(self.command_stats)
+
+    def coalescing_stats(self):
+        """GETs forwarded to devices and identical GETs that waited for their reply instead"""
+        return {'forwarded': self.forwarded_gets, 'coalesced': self.coalesced_gets}
+
+    def report_stats(self):
+        stages, commands = self.stage_stats()
+        if self.coalesced_gets:
+            app_log.info('GETs: {}'.format(self.coalescing_stats()))
+        app_log.info('stages: {}'.format(', '.join('{} {} x {:.1f} us'.format(name, calls, seconds / calls * 1e6)
+                                                  for name, calls, seconds in stages if calls)))
+        app_log.info('commands: {}'.format(', '.join('{} {} x {:.1f} us'.format(cmd.decode('utf-8', 'replace'), calls, seconds / calls * 1e6)
+                                                    for cmd, (calls, seconds) in sorted(commands.items()))))
+
+    def register_metrics(self, registry):
+        """Export the broker's counters to registry, most of them read at scrape time from the stats kept anyway"""
+        labels = {'broker': self.endpoints[0]}  # tells apart the brokers of a process, they share the registry
+        self.loop_time = registry.summary('labzmq_broker_loop_seconds', 'Time spent handling messages and tasks per poll', **labels)
+        self.sent_count = {False: registry.counter('labzmq_broker_sent_total', 'Messages sent', lane='normal', **labels),
+                           True: registry.counter('labzmq_broker_sent_total', 'Messages sent', lane='urgent', **labels)}
+        self.errors_sent = registry.counter('labzmq_broker_errors_sent_total', 'ERR replies sent, from the broker or forwarded', **labels)
+        self.urgent_dropped = registry.counter('labzmq_broker_urgent_dropped_total', 'Urgent messages dropped after URGENT_HOLD without room on the urgent lane', **labels)
+        registry.gauge('labzmq_broker_mail_table_size', 'Requests in flight', lambda: len(self.mail_table), **labels)
+        registry.gauge('labzmq_broker_devices', 'Connected devices', lambda: len(self.devs), **labels)
+        registry.gauge('labzmq_broker_streams', 'Chunked streams open', lambda: len(self.streams), **labels)
+        registry.collect('labzmq_broker_inflight', metrics.GAUGE, 'Requests in flight per destination device',
+                         lambda: [({'device': addr}, n) for addr, n in list(self.inflight.items())], **labels)
+        registry.collect('labzmq_broker_messages_total', metrics.COUNTER, 'Messages handled by command',
+                         lambda: [({'command': cmd}, stats[0]) for cmd, stats in list(self.command_stats.items())], **labels)
+        registry.collect('labzmq_broker_handler_seconds_total', metrics.COUNTER, 'Time spent in command handlers',
+                         lambda: [({'command': cmd}, stats[1]) for cmd, stats in list(self.command_stats.items())], **labels)
+        registry.collect('labzmq_broker_stage_seconds_total', metrics.COUNTER, 'Time spent in pipeline stages',
+                         lambda: [({'stage': stage[0]}, stage[2]) for stage in list(self.stages)], **labels)
+        registry.collect('labzmq_broker_gets_total', metrics.COUNTER, 'GETs forwarded to devices or coalesced with one in flight',
+                         lambda: [({'outcome': 'forwarded'}, self.forwarded_gets), ({'outcome': 'coalesced'}, self.coalesced_gets)], **labels)
+
+    def timed(self, cmd, fn, job):
+        start = time.perf_counter()
+        fn(job)
+        if cmd not in self.handlers and cmd not in self.requests and cmd not in self.replies:
+            cmd = OTHER  # whatever peers send, the stats and metric labels stay a fixed set
+        stats = self.command_stats.setdefault(cmd, [0, 0])
+        stats[0] += 1
+        stats[1] += time.perf_counter() - start
+
+    def on_chunk(self, job):
+        self.relay_stream(job.from_addr, job.cmd, job.msg)
+
+    def on_where(self, job):
+        # services have no single endpoint, requests to them stay with the broker to be balanced
+        endpoint = self.directory.get(job.msg[3])
+        self.send([job.from_addr, b'', b'HERE', job.msg[3]] + ([endpoint] if endpoint is not None else []))
+
+    def on_schema(self, job):
+        frame = self.schema_of(job.msg[3])
+        self.send([job.from_addr, b'', b'SCHEMA', job.msg[3]] + ([frame] if frame is not None else []))
+
+    def on_profile(self, job):
+        # the ERR has an empty msg_id, PROF to the broker is not mail and has none
+        try:
+            seconds, mode = profiler.parse_options(job.msg[3:])
+        except ValueError as err:
+            self.send([job.from_addr, b'', b'', b'ERR', str(err).encode('utf-8')])
+            return
+        if self.profiling is not None:
+            self.send([job.from_addr, b'', b'', b'ERR', b'Already profiling'])
+            return
+        self.profile(seconds, mode, job.from_addr)
+
+    def profile(self, seconds=profiler.SECONDS, mode=profiler.CPROFILE, requester=None):
+        """Profile the broker's loop for seconds; the summary goes to requester, if any, and to the log"""
+        if self.profiling is not None:
+            return
+        self.profiling = profiler.Profile('broker', seconds, mode, self.profile_dir)
+        self.profile_requester = requester
+        self.profile_task = [self.check_profile, 0.1, 0.1]
+        self.tasks.append(self.profile_task)
+        app_log.info('profiling for {} s, requested by {}'.format(seconds, requester))
+
+    def check_profile(self):
+        if self.profiling.due():
+            self.finish_profile()
+
+    def finish_profile(self):
+        summary = self.profiling.finish()
+        path = self.profiling.path
+        self.profiling = None
+        self.tasks.remove(self.profile_task)
+        self.profile_task = None
+        app_log.info('profile written to {}\n{}'.format(path, summary))
+        if self.profile_requester is not None:
+            self.send([self.profile_requester, b'', b'PRF', path.encode('utf-8'), summary.encode('utf-8')])
+            self.profile_requester = None
+
+    def toggle_profile(self, signum=None, frame=None):
+        """Signal handler: start a window of profiler.SECONDS, or end the one in progress early"""
+        if self.profiling is None:
+            self.profile()
+        else:
+            self.profiling.deadline = 0
+
+    def on_hello(self, job):
+        self.hello(job.from_addr, job.msg)
+
+    def on_bye(self, job):
+        if job.from_addr in self.devs:
+            self.evict(job.from_addr)
+        else:
+            app_log.warning('received BYE from {} but {} is not listed in devs'.format(job.from_addr, job.from_addr))
+
+    def hello(self, from_addr, msg):
+        # HI may be followed by option frames in key, value pairs
+        opts = dict(zip(msg[3::2], msg[4::2]))
+        token = opts.get(b'SESSION')
+        resend = []
+        if from_addr in self.devs and token is not None and token == self.sessions.get(from_addr):
+            # same device came back, e.g. after a crash, keep its pending mail
+            app_log.info("{} resumed its session".format(from_addr))
+            for msg_id, (req_addr, dest_addr, timestamp, req) in self.mail_table.items():
+                if dest_addr == from_addr:
+                    resend.append(([dest_addr, b'', msg_id] + req, msg_id in self.urgent_ids))
+            msg = [from_addr, b"", b"OK", b"SESSION", token]
+        elif from_addr in self.devs and token is not None:
+            app_log.warning("{} tried to join, but it already joined".format(from_addr))
+            msg = [from_addr, b"", b"ERR", b"Device already connected"]
+        else:
+            if from_addr in self.devs:
+                app_log.warning("{} joined again without a session, evicting the stale one".format(from_addr))
+                self.evict(from_addr)
+            self.devs.add(from_addr)
+            self.sessions[from_addr] = gen_id()
+            service = opts.get(b'SERVICE')
+            if service is not None and service != from_addr:
+                self.services.setdefault(service, []).append(from_addr)
+                app_log.info('{} is a replica of {}'.format(from_addr, service))
+            msg = [from_addr, b"", b"OK", b"SESSION", self.sessions[from_addr]]
+        if msg[2] == b"OK":
+            if b'HOST' in opts:
+                self.hosts[from_addr] = opts[b'HOST'].decode('utf-8')
+            self.peer_codecs[from_addr] = set(codec.decode_names(opts.get(b'CODECS', b'')))
+            if b'DIRECT' in opts:
+                self.directory[from_addr] = opts[b'DIRECT']
+            if b'SCHEMA' in opts:
+                try:
+                    self.schema_tags.register(from_addr, schema.Schema.decode(opts[b'SCHEMA']))
+                    self.schemas[from_addr] = opts[b'SCHEMA']
+                except schema.SchemaCollision as err:
+                    # clients may still hold IDs of the earlier schema, which would name other params now
+                    app_log.warning('{}, its params are reached by name only'.format(err))
+                    self.schemas.pop(from_addr, None)
+                    msg += [b'IDS', b'0']
+            msg += [b'CODECS', codec.encode_names(codec.available())]
+        self.send(msg)
+        for out_msg, urgent in resend:  # after OK, the device only reads mail once it is idle
+            self.send(out_msg, urgent)
+        self.recover()
+
+    def route(self, job):
+        """
+        Message should begin with msg_id, possibly dest, then (GET, SET, RET, MET), then extra info
+        New requests go to the handler in self.requests, replies to the one in self.replies
+        """
+        msg_id = job.msg[2]
+        if msg_id not in self.mail_table and job.msg[3] in self.replies:
+            self.recovered_reply(job)
+            return
+        if msg_id not in self.mail_table:  # this could be a new request
+            to_addr = job.msg[3]
+            cmd = job.msg[4]
+            if to_addr not in self.devs and to_addr in self.services:
+                to_addr = self.pick_replica(to_addr)
+            if to_addr not in self.devs:
+                self.send([job.from_addr, b'', msg_id, b'ERR', b'Device not connected'], job.urgent)
+                app_log.debug('requested device {} does not exist'.format(to_addr))
+                return
+            job.to_addr = to_addr
+            handler = self.requests.get(cmd)
+            if handler is None:
+                self.send([job.from_addr, b'', msg_id, b'ERR', b'Command not understood'], job.urgent)
+                app_log.warning('command {} not yet supported'.format(cmd))
+                return
+        else:  # this could be a reply to a request
+            to_addr = self.mail_table[msg_id][0]  # lookup message requestor
+            cmd = job.msg[3]
+            # a requestor of a journaled request may not have said HI to this broker yet
+            if to_addr not in self.devs and msg_id not in self.replayed:
+                app_log.warning('original requestor {} no longer connected'.format(to_addr))
+                return
+            self.replayed.discard(msg_id)
+            if job.from_addr != self.mail_table[msg_id][1]:
+                app_log.critical('{} sent a message ID that does not agree with mail table.'.format(job.from_addr))
+                app_log.critical(job.msg[3:])
+                app_log.critical(print_mail_table(self.mail_table))
+                return
+            job.to_addr = to_addr
+            handler = self.replies.get(cmd, self.reply_poorly)
+        self.timed(cmd, handler, job)
+
+    def recovered_reply(self, job):
+        """Reply to a journaled request that its device got before the broker restarted, or to a forgotten one"""
+        msg_id = job.msg[2]
+        entry = self.jrnl.recovered.get(msg_id) if self.jrnl is not None else None
+        if entry is None or entry[1] != job.from_addr:
+            app_log.warning('dropped {} from {} for unknown request {}'.format(job.msg[3], job.from_addr, msg_id.hex()))
+            return
+        del self.jrnl.recovered[msg_id]
+        self.jrnl.delete(msg_id)
+        self.send([entry[0], b'', msg_id] + job.msg[3:])
+        app_log.info('forwarded the reply to journaled request {} from {}'.format(msg_id.hex(), job.from_addr))
+
+    def forward_request(self, job):
+        """GET, SET and HIST: forward to the device, ACK to the requester"""
+        msg_id, msg = job.msg[2], job.msg[4:]  # msg starts with the command
+        if msg[0] == b'GET':
+            # keyed by the name asked for, so GETs to a service coalesce whichever replica serves them
+            key = (job.urgent, job.msg[3]) + tuple(msg[1:])
+            first = self.gets.get(key)
+            if first is not None and time.time() - self.mail_table[first][2] < GET_COALESCE_AGE:
+                self.waiters[first][1].append((job.from_addr, msg_id, job.urgent, job.msg))
+                if not job.acked:
+                    self.send([job.from_addr, b'', msg_id, b'ACK'], job.urgent)
+                self.coalesced_gets += 1
+                return
+            # the requests waiting on a GET that got no answer in time wait on this one instead
+            waiting = [] if first is None else self.take_waiters(first)
+            self.gets[key] = msg_id
+            self.waiters[msg_id] = (key, waiting)
+            self.forwarded_gets += 1
+        out_msg = [job.to_addr, b'', msg_id] + msg
+        self.note_streams(job.from_addr, out_msg)
+        self.send(out_msg, job.urgent)
+        if not job.acked:
+            self.send([job.from_addr, b'', msg_id, b'ACK'], job.urgent)
+        job.mail.append((msg_id, job.from_addr, job.to_addr, msg))
+        if job.urgent:
+            self.urgent_ids.add(msg_id)
+
+    def forward_reply(self, job):
+        """RET, MET, HST and ERR: forward to the requester and forget the request"""
+        msg_id = job.msg[2]
+        frames = job.msg[3:]
+        if self.waiters.get(msg_id, (None, None))[1]:
+            found = values.indices(frames, 0)
+            if any(stream.is_header(frames[i]) for i in found):
+                # a stream goes to one receiver, the others ask again
+                self.redispatch(self.take_waiters(msg_id))
+            else:
+                try:
+                    frames = [shm.read(frame) if i in found and shm.is_handle(frame) else frame
+                              for i, frame in enumerate(frames)]  # one reader per handle
+                    self.fan_out(msg_id, frames)
+                except OSError as err:
+                    app_log.warning('could not read shared memory payload for {}: {}'.format(msg_id.hex(), err))
+                    self.redispatch(self.take_waiters(msg_id))
+        out_msg = [job.to_addr, b'', msg_id] + frames
+        self.note_streams(job.from_addr, out_msg)
+        self.send(out_msg, msg_id in self.urgent_ids)
+        job.mail.append((None, msg_id))
+
+    def reply_poorly(self, job):
+        msg_id = job.msg[2]
+        self.send([job.to_addr, b'', msg_id, b'ERR', b'Device replied poorly'], msg_id in self.urgent_ids)
+        self.fan_out(msg_id, [b'ERR', b'Device replied poorly'])
+        job.mail.append((None, msg_id))
+        app_log.warning('{} sent unrecognized response: {}'.format(job.from_addr, job.msg[3:]))
+
+
+    def take_waiters(self, msg_id):
+        """Requests coalesced with a GET, which stops taking more"""
+        entry = self.waiters.pop(msg_id, None)
+        if entry is None:
+            return []
+        if self.gets.get(entry[0]) == msg_id:
+            del self.gets[entry[0]]
+        return entry[1]
+
+    def fan_out(self, msg_id, frames):
+        """Send the reply frames of a GET to the requests coalesced with it, each under its own msg_id"""
+        for from_addr, waiter_id, urgent, msg in self.take_waiters(msg_id):
+            if from_addr in self.devs:
+                self.send([from_addr, b'', waiter_id] + frames, urgent)
+
+    def redispatch(self, waiting):
+        """Route coalesced requests again as if they had just arrived"""
+        for from_addr, msg_id, urgent, msg in waiting:
+            job = Job(msg, urgent)
+            job.from_addr = from_addr
+            job.cmd = msg_id
+            job.acked = True
+            self.route(job)
+            self.update_mail(job)
+
 
 def print_mail_table(mt):
     header_format = '{0:<34} : {1}\n'
@@ -101,19 +877,13 @@ def print_mail_table(mt):
         mt_str += row_format.format(id.hex(), msg)
     return mt_str
 
-def main():
-    """Load balancer main loop."""
-    # Prepare context and sockets
-    context = zmq.Context.instance()
-    frontend = context.socket(zmq.ROUTER)
-    frontend.identity = 'BROKER'.encode('utf-8')
-    frontend.bind(names.BROKER_IN)
-
-    # Initialize main loop state
-    count = NBR_DEVS
-    devs = set()
-    poller = zmq.Poller() 
-    
+def main(journal_path=None, capture_path=None, metrics_port=None):
+    """
+    Broker in the foreground with a Tk window listing the connected devices and
+    the mail table, see Broker for the arguments.
+    """
+    broker = Broker(journal_path=journal_path, capture_path=capture_path, metrics_port=metrics_port)
+
     # setup Tk window
     top = tk.Tk()
     top.geometry("1000x250")
@@ -127,156 +897,33 @@ def main():
     msg_log = tk.Text(log_frame)
     msg_log.pack()
     log_frame.pack(side=tk.LEFT)
-    gui_running = True
-
-    poller.register(frontend, zmq.POLLIN)
-
-    mail_table = {}
 
     def update_gui():
         listbox.delete(0, tk.END)
         i = 1
-        for dev in devs:
+        for dev in broker.devs:
             listbox.insert(i, str(dev))
             i = i + 1
+        msg_log.delete(1.0, tk.END)
+        msg_log.insert(tk.END, print_mail_table(broker.mail_table))
         top.update_idletasks()
         top.update()
-    
-    def on_closing():
-        gui_running = False
 
-    top.protocol("WM_DELETE_WINDOW", on_closing)
-
-    def print_connections():
-        for id, (from_addr, to_addr, timestamp, msg) in mail_table.items():
-            if time.time() - timestamp > 5:
-                app_log.debug('Message from {} to {} is older than 5 seconds'.format(from_addr.decode('utf-8'), to_addr.decode('utf-8')))
-        if len(devs) > 0:
-            app_log.info('connected devices: {}'.format(devs))
-        else:
-            app_log.info('no connected devices.')
-
-    tasks = [print_connections, update_gui]
-    times = [1, 0.2]
-    timers = times.copy()
-
-    while gui_running:
-        start_time = time.time()
-
-        msg_log.delete(1.0, tk.END)
-        msg_log.insert(tk.END, print_mail_table(mail_table))
-
-        sockets = dict(poller.poll(20))
-
-        if frontend in sockets:
-            # msg will be [socket identity, b'', b'HI' or b'BYE' or msg_id]
-            msg = frontend.recv_multipart()
-            app_log.info('received: {}'.format(msg))
-            from_addr = msg[0]
-            cmd = msg[2]
-            """
-            Handle messages from workers to broker
-            """
-            if cmd == b"HI":
-                if from_addr in devs:
-                    app_log.warning("{} tried to join, but it already joined".format(from_addr))
-                    msg = [from_addr, b"", b"ERR", b"Device already connected"]
-                else:
-                    devs.add(from_addr)
-                    msg = [from_addr, b"", b"OK"]
-                frontend.send_multipart(msg)
-                app_log.debug('sending {}'.format(msg))
-            elif cmd == b"BYE":
-                try:
-                    devs.remove(from_addr)
-                    for x in mail_table:
-                        if x[0] == from_addr:
-                            del x
-                except KeyError:
-                    app_log.warning('received BYE from {} but {} is not listed in devs'.format(from_addr, from_addr))
-            else:
-                """
-                Message should begin with msg_id, possibly dest, then (GET, SET, RET, MET), then extra info
-                out_msg is the message sent to to_addr
-                reply is the message sent to from_addr
-                """
-                msg_id = msg[2]
-                msg = msg[3:]  # strip everything up to and including msg_id
-                out_msg = None  # goes to the to_addr, which is extracted from message or mail_table
-                reply = None  # goes to the from_addr
-                if msg_id not in mail_table:  # this could be a new request
-                    to_addr = msg[0]
-                    cmd = msg[1]
-                    msg = msg[1:]  # strip the to_addr
-                    if to_addr in devs:
-                        if cmd == b'GET':
-                            out_msg = [to_addr, b'', msg_id] + msg
-                            reply = [from_addr, b'', msg_id, b'ACK']
-                            mail_table[msg_id] = (from_addr, to_addr, time.time(), msg)
-                            app_log.debug('Processed GET')
-                        elif cmd == b'SET':
-                            out_msg = [to_addr, b'', msg_id] + msg
-                            reply = [from_addr, b'', msg_id, b'ACK']
-                            mail_table[msg_id] = (from_addr, to_addr, time.time(), msg)
-                            app_log.debug('Processed SET')
-                        else:
-                            reply = [from_addr, b'', msg_id, b'ERR', b'Command not understood']
-                            app_log.warning('command {} not yet supported'.format(cmd))
-                    else:
-                        reply = [from_addr, b'', msg_id, b'ERR', b'Device not connected']
-                        app_log.debug('requested device {} does not exist'.format(to_addr))
-                        app_log.debug(print_mail_table(mail_table))
-                else:  # this could be a reply to a request
-                    to_addr = mail_table[msg_id][0]  # lookup message requestor
-                    cmd = msg[0]
-                    if to_addr in devs:
-                        if from_addr != mail_table[msg_id][1]:
-                            app_log.critical('{} sent a message ID that does not agree with mail table.'.format(from_addr))
-                            app_log.critical(msg)
-                            app_log.critical(print_mail_table(mail_table))
-                        elif cmd == b'RET':
-                            out_msg = [to_addr, b'', msg_id] + msg
-                            del mail_table[msg_id]
-                            app_log.debug('Processed RET')
-                        elif cmd == b'MET':
-                            out_msg = [to_addr, b'', msg_id] + msg
-                            del mail_table[msg_id]
-                            app_log.debug('Processed MET')
-                        elif cmd == b'ERR':
-                            del mail_table[msg_id]
-                            out_msg = [to_addr, b'', msg_id] + msg
-                        else:
-                            del mail_table[msg_id]
-                            out_msg = [to_addr, b'', msg_id, b'ERR', b'Device replied poorly']
-                            app_log.warning('{} sent unrecognized response: {}'.format(from_addr, msg))
-                    else:
-                        app_log.warning('original requestor {} no longer connected'.format(to_addr))
-                if out_msg is not None:
-                    try:
-                        frontend.send_multipart(out_msg)
-                        app_log.debug('sending {}'.format(out_msg))
-                    except zmq.ZMQBaseError as err:
-                        app_log.debug('failed to send {} with error: {}'.format(msg, err))
-                if reply is not None:
-                    try:
-                        frontend.send_multipart(reply)
-                        app_log.debug('sending {}'.format(reply))
-                    except zmq.ZMQBaseError as err:
-                        app_log.debug('failed to send {} with error: {}'.format(msg, err))
-
-        end_time = time.time()
-        dt = end_time - start_time
-        timers = [x - dt for x in timers]
-        for i, x in enumerate(timers):
-            if x < 0:
-                tasks[i]()
-                timers[i] = times[i]
+    top.protocol("WM_DELETE_WINDOW", broker.stop)
+    if hasattr(signal, 'SIGUSR1'):  # kill -USR1 <pid> profiles the broker, see profiler.py
+        signal.signal(signal.SIGUSR1, broker.toggle_profile)
+    broker.tasks.append([update_gui, 0.2, 0.2])
+    broker.run()
 
     # Clean up
-    frontend.close()
-    context.term()
+    broker.ctx.term()
     top.destroy()
 
 if __name__ == "__main__":
-    main()
-
+    parser = argparse.ArgumentParser(description='labzmq broker')
+    parser.add_argument('--journal', help='journal in-flight requests to this file and recover them on restart')
+    parser.add_argument('--capture', help='record all traffic to this file, see replay.py')
+    parser.add_argument('--metrics-port', type=int, default=names.BROKER_METRICS_PORT,
+                        help='serve metrics on this localhost port, see metrics.py (default %(default)s)')
+    args = parser.parse_args()
+    main(journal_path=args.journal, capture_path=args.capture, metrics_port=args.metrics_port)
@@ -0,0 +1,77 @@
+"""
+Binary capture of the messages a broker receives and sends
+
+A capture file starts with MAGIC and is followed by one record per message:
+    double timestamp, uint8 direction (RECV or SEND), uint8 lane (NORMAL or URGENT),
+    uint16 identity length, uint16 frame count,
+    identity, then uint32 length and bytes for every other frame
+The identity is the first frame of the ROUTER message: the sender for RECV,
+the destination for SEND. The lane is the one the message came in on, or the
+one it was sent on. Files of the first format, MAGIC_V1, have no lane byte and
+are read as all NORMAL.
+"""
+
+import struct
+
+MAGIC = b'LZCAP2\n'
+MAGIC_V1 = b'LZCAP1\n'
+
+RECV = 0
+SEND = 1
+
+NORMAL = 0
+URGENT = 1
+
+_record = struct.Struct('<dBBHH')
+_record_v1 = struct.Struct('<dBHH')
+_len = struct.Struct('<I')
+
+
+class Capture(object):
+    """Writes a capture file, see the module docstring for the format"""
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC)
+        self.count = 0
+
+    def __repr__(self):
+        return "Capture(path={},count={})".format(self.path, self.count)
+
+    def write(self, direction, msg, timestamp, lane=NORMAL):
+        parts = [_record.pack(timestamp, direction, lane, len(msg[0]), len(msg) - 1), msg[0]]
+        for frame in msg[1:]:
+            parts.append(_len.pack(len(frame)))
+            parts.append(frame)
+        self.file.write(b''.join(parts))
+        self.count += 1
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def read_capture(path):
+    """Yield (timestamp, direction, lane, identity, frames) for every record in a capture file"""
+    with open(path, 'rb') as f:
+        magic = f.read(len(MAGIC))
+        if magic not in (MAGIC, MAGIC_V1):
+            raise ValueError('{} is not a capture file'.format(path))
+        record = _record if magic == MAGIC else _record_v1
+        while True:
+            head = f.read(record.size)
+            if len(head) < record.size:
+                return
+            if magic == MAGIC:
+                timestamp, direction, lane, n, count = record.unpack(head)
+            else:
+                timestamp, direction, n, count = record.unpack(head)
+                lane = NORMAL
+            identity = f.read(n)
+            frames = []
+            for i in range(count):
+                n, = _len.unpack(f.read(_len.size))
+                frames.append(f.read(n))
+            yield timestamp, direction, lane, identity, frames
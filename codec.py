@@ -0,0 +1,140 @@
+"""
+Optional compression of large value frames
+
+A compressed frame is MAGIC, one codec id byte and the compressed bytes, so a
+receiver sees from the frame alone whether and how to decompress it. zlib and
+lzma come with Python; lz4 and zstd are used when their packages are installed.
+
+Devices list the codecs they can decompress at HI (CODECS option) and the
+broker answers with its own. A device only compresses with a codec the broker
+has, and the broker decompresses frames for peers that did not list the codec.
+Streamed values are opaque to the broker, so values big enough to be streamed
+only use a codec every peer has (PORTABLE).
+"""
+
+import time
+import zlib
+import lzma
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MAGIC = b'\x00Z'  # see values.py
+COMPRESS_THRESHOLD = 4 * 1024  # frames at least this big are compressed
+
+PORTABLE = ('zlib', 'lzma')  # always available
+
+# name -> (id byte, compress, decompress)
+CODECS = {
+    'zlib': (b'z', lambda data: zlib.compress(data, 1), zlib.decompress),
+    'lzma': (b'x', lambda data: lzma.compress(data, preset=0), lzma.decompress),
+}
+if lz4 is not None:
+    CODECS['lz4'] = (b'4', lz4.frame.compress, lz4.frame.decompress)
+if zstandard is not None:
+    CODECS['zstd'] = (b's', zstandard.ZstdCompressor(level=1).compress,
+                      lambda data: zstandard.ZstdDecompressor().decompress(data))
+
+_by_id = dict((codec_id, name) for name, (codec_id, compress, decompress) in CODECS.items())
+
+
+def available():
+    """Codec names this process can use, fastest first"""
+    return [name for name in ('lz4', 'zstd', 'zlib', 'lzma') if name in CODECS]
+
+
+def encode_names(codec_names):
+    return ','.join(codec_names).encode('utf-8')
+
+
+def decode_names(frame):
+    return [name for name in frame.decode('utf-8').split(',') if name]
+
+
+def is_compressed(frame):
+    return frame[:len(MAGIC)] == MAGIC
+
+
+def codec_of(frame):
+    """Name of the codec a compressed frame was made with"""
+    return _by_id.get(bytes(frame[len(MAGIC):len(MAGIC) + 1]))
+
+
+class Codecs(object):
+    """Compresses and decompresses value frames, and keeps count of what it cost"""
+    def __init__(self, threshold=COMPRESS_THRESHOLD):
+        self.threshold = threshold
+        self.compressed = 0  # frames sent compressed
+        self.skipped = 0  # frames over the threshold that did not get smaller
+        self.decompressed = 0
+        self.bytes_in = 0  # sizes before and after compression of the compressed frames
+        self.bytes_out = 0
+        self.compress_time = 0  # CPU seconds
+        self.decompress_time = 0
+
+    def __repr__(self):
+        return "Codecs(compressed={},skipped={},decompressed={},ratio={:.2f},compress_time={:.3f},decompress_time={:.3f})".format(
+            self.compressed, self.skipped, self.decompressed, self.ratio(), self.compress_time, self.decompress_time)
+
+    def ratio(self):
+        """Bytes before over bytes after compression, 1 if nothing was compressed"""
+        if self.bytes_out == 0:
+            return 1.0
+        return self.bytes_in / self.bytes_out
+
+    def stats(self):
+        return {
+            'compressed': self.compressed,
+            'skipped': self.skipped,
+            'decompressed': self.decompressed,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'ratio': self.ratio(),
+            'compress_time': self.compress_time,
+            'decompress_time': self.decompress_time,
+        }
+
+    def pack(self, frame, name):
+        """The frame compressed with codec name, or the frame itself if it is small or does not shrink"""
+        if len(frame) < self.threshold:
+            return frame
+        codec_id, compress, decompress = CODECS[name]
+        start = time.process_time()
+        data = MAGIC + codec_id + compress(frame)
+        self.compress_time += time.process_time() - start
+        if len(data) >= len(frame):
+            self.skipped += 1
+            return frame
+        self.compressed += 1
+        self.bytes_in += len(frame)
+        self.bytes_out += len(data)
+        return data
+
+    def unpack(self, frame):
+        """The original bytes of a frame, decompressing it if needed"""
+        if not is_compressed(frame):
+            return frame
+        name = codec_of(frame)
+        if name is None:
+            raise ValueError('frame compressed with unknown codec {}'.format(bytes(frame[len(MAGIC):len(MAGIC) + 1])))
+        codec_id, compress, decompress = CODECS[name]
+        start = time.process_time()
+        data = decompress(bytes(frame[len(MAGIC) + 1:]))
+        self.decompress_time += time.process_time() - start
+        self.decompressed += 1
+        return data
+
+    def transcode(self, msg, indices, accepted):
+        """Decompress the frames of msg at indices (its value frames) made with a known codec that is not in accepted"""
+        for i in indices:
+            name = codec_of(msg[i]) if is_compressed(msg[i]) else None
+            if name is not None and name not in accepted:
+                msg[i] = self.unpack(msg[i])
+        return msg
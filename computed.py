@@ -0,0 +1,208 @@
+"""
+Parameters read from and written to hardware
+
+A Computed parameter is backed by a getter and, unless it is read-only, a
+setter. Reads and writes run on worker threads so a slow instrument does not
+block the device's loop, and the results are handed back to the loop through
+an inproc socket it polls. Each parameter caches its last value:
+
+    max_age=0            every GET reads the hardware (always fresh)
+    max_age=s            a value up to s seconds old is returned from the cache
+    refresh_ahead=True   a stale cached value is returned at once and a read
+                         starts in the background for the next GET
+
+GETs that arrive while a read of the same parameter is in progress wait for
+that read instead of starting another one. The reads and writes of one
+parameter reach the hardware one at a time, in the order they were asked
+for; different parameters run in parallel.
+"""
+
+import itertools
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import zmq
+
+import schema
+
+WORKERS = 4  # threads reading and writing hardware, per device
+
+_ids = itertools.count()
+
+
+class Computed(object):
+    def __init__(self, getter, setter=None, max_age=0, refresh_ahead=False, type_name='object'):
+        self.getter = getter  # getter() -> value
+        self.setter = setter  # setter(value), None for a read-only parameter
+        self.max_age = max_age  # seconds a read stays fresh
+        self.refresh_ahead = refresh_ahead
+        self.type_name = type_name  # published in the schema
+        self.access = schema.READ if setter is None else schema.READ_WRITE
+        self.value = None
+        self.read_time = None  # time.time() of the read or write that gave value, None if there was none
+        self.reading = False  # a read is in progress
+        self.waiters = []  # callbacks waiting for that read
+        self.reads = 0  # hardware reads done
+        self.hits = 0  # GETs answered from the cache
+        self.lock = threading.Lock()  # guards jobs and busy, shared with the worker threads
+        self.jobs = deque()  # (fn, args, callback, generation) waiting for the hardware, oldest first
+        self.busy = False  # a worker is running this parameter's jobs
+
+    def __repr__(self):
+        return "Computed(max_age={},refresh_ahead={},reads={},hits={})".format(self.max_age, self.refresh_ahead, self.reads, self.hits)
+
+    def fresh(self):
+        return self.read_time is not None and time.time() - self.read_time < self.max_age
+
+
+class Computer(object):
+    """Runs the getters and setters of Computed parameters on worker threads"""
+    def __init__(self, ctx, workers=WORKERS):
+        self.ctx = ctx
+        self.workers = workers
+        self.executor = None  # started on first use
+        self.endpoint = None  # a new one at each open(), the last one may still be bound while it closes
+        self.socket = None  # becomes readable when results are waiting, see open()
+        self.waker = None
+        self.lock = threading.Lock()  # the waker is used from the worker threads
+        self.results = deque()  # (callback, future) of finished reads and writes
+        self.reading = set()  # parameters with a read in progress
+        self.generation = 0  # counts close() calls, results of jobs from before the last one are dropped
+        self.on_value = None  # on_value(param, value) for every value read or written
+
+    def __repr__(self):
+        return "Computer(workers={},pending={})".format(self.workers, len(self.results))
+
+    def open(self, poller):
+        """Create the wakeup socket and register it with the device's poller"""
+        if self.socket is not None:
+            return
+        self.endpoint = 'inproc://labzmq-computed-{}'.format(next(_ids))
+        self.socket = self.ctx.socket(zmq.PULL)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.bind(self.endpoint)
+        self.waker = self.ctx.socket(zmq.PUSH)
+        self.waker.setsockopt(zmq.LINGER, 0)
+        self.waker.connect(self.endpoint)
+        poller.register(self.socket, zmq.POLLIN)
+
+    def close(self, poller):
+        """Stop handing back results; reads still running finish on their own and are dropped"""
+        with self.lock:
+            self.generation += 1
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+        if self.socket is None:
+            return
+        poller.unregister(self.socket)
+        with self.lock:
+            self.waker.close()
+            self.waker = None
+        self.socket.close()
+        self.socket = None
+        self.results.clear()
+        for param in self.reading:
+            param.reading = False
+            param.waiters = []
+        self.reading.clear()
+
+    def submit(self, param, fn, callback, *args):
+        """Run fn(*args) after the jobs of param already queued, then callback(future) on the device's thread"""
+        with param.lock:
+            param.jobs.append((fn, args, callback, self.generation))
+            if param.busy:
+                return
+            param.busy = True
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(self.workers)
+        self.executor.submit(self.run, param)
+
+    def run(self, param):
+        # runs on a worker thread, until the parameter has no job left
+        while True:
+            with param.lock:
+                if not param.jobs:
+                    param.busy = False
+                    return
+                fn, args, callback, generation = param.jobs.popleft()
+            if generation != self.generation:
+                continue  # queued before close()
+            future = Future()
+            future.set_running_or_notify_cancel()
+            try:
+                future.set_result(fn(*args))
+            except Exception as err:
+                future.set_exception(err)
+            self.finished(callback, future, generation)
+
+    def finished(self, callback, future, generation):
+        # runs on a worker thread
+        with self.lock:
+            if generation != self.generation:
+                return  # finished after close()
+            self.results.append((callback, future))
+            if self.waker is not None:
+                self.waker.send(b'', zmq.NOBLOCK)
+
+    def dispatch(self):
+        """Call the callbacks of finished reads and writes, from the device's thread"""
+        try:
+            while True:
+                self.socket.recv(zmq.NOBLOCK)
+        except zmq.Again:
+            pass
+        count = 0
+        while self.results:
+            callback, future = self.results.popleft()
+            callback(future)
+            count += 1
+        return count
+
+    def get(self, param, callback):
+        """Call callback(value, error) with the parameter's value, from the cache or once it is read"""
+        if param.fresh():
+            param.hits += 1
+            callback(param.value, None)
+            return
+        if param.refresh_ahead and param.read_time is not None:
+            param.hits += 1
+            callback(param.value, None)
+        else:
+            param.waiters.append(callback)
+        if not param.reading:
+            param.reading = True
+            self.reading.add(param)
+            self.submit(param, param.getter, lambda future: self.got(param, future))
+
+    def got(self, param, future):
+        param.reading = False
+        self.reading.discard(param)
+        param.reads += 1
+        waiters, param.waiters = param.waiters, []
+        error = future.exception()
+        if error is None:
+            # jobs of a parameter finish in order, so this read is newer than any write before it
+            param.value = future.result()
+            param.read_time = time.time()
+            if self.on_value is not None:
+                self.on_value(param, param.value)
+            value = future.result()
+        else:
+            value = None
+        for callback in waiters:
+            callback(value, error)
+
+    def set(self, param, value, callback):
+        """Write value with the setter and call callback(error) once it is done"""
+        def wrote(future):
+            error = future.exception()
+            if error is None:
+                param.value = value
+                param.read_time = time.time()
+                if self.on_value is not None:
+                    self.on_value(param, value)
+            callback(error)
+        self.submit(param, param.setter, wrote, value)
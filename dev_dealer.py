@@ -1,5 +1,6 @@
 import zmq
 import logger
+import peers
 import os
 import time
 
@@ -26,21 +27,18 @@ class Message():
         return s
 
 class Device():
-    def __init__(self, name):
+    def __init__(self, name, pool_size=peers.POOL_SIZE):
         if name not in RT.keys():
             raise KeyError
         self.name = name
         self.ctx = zmq.Context.instance()
         self.make_rep_socket()  # make inbox
-        self.make_req_socket()  # make outbox
         self.poller = zmq.Poller()
+        # outbox: one DEALER per peer, connected on first use, least recently used closed beyond pool_size
+        self.outbox = peers.PeerPool(self.ctx, self.poller, pool_size)
         self.reqs = {}
         self._counter = 0
 
-    def make_req_socket(self):
-        self.outbox = self.ctx.socket(zmq.DEALER)
-        self.outbox.setsockopt(zmq.LINGER, 0)
-
     def make_rep_socket(self):
         self.inbox = self.ctx.socket(zmq.REP)
         self.inbox.setsockopt(zmq.LINGER, 0)
@@ -55,14 +53,7 @@ class Device():
             self.inbox.bind('{}'.format(RT[self.name]))
         except zmq.ZMQBaseError as err:
             raise err
-        for dev_name, addr in RT.items():
-            if dev_name != self.name:
-                try:
-                    self.outbox.connect(addr)
-                except zmq.ZMQBaseError as err:
-                    raise err
         self.poller.register(self.inbox, zmq.POLLIN)
-        self.poller.register(self.outbox, zmq.POLLIN)
         print('device connected')
 
     def disconnect(self):
@@ -70,14 +61,9 @@ class Device():
             self.poller.unregister(self.inbox)
         except KeyError:
             pass
-        try:
-            self.poller.unregister(self.outbox)
-        except KeyError:
-            pass
         self.inbox.close()
-        self.outbox.close()
-        self.inbox = make_req_socket(self.ctx)
-        self.outbox = make_rep_socket(self.ctx)
+        self.outbox.close_all()
+        self.make_rep_socket()
         print('device disconnected')
 
     def reset(self):
@@ -117,23 +103,26 @@ class Device():
                 self.handle_reply(msg[1:])
             else:
                 print('Received message not addressed to me: {}'.format(msg[1:]))
-        if self.outbox in sockets:
-            msg = self.outbox.recv_multipart()
-            print('Received a reply: {}'.format(msg))
-            msg_id = msg[1]
-            msg = msg[2:]
-            if msg_id in self.reqs:
-                print('Received a reply from a known request')
-                del self.reqs[msg_id]
-            else:
-                print('Received a message I do not remember sending.')
+        for sock in self.outbox.sockets():
+            if sock in sockets:
+                peer, msg = self.outbox.recv(sock)
+                print('Received a reply from {}: {}'.format(peer, msg))
+                msg_id = msg[1]
+                msg = msg[2:]
+                if msg_id in self.reqs:
+                    print('Received a reply from a known request')
+                    del self.reqs[msg_id]
+                else:
+                    print('Received a message I do not remember sending.')
         for msg_id, msg in self.reqs.items():
+            dest = msg.msg[1].decode('utf-8')
             if not msg.sent:
-                self.outbox.send_multipart(msg.msg)
+                self.outbox.send(dest, RT[dest], msg.msg)
                 msg.sent = True
                 msg.sent_time = time.time()
             elif time.time() - msg.sent_time > msg.timeout:
                 print('{} is old'.format(msg))
+                self.outbox.done(dest)
         self.reqs = dict((msg_id, msg) for msg_id, msg in self.reqs.items() if not msg.sent or time.time() - msg.sent_time < msg.timeout)
 
 if __name__ == '__main__':
@@ -1,4 +1,15 @@
 import names
+import endpoints
+import shm
+import stream
+import codec
+import peers
+import schema
+import computed
+import telemetry
+import history
+import metrics
+import profiler
 from MsgID import gen_id
 
 import zmq
@@ -7,12 +18,32 @@ import pickle
 import time
 import logger
 import os  # urandom function
-from collections import OrderedDict
+import zlib
+import lzma
+from collections import OrderedDict, deque
 
 states = ['closed', 'nobroker', 'joining', 'rejected', 'idle', 'leaving']
 
 ID_LEN = 4
 
+JOIN_TIMEOUT = 1  # seconds to wait for the broker to answer HI
+RECONNECT_MIN = 0.1  # first reconnect delay in seconds
+RECONNECT_MAX = 30  # upper bound on the reconnect delay in seconds
+RECONNECT_JITTER = 0.5  # fraction of each delay that is randomized
+CMD_MAX_AGE = 10  # unsent commands older than this (seconds) are dropped while reconnecting
+SESSION_DIRECTORY = '.'  # where devices keep their <name>.session file
+INBOX_BATCH = 100  # most messages handled per check_inbox()
+PEER_TTL = 60  # seconds a peer's direct endpoint, or its lack of one, is cached
+DIRECT_TIMEOUT = 0.5  # seconds without an ACK or reply before a direct request goes through the broker
+LATENCY_SAMPLES = 10000  # round trip times kept per priority class
+BROKER_COMMANDS = (b'SCHEMA', b'HERE', b'CHK', b'CRD', b'PRF')  # messages from the broker that are not mail
+MAIL_COMMANDS = (b'GET', b'SET', b'HIST', b'PROF', b'ACK', b'RET', b'MET', b'HST', b'PRF', b'ERR')  # requests and replies
+OTHER = b'other'  # messages_received key of commands a device does not know
+BROKER_FRAMES = {b'SCHEMA': 3, b'HERE': 3, b'CHK': 5, b'CRD': 4, b'PRF': 4}  # frames a broker message needs, the empty one included
+MAIL_FRAMES = {b'ERR': 4, b'RET': 5, b'HST': 5, b'PRF': 5, b'GET': 4, b'SET': 5, b'HIST': 4}  # frames of mail, 3 for the others
+
+NORMAL, URGENT = 'normal', 'urgent'  # priority classes, URGENT is also the route of requests from the urgent lane
+
 def make_socket(ctx, name):
     """A utility function that constructs the Dealer socket used by the device"""
     sock = ctx.socket(zmq.DEALER)
@@ -21,20 +52,52 @@ def make_socket(ctx, name):
     return sock
 
 
+def is_direct(route):
+    """True if a request with this route came from a direct peer rather than through the broker"""
+    return route is not None and route != URGENT
+
+
 class DeviceNotConnected(Exception):
     def __init__(self):
         Exception.__init__(self, "Target device is not connected to network.")
 
 
+class Backoff(object):
+    """Exponential backoff with jitter, so devices restarting together do not storm the broker"""
+    def __init__(self, base=RECONNECT_MIN, cap=RECONNECT_MAX, jitter=RECONNECT_JITTER):
+        self.base = base
+        self.cap = cap
+        self.jitter = jitter
+        self.attempts = 0
+
+    def __repr__(self):
+        return "Backoff(base={},cap={},jitter={},attempts={})".format(self.base, self.cap, self.jitter, self.attempts)
+
+    def next(self):
+        """Return the next delay in seconds and count the attempt"""
+        delay = min(self.cap, self.base * 2 ** min(self.attempts, 32))
+        self.attempts += 1
+        return delay * (1 - self.jitter * random.random())
+
+    def reset(self):
+        self.attempts = 0
+
+
 class Command(object):
     """A command for a device contains a zmq msg, a timeout in seconds, a boolean state indicating if msg is sent, and a POSIX time when the message is sent"""
-    def __init__(self, msg_id=None, msg=b"", timeout=1):
+    def __init__(self, msg_id=None, msg=b"", timeout=1, urgent=False):
         if msg_id is None:
             self.msg_id = gen_id()
         self.msg = msg
         self.timeout = timeout
         self.sent = False
         self.sent_time = -1
+        self.created = time.time()
+        self.direct = False  # sent straight to the peer instead of through the broker
+        self.replied = False
+        self.urgent = urgent  # sent ahead of normal commands, on the broker's urgent lane
+        self.replied_time = None  # POSIX time of the first reply that is not an ACK
+        self.superseded = False  # a newer SET of the same param replaced this one before it was sent
 
     def __repr__(self):
         s = "msg={},timeout={},sent={},sent_time={}".format(self.msg, self.timeout, self.sent, self.sent_time)
@@ -45,42 +108,106 @@ class Command(object):
 
 
 class CommandQueue(object):
-    """A simple object wrapping a queue dictionary with a custom filter function"""
-    def __init__(self):
+    """
+    A simple object wrapping a queue dictionary with a custom filter function
+    Urgent commands are kept in a dictionary of their own, so they come first
+    without sorting the queue. With coalesce, a SET replaces the unsent SET of
+    the same (device, param), so only the last value of e.g. a slider is sent.
+    With one_in_flight, a SET is held back until the previous SET of its param
+    was answered or timed out.
+    """
+    def __init__(self, coalesce=False, one_in_flight=False):
         self.queue = {}
+        self.urgent = {}  # msg_id -> urgent command, not in queue
+        self.coalesce = coalesce
+        self.one_in_flight = one_in_flight
+        self.superseded = 0  # SETs replaced before they were sent
 
     def __repr__(self):
-        return self.queue.__repr__()
+        return dict(self.items()).__repr__()
 
     def __str__(self):
         s = "\n"
         row_fmt = "{0:<32} {1:<5} {2:<20}\n"
         s += row_fmt.format('ID', 'Sent', 'Sent Time')
-        for msg_id, msg in self.queue.items():
+        for msg_id, msg in self.items():
             s += row_fmt.format(msg_id.hex(), msg.sent, msg.sent_time)
         return s[:-1]
 
+    def __len__(self):
+        return len(self.urgent) + len(self.queue)
+
+    def lane(self, cmd):
+        return self.urgent if cmd.urgent else self.queue
+
     def __getitem__(self, key):
-        return self.queue[key]
+        cmd = self.urgent.get(key)
+        return self.queue[key] if cmd is None else cmd
 
     def __setitem__(self, key, value):
-        self.queue[key] = value
+        self.lane(value)[key] = value
+
+    @staticmethod
+    def set_key(cmd):
+        """(device, param) of a SET, None for other commands"""
+        if len(cmd.msg) > 3 and cmd.msg[1] == b'SET':
+            return (cmd.msg[0], cmd.msg[2])
+        return None
+
+    def add(self, cmd):
+        """Queue a command, return the unsent SETs of its lane it superseded"""
+        lane = self.lane(cmd)
+        superseded = []
+        key = self.set_key(cmd) if self.coalesce else None
+        if key is not None:
+            superseded = [old for old in lane.values() if not old.sent and self.set_key(old) == key]
+            for old in superseded:
+                old.superseded = True
+                del lane[old.msg_id]
+            self.superseded += len(superseded)
+        lane[cmd.msg_id] = cmd
+        return superseded
+
+    def blocked(self, cmd):
+        """True if cmd is a SET that waits for the answer to a SET of the same param on its lane"""
+        if not self.one_in_flight:
+            return False
+        key = self.set_key(cmd)
+        return key is not None and any(old.sent and self.set_key(old) == key for old in self.lane(cmd).values())
 
     def __contains__(self, key):
-        return self.queue.__contains__(key)
+        return key in self.urgent or key in self.queue
 
-    def pop(self, key):
-        return self.queue.pop(key)
+    def pop(self, key, default=None):
+        cmd = self.urgent.pop(key, None)
+        return self.queue.pop(key, default) if cmd is None else cmd
 
     def clear(self):
+        self.urgent.clear()
         self.queue.clear()
 
     def items(self):
-        return self.queue.items()
+        """(msg_id, command) pairs, urgent ones first"""
+        return list(self.urgent.items()) + list(self.queue.items())
+
+    def values(self):
+        return list(self.urgent.values()) + list(self.queue.values())
 
     def filter_expired(self):
-        """Filter the queue by removing expired commands, log the expired entries"""
-        self.queue = dict((msg_id, cmd) for msg_id, cmd in self.queue.items() if time.time() - cmd.sent_time < cmd.timeout)
+        """Filter the queue by removing expired commands, return them"""
+        now = time.time()
+        expired = [cmd for cmd in self.values() if cmd.sent and now - cmd.sent_time >= cmd.timeout]
+        self.urgent = dict((msg_id, cmd) for msg_id, cmd in self.urgent.items() if not cmd.sent or now - cmd.sent_time < cmd.timeout)
+        self.queue = dict((msg_id, cmd) for msg_id, cmd in self.queue.items() if not cmd.sent or now - cmd.sent_time < cmd.timeout)
+        return expired
+
+    def filter_stale(self, max_age):
+        """Remove unsent commands queued more than max_age seconds ago, return how many were dropped"""
+        now = time.time()
+        n = len(self)
+        self.urgent = dict((msg_id, cmd) for msg_id, cmd in self.urgent.items() if cmd.sent or now - cmd.created < max_age)
+        self.queue = dict((msg_id, cmd) for msg_id, cmd in self.queue.items() if cmd.sent or now - cmd.created < max_age)
+        return n - len(self)
 
 
 class Device():
@@ -94,14 +221,81 @@ class Device():
         self.poller = zmq.Poller()
         self.cmd_queue = CommandQueue()
         self.state = 'closed'
+        self.backoff = Backoff()
+        self.join_timeout = JOIN_TIMEOUT
+        self.cmd_max_age = CMD_MAX_AGE
+        self.retry_time = 0  # POSIX time of the next HI attempt
+        self.join_deadline = 0  # POSIX time at which an unanswered HI times out
+        self.reconnects = 0  # number of join attempts that timed out
+        self.downtime = 0  # total seconds spent without a broker
+        self.down_since = None
+        self.session_file = os.path.join(SESSION_DIRECTORY, name + '.session')  # survives a crash so a restart can resume
+        self.session = self.load_session()
+        self.service = None  # set to join the broker as a replica of a shared service name
+        self.endpoints = names.BROKER_ENDPOINTS  # broker endpoints to pick from
+        self.endpoint = None  # the one in use, picked at connect()
+        self.failed_endpoints = set()  # ipc/inproc endpoints whose HI went unanswered
+        # urgent commands, and the replies to them, skip the bulk traffic queued on the mailbox
+        self.urgent_endpoints = names.BROKER_URGENT_ENDPOINTS
+        self.urgent = None  # DEALER on the broker's urgent lane, opened at connect()
+        self.latencies = {NORMAL: deque(maxlen=LATENCY_SAMPLES), URGENT: deque(maxlen=LATENCY_SAMPLES)}
+        # large values travel through shared memory when the broker is on this host
+        self.payloads = None
+        self.reap_time = 0
+        # otherwise they are streamed in chunks, so they do not hold up other messages
+        self.streams = stream.Streams()
+        self.codecs = codec.Codecs()  # decompresses what peers send, and counts the cost
+        self.compress = None  # set to a codec name, e.g. 'zlib', to compress large values
+        self.broker_codecs = []  # codecs the broker listed in its OK
+        # peer-to-peer: requests to peers with a direct endpoint bypass the broker
+        self.direct = None  # set to an endpoint, e.g. 'tcp://*:5601', to accept requests from peers
+        self.direct_endpoint = None  # the endpoint announced at HI, with the port really bound
+        self.inbox = None  # ROUTER bound to self.direct
+        self.peers = {}  # peer name -> [direct endpoint or None, POSIX time the entry expires]
+        self.pool = peers.PeerPool(self.ctx, self.poller)  # DEALERs connected to direct endpoints
+        # parameters are published at HI; peers whose schema is known are sent IDs instead of names
+        self.access = {}  # param name -> schema.READ, WRITE or READ_WRITE (default)
+        self.schema = schema.Schema.from_params(self.params, self.access)
+        self.schemas = {}  # peer name -> [Schema or None, POSIX time the entry expires]
+        # params given as computed.Computed are read and written on worker threads
+        self.computer = computed.Computer(self.ctx)
+        self.computer.on_value = self.computed_changed
+        # params given to keep_history() record every change, HIST queries them
+        self.histories = {}  # param name -> history.History
+        self.fetched = {}  # (peer name, param name) -> rows of the last HST reply from it
+        # params declared with publish() are sampled and published to subscribers, see telemetry.py
+        self.telemetry = telemetry.Publisher(name)
+        self.telemetry_endpoints = names.TELEMETRY_IN_ENDPOINTS
+        # counters exported with metrics.REGISTRY, set metrics_port to serve it
+        self.metrics_port = None
+        self.metrics_server = None  # the server of metrics_port while started
+        self.messages_received = {}  # command -> messages received
+        self.commands_sent = {}  # command -> commands sent
+        self.register_metrics(metrics.REGISTRY)
+        # PROF profiles the device's loop for a while, see profiler.py
+        self.profile_dir = profiler.DIRECTORY
+        self.profiling = None  # (profiler.Profile, msg_id, route) of the window in progress
+        self.profiles = {}  # peer name, or b'BROKER', -> (path, summary) of the last profile it sent
 
     def connect(self):
+        self.endpoint = endpoints.pick(self.endpoints, self.failed_endpoints)
         try:
-            self.mailbox.connect(names.BROKER_IN)
+            self.mailbox.connect(self.endpoint)
         except zmq.ZMQBaseError as err:
             raise err
         self.poller.register(self.mailbox, zmq.POLLIN)
-        self.logger.debug('device connected')
+        # same transport as the mailbox, the broker binds its lanes alike
+        same = [x for x in self.urgent_endpoints if endpoints.transport(x) == endpoints.transport(self.endpoint)]
+        self.urgent = make_socket(self.ctx, self.name)
+        self.urgent.connect(same[0] if same else endpoints.pick(self.urgent_endpoints))
+        self.poller.register(self.urgent, zmq.POLLIN)
+        if endpoints.is_local(self.endpoint):
+            if self.payloads is None:
+                self.payloads = shm.SharedPayloads()
+        elif self.payloads is not None:
+            self.payloads.close()
+            self.payloads = None
+        self.logger.debug('device connected to {}'.format(self.endpoint))
         self.logger.debug(self.cmd_queue)
 
     def disconnect(self):
@@ -111,12 +305,46 @@ class Device():
             pass
         self.mailbox.close()
         self.mailbox = make_socket(self.ctx, self.name)  # pre-emptive in case user wants to connect again
+        if self.urgent is not None:
+            self.poller.unregister(self.urgent)
+            self.urgent.close()
+            self.urgent = None
         self.logger.debug('device disconnected')
 
     def reset_connection(self):
         self.disconnect()
         self.connect()
 
+    def open_inbox(self):
+        """Bind the direct endpoint, if any, so peers can skip the broker"""
+        if self.direct is None:
+            return
+        self.inbox = self.ctx.socket(zmq.ROUTER)
+        self.inbox.setsockopt(zmq.LINGER, 0)
+        self.inbox.bind(self.direct)
+        endpoint = self.inbox.getsockopt_string(zmq.LAST_ENDPOINT)
+        self.direct_endpoint = endpoint.replace('0.0.0.0', shm.HOSTNAME)
+        self.poller.register(self.inbox, zmq.POLLIN)
+        self.logger.debug('accepting direct requests at {}'.format(self.direct_endpoint))
+
+    def close_peers(self):
+        self.pool.close_all()
+        self.peers.clear()
+        if self.inbox is not None:
+            self.poller.unregister(self.inbox)
+            self.inbox.close()
+            self.inbox = None
+
+    def lookup(self, name):
+        """Direct endpoint of a peer from the cache, asking the broker (WHERE) when it is not known"""
+        entry = self.peers.get(name)
+        if entry is None or time.time() >= entry[1]:
+            # until HERE arrives the peer counts as having no direct endpoint
+            self.peers[name] = [None, time.time() + PEER_TTL]
+            self.mailbox.send_multipart([b'', b'WHERE', name])
+            return None
+        return entry[0]
+
     def start(self, **kwargs):
         """
         Execute this to go from closed to nobroker state
@@ -124,9 +352,20 @@ class Device():
         """
         if self.state == 'closed':
             try:
+                self.pool.poller = self.poller  # a DeviceHost may have swapped the poller
                 self.connect()
+                self.open_inbox()
+                self.computer.open(self.poller)
+                if self.telemetry.topics:
+                    self.telemetry.open(self.ctx, endpoints.pick(self.telemetry_endpoints), self.poller)
+                self.register_metrics(metrics.REGISTRY)  # again, if an earlier close dropped them
+                if self.metrics_port is not None:
+                    self.serve_metrics()
                 self.state = 'nobroker'
-                self.cmd_queue.clear()
+                self.down_since = time.time()
+                # spread the first HI of devices started together over one backoff step
+                self.retry_time = self.down_since + random.uniform(0, self.backoff.base)
+                self.drop_stale()
             except zmq.ZMQBaseError as err:
                 self.logger.critical('Failed to connect to socket. Error {}'.format(err))
                 raise err
@@ -146,125 +385,664 @@ class Device():
         return 0
 
 
+    def load_session(self):
+        """Read the session token left by a previous run of this device, if any"""
+        try:
+            with open(self.session_file, 'rb') as f:
+                return f.read() or None
+        except OSError:
+            return None
+
+    def save_session(self, token):
+        self.session = token
+        try:
+            if token is None:
+                os.remove(self.session_file)
+            else:
+                with open(self.session_file, 'wb') as f:
+                    f.write(token)
+        except OSError as err:
+            self.logger.warning('could not update session file {}: {}'.format(self.session_file, err))
+
+    def hello(self):
+        """Option frames sent with HI, in key, value pairs"""
+        opts = [b'HOST', shm.HOSTNAME.encode('utf-8')]
+        if self.session is not None:
+            opts += [b'SESSION', self.session]
+        if self.service is not None:
+            opts += [b'SERVICE', str(self.service).encode('utf-8')]
+        if self.direct_endpoint is not None:
+            opts += [b'DIRECT', self.direct_endpoint.encode('utf-8')]
+        self.schema = schema.Schema.from_params(self.params, self.access)
+        opts += [b'SCHEMA', self.schema.frame]
+        opts += [b'CODECS', codec.encode_names(codec.available())]
+        return opts
+
+    def pick_codec(self, frame):
+        """Codec to compress a value frame with, or None"""
+        name = self.compress
+        if name is None or not self.broker_codecs:
+            return None  # a broker that lists no codecs cannot decompress for other peers
+        if name not in self.broker_codecs or name not in codec.CODECS:
+            name = 'zlib'
+        if len(frame) >= self.streams.threshold and name not in codec.PORTABLE:
+            name = 'zlib'  # the broker cannot decompress a stream for peers without the codec
+        return name
+
+    def pack_value(self, frame, direct=False):
+        """
+        Frame to send for a value, compressed if asked to, a shared memory handle or a stream header if it is large
+        A direct peer gets the bytes in one frame, compressed with a codec every peer has.
+        """
+        name = self.pick_codec(frame)
+        if direct:
+            if name is not None and name not in codec.PORTABLE:
+                name = 'zlib'
+            return frame if name is None else self.codecs.pack(frame, name)
+        if name is not None:
+            frame = self.codecs.pack(frame, name)
+        if self.payloads is None:
+            return self.streams.pack(frame)
+        return self.payloads.pack(frame)
+
+    def unpack_value(self, frame):
+        if shm.is_handle(frame):
+            frame = shm.read(frame)
+        return self.codecs.unpack(frame)
+
+    def receive_value(self, frame, callback, failed):
+        """
+        Call callback with the bytes of a value frame, once its stream is complete if it was streamed,
+        or failed(error) if they cannot be read or decompressed, e.g. from a shared memory segment reaped at shm.SHM_TTL
+        """
+        def unpack(data):
+            try:
+                value = self.unpack_value(data)
+            except (OSError, ValueError, zlib.error, lzma.LZMAError) as err:
+                failed(err)
+                return
+            callback(value)
+        if stream.is_header(frame):
+            self.streams.expect(frame, unpack)
+        else:
+            unpack(frame)
+
+    def value_lost(self, msg_id, error):
+        """The value of a reply could not be read, the request is answered as failed"""
+        cmd = self.cmd_queue.pop(msg_id, None)
+        if cmd is not None:
+            self.logger.warning('could not read the {} of {} from {}: {}'.format(cmd.msg[1].decode('utf-8'), cmd.msg[2].decode('utf-8'), cmd.get_dest(), error))
+
+    def got_value(self, msg_id, param, value):
+        if msg_id not in self.cmd_queue:
+            self.logger.warning('got {} after its request timed out'.format(param))
+            return
+        self.logger.info('got {} = {} from {}'.format(self.cmd_queue[msg_id].msg[2].decode('utf-8'), pickle.loads(value), self.cmd_queue[msg_id].get_dest()))
+        self.cmd_queue.pop(msg_id)
+
+    def get_value(self, msg_id, name, param, route=None):
+        """Reply RET with a parameter's value, once it is read if it is computed"""
+        target = self.params[name]
+        if isinstance(target, computed.Computed):
+            self.computer.get(target, lambda value, error: self.ret_value(msg_id, name, param, value, route, error))
+        else:
+            self.ret_value(msg_id, name, param, target, route)
+
+    def ret_value(self, msg_id, name, param, value, route=None, error=None):
+        if error is not None:
+            self.logger.warning('reading {} failed: {}'.format(name, error))
+            self.reply([b'', msg_id, b'ERR', 'reading {} failed: {}'.format(name, error).encode('utf-8')], route)
+            return
+        self.reply([b"", msg_id, b'RET', param, self.pack_value(pickle.dumps(value), is_direct(route))], route)
+
+    def set_value(self, msg_id, name, param, value, echo=True, route=None):
+        """Apply a SET and reply MET, echoing the value unless it came in a stream; computed ones once they are written"""
+        target = self.params[name]
+        if isinstance(target, computed.Computed):
+            self.computer.set(target, pickle.loads(value), lambda error: self.met_value(msg_id, name, param, value, echo, route, error))
+        else:
+            self.update(name, pickle.loads(value))
+            self.met_value(msg_id, name, param, value, echo, route)
+
+    def met_value(self, msg_id, name, param, value, echo=True, route=None, error=None):
+        if error is not None:
+            self.logger.warning('writing {} failed: {}'.format(name, error))
+            self.reply([b'', msg_id, b'ERR', 'writing {} failed: {}'.format(name, error).encode('utf-8')], route)
+            return
+        reply = [b'', msg_id, b'MET', param]
+        if echo:
+            reply.append(self.pack_value(value, is_direct(route)))
+        self.reply(reply, route)
+
+    def param_index(self, frame):
+        """ID of a parameter frame, None if it does not resolve; a name added to params since HI extends the schema"""
+        i = self.schema.index(frame)
+        if i is None and not schema.is_id(frame):
+            name = frame.decode('utf-8', 'replace')
+            if name in self.params:
+                self.schema = self.schema.extended(schema.Schema.from_params({name: self.params[name]}, self.access).entries)
+                self.logger.info('added {} to the schema'.format(name))
+                i = self.schema.index(frame)
+        return i
+
+    def param_error(self, frame):
+        """ERR text for a parameter frame that does not resolve"""
+        if schema.is_id(frame):
+            return b'Unknown parameter ID'
+        return '{} is not param'.format(frame.decode('utf-8')).encode('utf-8')
+
+    def reply(self, msg, route=None, copy=True):
+        """Answer a request from the broker, or from a direct peer if route is its identity frames"""
+        if msg[2] == b'ERR':
+            self.errors_sent.inc()
+        if route is None:
+            self.logger.info('reply to broker with {}'.format(msg))
+            self.mailbox.send_multipart(msg, copy=copy)
+        elif route == URGENT:
+            self.logger.info('reply to broker on the urgent lane with {}'.format(msg))
+            self.urgent.send_multipart(msg, copy=copy)
+        else:
+            self.logger.info('reply to peer {} with {}'.format(route[0], msg))
+            self.inbox.send_multipart(route + msg, copy=copy)
+
+    def update(self, name, value):
+        """Change a stored param from the device's own code, recording it in its history"""
+        self.params[name] = value
+        self.record(name, value)
+
+    def keep_history(self, name, capacity=history.CAPACITY, dtype='f8'):
+        """Record the last capacity changes of param name, whose values must fit the NumPy dtype"""
+        if name not in self.params:
+            raise KeyError('{} is not param'.format(name))
+        self.histories[name] = history.History(capacity, dtype)
+        self.logger.info('keeping {} of history for {} ({} bytes)'.format(capacity, name, self.histories[name].nbytes))
+        if not isinstance(self.params[name], computed.Computed):
+            self.record(name, self.params[name])
+
+    def record(self, name, value):
+        rows = self.histories.get(name)
+        if rows is None:
+            return
+        try:
+            rows.record(value, time.time())
+        except (TypeError, ValueError) as err:
+            self.logger.warning('could not record {} = {} in its history: {}'.format(name, value, err))
+
+    def computed_changed(self, param, value):
+        for name in self.histories:
+            if self.params[name] is param:
+                self.record(name, value)
+
+    def send_history(self, msg_id, name, param, options, route=None):
+        """Reply HST with the rows of a param's history that the HIST options select"""
+        try:
+            rows = self.histories[name].query(**history.parse_options(options))
+        except ValueError as err:
+            self.reply([b'', msg_id, b'ERR', str(err).encode('utf-8')], route)
+            return
+        dtype, data = self.histories[name].encode(rows)
+        self.reply([b'', msg_id, b'HST', param, dtype, self.pack_value(data, is_direct(route))], route, copy=False)
+
+    def got_history(self, msg_id, dtype, data):
+        if msg_id not in self.cmd_queue:
+            self.logger.warning('got a history after its request timed out')
+            return
+        try:
+            rows = history.decode(dtype, data)
+        except (ImportError, ValueError, TypeError) as err:
+            # no numpy, or a dtype or rows frame that is not an array: the request failed
+            self.value_lost(msg_id, err)
+            return
+        cmd = self.cmd_queue.pop(msg_id)
+        self.fetched[(cmd.get_dest(), cmd.msg[2].decode('utf-8'))] = rows
+        self.logger.info('got {} rows of history of {} from {}'.format(len(rows), cmd.msg[2].decode('utf-8'), cmd.get_dest()))
+
+    def publish(self, name, rate):
+        """Publish param name rate times a second while someone subscribes to it, 0 to stop"""
+        if name not in self.params:
+            raise KeyError('{} is not param'.format(name))
+        self.telemetry.declare(name, rate)
+        if self.telemetry.sock is None and self.state != 'closed':
+            self.telemetry.open(self.ctx, endpoints.pick(self.telemetry_endpoints), self.poller)
+
+    def sample(self):
+        """Publish the declared params that are due, computed ones once they are read"""
+        for name in self.telemetry.due(time.time()):
+            target = self.params[name]
+            if isinstance(target, computed.Computed):
+                self.computer.get(target, lambda value, error, name=name: error is None and self.telemetry.publish(name, value))
+            else:
+                self.telemetry.publish(name, target)
+
+    def poll_timeout(self, timeout=20):
+        """Milliseconds a poll may wait, less than timeout if a telemetry sample is due sooner"""
+        next_due = self.telemetry.next_due()
+        if next_due is None:
+            return timeout
+        return max(0, min(timeout, (next_due - time.time()) * 1000))
+
+    def record_latency(self, msg_id):
+        """Round trip time of a command's first reply, ACKs aside, in its priority class"""
+        if msg_id not in self.cmd_queue:
+            return
+        cmd = self.cmd_queue[msg_id]
+        if cmd.sent and cmd.sent_time > 0 and not cmd.replied_time:
+            cmd.replied_time = time.time()
+            self.latencies[URGENT if cmd.urgent else NORMAL].append(cmd.replied_time - cmd.sent_time)
+
+    def latency(self, p=99, priority=NORMAL):
+        """p-th percentile of the round trip times in seconds of a priority class, None without samples"""
+        times = sorted(self.latencies[priority])
+        if not times:
+            return None
+        return times[min(len(times) - 1, int(p / 100 * len(times)))]
+
+    def register_metrics(self, registry):
+        """Export the device's counters to registry, labelled with its name"""
+        name = self.name
+        self.loop_time = registry.summary('labzmq_device_loop_seconds', 'Time spent handling messages and commands per poll', device=name)
+        self.errors_sent = registry.counter('labzmq_device_errors_sent_total', 'ERR replies sent to requesters', device=name)
+        registry.gauge('labzmq_device_connected', 'Whether the device joined the broker', lambda: self.state == 'idle', device=name)
+        registry.gauge('labzmq_device_queue_depth', 'Commands queued, sent or not', lambda: len(self.cmd_queue), device=name)
+        registry.gauge('labzmq_device_unsent', 'Commands queued and not sent yet',
+                       lambda: sum(1 for cmd in self.cmd_queue.values() if not cmd.sent), device=name)
+        registry.collect('labzmq_device_reconnects_total', metrics.COUNTER, 'Join attempts that timed out',
+                         lambda: [({}, self.reconnects)], device=name)
+        registry.collect('labzmq_device_downtime_seconds_total', metrics.COUNTER, 'Time spent without a broker, until the last join',
+                         lambda: [({}, self.downtime)], device=name)
+        registry.collect('labzmq_device_superseded_total', metrics.COUNTER, 'Unsent SETs replaced by a newer one',
+                         lambda: [({}, self.cmd_queue.superseded)], device=name)
+        registry.collect('labzmq_device_received_total', metrics.COUNTER, 'Messages received by command',
+                         lambda: [({'command': cmd}, n) for cmd, n in list(self.messages_received.items())], device=name)
+        registry.collect('labzmq_device_sent_total', metrics.COUNTER, 'Commands sent by command',
+                         lambda: [({'command': cmd}, n) for cmd, n in list(self.commands_sent.items())], device=name)
+        registry.collect('labzmq_device_latency_seconds', metrics.GAUGE, 'Round trip time percentiles of commands',
+                         lambda: [({'priority': priority, 'quantile': p / 100}, self.latency(p, priority))
+                                  for priority in (NORMAL, URGENT) for p in (50, 99) if self.latencies[priority]], device=name)
+
+    def serve_metrics(self):
+        """Serve metrics.REGISTRY, shared with the other devices and the broker of this process, on metrics_port"""
+        try:
+            self.metrics_server = metrics.serve(self.metrics_port)
+            self.logger.info('serving metrics on http://127.0.0.1:{}/metrics'.format(self.metrics_server.server_address[1]))
+        except OSError as err:
+            self.logger.warning('not serving metrics, could not bind port {}: {}'.format(self.metrics_port, err))
+
+    def profile(self, name=None, seconds=profiler.SECONDS, mode=profiler.CPROFILE):
+        """Ask a peer, or the broker if name is None, to profile itself; the summary lands in self.profiles"""
+        opts = profiler.options(seconds, mode)
+        if name is None:
+            self.mailbox.send_multipart([b'', b'PROF'] + opts)
+        else:
+            if isinstance(name, str):
+                name = name.encode('utf-8')
+            self.send([name, b'PROF'] + opts, timeout=seconds + 5)
+
+    def got_profile(self, name, path, summary):
+        self.profiles[name] = (path.decode('utf-8'), summary.decode('utf-8'))
+        self.logger.info('profile of {} written to {}\n{}'.format(name, *self.profiles[name]))
+
+    def start_profile(self, msg_id, options, route=None):
+        """Profile this device's loop, PROF replies once the window is over"""
+        try:
+            seconds, mode = profiler.parse_options(options)
+        except ValueError as err:
+            self.reply([b'', msg_id, b'ERR', str(err).encode('utf-8')], route)
+            return
+        if self.profiling is not None:
+            self.reply([b'', msg_id, b'ERR', b'Already profiling'], route)
+            return
+        self.profiling = (profiler.Profile(self.name, seconds, mode, self.profile_dir), msg_id, route)
+        self.logger.info('profiling for {} s'.format(seconds))
+
+    def finish_profile(self, reply=True):
+        profile, msg_id, route = self.profiling
+        self.profiling = None
+        summary = profile.finish()
+        self.logger.info('profile written to {}\n{}'.format(profile.path, summary))
+        if reply:
+            self.reply([b'', msg_id, b'PRF', profile.path.encode('utf-8'), summary.encode('utf-8')], route)
+
+    def drop_stale(self):
+        """Drop queued commands that are too old to be worth sending after a reconnect"""
+        dropped = self.cmd_queue.filter_stale(self.cmd_max_age)
+        if dropped > 0:
+            self.logger.warning('dropped {} unsent commands older than {} s'.format(dropped, self.cmd_max_age))
+
     def broker_alive(self):
         """Convenience function for checking if broker is alive or not"""
         return self.state == 'idle' or self.state == 'rejected' or self.state == 'leaving'
 
-    def check_inbox(self):
-        """Poll for messages, parse incoming messages from broker"""
-        sockets = dict(self.poller.poll(20))
+    def check_inbox(self, sockets=None):
+        """Poll for messages unless the poll result is given, parse incoming messages from broker and peers"""
+        if sockets is None:
+            sockets = dict(self.poller.poll(self.poll_timeout()))
+        if self.urgent is not None and self.urgent in sockets:
+            for i in range(INBOX_BATCH):
+                try:
+                    msg = self.urgent.recv_multipart(zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                self.handle_message(msg, route=URGENT)
         if self.mailbox in sockets:
-            msg = self.mailbox.recv_multipart()
-            self.logger.debug('recv from broker: {}'.format(msg))
-            msg_id = msg[1]
-            cmd = msg[2]
-            msg = msg[2:]  # msg now starts with CMD
-            if cmd == b'ERR':
-                error_msg = msg[1].decode('utf-8')
-                if error_msg == "Device not connected":
-                    if msg_id in self.cmd_queue:
-                        self.logger.warning('{} not connected'.format(self.cmd_queue[msg_id]))
-                    else:
-                        self.logger.debug('Broker said a device was not connected, but no msg_id in queue')
+            for i in range(INBOX_BATCH):
+                try:
+                    msg = self.mailbox.recv_multipart(zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                self.handle_message(msg)
+        for sock in self.pool.sockets():
+            if sock in sockets:
+                for i in range(INBOX_BATCH):
+                    try:
+                        name, msg = self.pool.recv(sock)
+                    except zmq.Again:
+                        break
+                    self.handle_message(msg)
+        if self.inbox is not None and self.inbox in sockets:
+            for i in range(INBOX_BATCH):
+                try:
+                    msg = self.inbox.recv_multipart(zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                self.handle_message(msg[1:], route=msg[:1])
+        if self.computer.socket is not None and self.computer.socket in sockets:
+            self.computer.dispatch()
+        if self.telemetry.sock is not None and self.telemetry.sock in sockets:
+            self.telemetry.on_subscription()
+
+    @staticmethod
+    def well_formed(msg):
+        """True if msg has the frames its command needs"""
+        if len(msg) < 3:
+            return False
+        if msg[1] in BROKER_COMMANDS:
+            return len(msg) >= BROKER_FRAMES[msg[1]]
+        return len(msg) >= MAIL_FRAMES.get(msg[2], 3)
+
+    def handle_message(self, msg, route=None):
+        """Parse one message from the broker, or from a direct peer if route is its identity frames"""
+        self.logger.debug('recv from {}: {}'.format(route[0] if is_direct(route) else 'broker', msg[:4]))
+        if not self.well_formed(msg):
+            self.logger.warning('dropped a malformed message from {}: {}'.format(route[0] if is_direct(route) else 'broker', msg[:6]))
+            return
+        cmd = msg[1] if msg[1] in BROKER_COMMANDS else msg[2]
+        if cmd not in BROKER_COMMANDS and cmd not in MAIL_COMMANDS:
+            cmd = OTHER  # the frame comes from a peer, the metric labels stay a fixed set
+        self.messages_received[cmd] = self.messages_received.get(cmd, 0) + 1
+        if msg[1] == b'SCHEMA':
+            self.schemas[msg[2]] = [schema.Schema.decode(msg[3]) if len(msg) > 3 else None, time.time() + PEER_TTL]
+            self.logger.debug('schema of {} is {}'.format(msg[2], self.schemas[msg[2]][0]))
+            return
+        elif msg[1] == b'HERE':
+            endpoint = msg[3].decode('utf-8') if len(msg) > 3 else None
+            self.peers[msg[2]] = [endpoint, time.time() + PEER_TTL]
+            self.logger.debug('direct endpoint of {} is {}'.format(msg[2], endpoint))
+            return
+        elif msg[1] == b'CHK':
+            for out_msg in self.streams.on_chunk(msg[2], msg[3], msg[4]):
+                self.mailbox.send_multipart(out_msg)
+            return
+        elif msg[1] == b'CRD':
+            self.streams.on_credit(msg[2], msg[3], msg[4:])
+            return
+        elif msg[1] == b'PRF':
+            self.got_profile(b'BROKER', msg[2], msg[3])
+            return
+        msg_id = msg[1]
+        cmd = msg[2]
+        msg = msg[2:]  # msg now starts with CMD
+        if cmd == b'ERR':
+            error_msg = msg[1].decode('utf-8')
+            if error_msg == "Device not connected":
+                if msg_id in self.cmd_queue:
+                    self.logger.warning('{} not connected'.format(self.cmd_queue[msg_id]))
                 else:
-                    self.logger.warning('Error: {}'.format(error_msg))
-                self.cmd_queue.pop(msg_id)
+                    self.logger.debug('Broker said a device was not connected, but no msg_id in queue')
+            elif error_msg == 'Unknown parameter ID' and msg_id in self.cmd_queue:
+                # the peer restarted with another schema: forget ours and send the request again by name
+                cmd = self.cmd_queue[msg_id]
+                self.logger.info('{} does not know the parameter ID, retrying {} by name'.format(cmd.get_dest(), cmd))
+                self.schemas.pop(cmd.msg[0], None)
+                cmd.direct = False
+                self.send_command(cmd)
                 return
-            if msg_id in self.cmd_queue:
-                if cmd == b"ACK":
-                    self.logger.info('broker acknowledged receipt of message')
-                elif cmd == b"RET":
-                    param = msg[1].decode('utf-8')
-                    value = pickle.loads(msg[2])
-                    self.logger.info('got {} = {} from {}'.format(param, value, self.cmd_queue[msg_id].get_dest()))
-                    self.cmd_queue.pop(msg_id)
-                elif cmd == b'MET':
-                    self.logger.info('{} successfully set {}'.format(self.cmd_queue[msg_id].get_dest(), self.cmd_queue[msg_id].msg[1].decode('utf-8')))
-                else:
-                    self.logger.warning('did not understand message {}, discarding...'.format(msg))
             else:
-                if cmd == b"GET":
-                    param = msg[1].decode('utf-8')
-                    if param in self.params:
-                        reply = [b"", msg_id, b'RET', msg[1], pickle.dumps(self.params[param])]
-                    else:
-                        reply = [b'', msg_id, b'ERR', '{} is not param'.format(param).encode('utf-8')]
-                    self.logger.info('reply to broker with {}'.format(reply))
-                    self.mailbox.send_multipart(reply)
-                elif cmd == b'SET':
-                    param = msg[1].decode('utf-8')
-                    if param in self.params:
-                        self.params[param] = pickle.loads(msg[2])
-                        reply = [b'', msg_id, b'MET', msg[1], msg[2]]
-                    else:
-                        reply = [b'', msg_id, b'ERR', '{} is not param'.format(param).encode('utf-8')]
-                    self.logger.info('reply to broker with {}'.format(reply))
-                    self.mailbox.send_multipart(reply)
+                self.logger.warning('Error: {}'.format(error_msg))
+                self.record_latency(msg_id)
+            self.cmd_queue.pop(msg_id, None)  # e.g. an ERR for a request that already timed out
+            return
+        if msg_id in self.cmd_queue:
+            self.cmd_queue[msg_id].replied = True
+            if cmd != b'ACK':
+                self.record_latency(msg_id)
+            if cmd == b"ACK":
+                # from the broker, or from a direct peer, which then has the request and will answer it
+                self.logger.info('receipt of message acknowledged')
+            elif cmd == b"RET":
+                param = msg[1]
+                self.receive_value(msg[2], lambda value: self.got_value(msg_id, param, value),
+                                   lambda error: self.value_lost(msg_id, error))
+            elif cmd == b'HST':
+                dtype = msg[2]
+                self.receive_value(msg[3], lambda data: self.got_history(msg_id, dtype, data),
+                                   lambda error: self.value_lost(msg_id, error))
+            elif cmd == b'PRF':
+                self.got_profile(self.cmd_queue[msg_id].msg[0], msg[1], msg[2])
+                self.cmd_queue.pop(msg_id)
+            elif cmd == b'MET':
+                if len(msg) > 2 and shm.is_handle(msg[2]):
+                    shm.release(msg[2])  # the echoed value is not needed
+                self.logger.info('{} successfully set {}'.format(self.cmd_queue[msg_id].get_dest(), self.cmd_queue[msg_id].msg[2].decode('utf-8')))
+                self.cmd_queue.pop(msg_id)  # answered, which lets the next SET of the param go with one_in_flight
+            else:
+                self.logger.warning('did not understand message {}, discarding...'.format(msg))
+        else:
+            if is_direct(route) and cmd in (b'GET', b'SET', b'HIST', b'PROF'):
+                # like the broker's ACK, tells the requester not to fall back to the broker and run it twice
+                self.reply([b'', msg_id, b'ACK'], route)
+            if cmd == b"GET":
+                i = self.param_index(msg[1])
+                if i is None:
+                    self.reply([b'', msg_id, b'ERR', self.param_error(msg[1])], route)
+                elif self.schema.entries[i][2] == schema.WRITE:
+                    self.reply([b'', msg_id, b'ERR', '{} is write-only'.format(self.schema.names[i]).encode('utf-8')], route)
+                else:
+                    self.get_value(msg_id, self.schema.names[i], msg[1], route)
+            elif cmd == b'SET':
+                i = self.param_index(msg[1])
+                if i is None:
+                    self.reply([b'', msg_id, b'ERR', self.param_error(msg[1])], route)
+                elif self.schema.entries[i][2] == schema.READ:
+                    self.reply([b'', msg_id, b'ERR', '{} is read-only'.format(self.schema.names[i]).encode('utf-8')], route)
                 else:
-                    self.logger.warning('did not understand: {}. Discarding...'.format(msg))
+                    name, frame = self.schema.names[i], msg[1]
+                    echo = not stream.is_header(msg[2])
+                    self.receive_value(msg[2], lambda value: self.set_value(msg_id, name, frame, value, echo, route),
+                                       lambda error: self.reply([b'', msg_id, b'ERR', 'Could not read the value: {}'.format(error).encode('utf-8')], route))
+            elif cmd == b'HIST':
+                i = self.param_index(msg[1])
+                if i is None:
+                    self.reply([b'', msg_id, b'ERR', self.param_error(msg[1])], route)
+                elif self.schema.names[i] not in self.histories:
+                    self.reply([b'', msg_id, b'ERR', '{} has no history'.format(self.schema.names[i]).encode('utf-8')], route)
+                else:
+                    self.send_history(msg_id, self.schema.names[i], msg[1], msg[2:], route)
+            elif cmd == b'PROF':
+                self.start_profile(msg_id, msg[1:], route)
+            else:
+                self.logger.warning('did not understand: {}. Discarding...'.format(msg))
 
-    def loop(self):
+    def loop(self, sockets=None):
         """
         Run the code for a given state
+        sockets is the result of a poll that included the mailbox, as done by
+        DeviceHost; without it the device polls its own poller.
         """
         if self.state == 'closed':
             return 1
         elif self.state == 'nobroker':
-            msg = [b"", b'HI']
+            wait = self.retry_time - time.time()
+            if wait > 0:
+                if sockets is None:
+                    time.sleep(min(wait, 0.02))
+                return 0
+            msg = [b"", b'HI'] + self.hello()
             self.logger.debug('sending: {}'.format(msg))
             self.mailbox.send_multipart(msg)
+            self.join_deadline = time.time() + self.join_timeout
             self.state = 'joining'
         elif self.state == 'joining':
-            sockets = dict(self.poller.poll(1000))
+            if sockets is None:
+                sockets = dict(self.poller.poll(max(0, self.join_deadline - time.time()) * 1000))
             if self.mailbox in sockets:
                 cmd = self.mailbox.recv_multipart()
                 self.logger.debug('received from broker: {}'.format(cmd))
                 cmd = cmd[1:]  # strip b'' delimiter frame
                 if cmd[0] == b'OK':
+                    opts = dict(zip(cmd[1::2], cmd[2::2]))
+                    if opts.get(b'SESSION', self.session) != self.session:
+                        self.save_session(opts[b'SESSION'])
+                    self.broker_codecs = codec.decode_names(opts.get(b'CODECS', b''))
+                    if opts.get(b'IDS') == b'0':
+                        # the tag of our schema collided with an earlier one, refuse IDs made with it
+                        self.schema = schema.Schema(self.schema.entries, (self.schema.tag + 1) & 0xffff)
+                        self.logger.warning('schema tag collision, peers reach params by name only')
+                    if self.down_since is not None:
+                        self.downtime += time.time() - self.down_since
+                        self.down_since = None
+                    self.logger.info('joined broker at {} after {} reconnects, {:.3f} s total downtime'.format(self.endpoint, self.reconnects, self.downtime))
+                    self.failed_endpoints.clear()
+                    self.backoff.reset()
                     self.state = 'idle'
                 elif cmd[0] == b'ERR' and cmd[1] == b"Device already connected":
                     self.logger.warning('Broker says I am already connected ({})'.format(cmd))
                     self.state = 'rejected'
                 else:
                     self.logger.warning('Did not understand reply from broker: {}'.format(cmd))
-            else:
-                self.logger.warning('timed out trying to connect to broker')
+            elif time.time() >= self.join_deadline:
+                delay = self.backoff.next()
+                self.reconnects += 1
+                self.logger.warning('timed out trying to connect to broker at {}, retrying in {:.3f} s'.format(self.endpoint, delay))
+                if endpoints.transport(self.endpoint) != 'tcp':
+                    self.failed_endpoints.add(self.endpoint)  # e.g. the ipc file of a broker that crashed
                 self.reset_connection()
+                self.retry_time = time.time() + delay
+                self.drop_stale()
                 self.state = 'nobroker'
         elif self.state == 'rejected':
             return -1
         elif self.state == 'idle':
             # Run functions to update parameters
             # Check the inbox
-            self.check_inbox()
-            # Send messages
+            if sockets is None:
+                sockets = dict(self.poller.poll(self.poll_timeout()))
+            busy = time.perf_counter()
+            self.check_inbox(sockets)
+            # Send messages, urgent ones first
             for msg_id, cmd in self.cmd_queue.items():
                 if cmd.sent:
-                    if time.time() - cmd.sent_time >= cmd.timeout:
+                    if cmd.direct and not cmd.replied and time.time() - cmd.sent_time >= min(DIRECT_TIMEOUT, cmd.timeout / 2):
+                        self.direct_failed(cmd)
+                    elif time.time() - cmd.sent_time >= cmd.timeout:
                         self.logger.warning('Message {} was sent [{}], but has timed out.'.format(cmd.msg, time.asctime(time.gmtime(cmd.sent_time))))
-                else:
-                    msg = [b'', cmd.msg_id] + cmd.msg
-                    self.logger.debug('sending {}'.format(msg))
-                    self.mailbox.send_multipart(msg)
-                    cmd.sent = True
-                    cmd.sent_time = time.time()
-            self.cmd_queue.filter_expired()
+                elif not self.cmd_queue.blocked(cmd):
+                    self.send_command(cmd)
+            for cmd in self.cmd_queue.filter_expired():
+                if cmd.direct:
+                    self.pool.done(cmd.msg[0])  # no reply will come, the peer's socket may be evicted again
+            self.sample()
+            if self.profiling is not None and self.profiling[0].due():
+                self.finish_profile()
+            # a few chunks per loop, so commands and replies are not held up by a large value
+            for msg in self.streams.pump():
+                self.mailbox.send_multipart(msg)
+            if self.payloads is not None and time.time() >= self.reap_time:
+                self.payloads.reap()
+                self.reap_time = time.time() + 0.5
+            self.loop_time.observe(time.perf_counter() - busy)
         elif self.state == 'leaving':
             self.mailbox.send_multipart([b'', b'BYE'])
+            self.save_session(None)
             self.state = 'closing'
         elif self.state == 'closing':
+            if self.profiling is not None:
+                self.finish_profile(reply=False)
             self.cmd_queue.clear()
+            self.close_peers()
+            self.computer.close(self.poller)
+            self.telemetry.close(self.poller)
+            if self.payloads is not None:
+                self.payloads.close()
             self.disconnect()
+            metrics.REGISTRY.unregister(device=self.name)  # a closed device is no longer scraped
+            if self.metrics_server is not None:
+                metrics.stop(self.metrics_server.server_address[1])  # shut down once its other users stopped too
+                self.metrics_server = None
             self.state = 'closed'
         else:
             self.logger.critical('The device is an unknown state: {}. This might be a typo in code.'.format(self.state)) 
             self.state = 'idle'           
         return 0
     
-    def send(self, msg, timeout=1):
-        """Put a message on the command queue with timeout in seconds"""
-        cmd = Command(None, msg, timeout)
-        self.cmd_queue[cmd.msg_id] = cmd
+    def send_command(self, cmd):
+        """Send a queued command straight to its peer if it has a direct endpoint, through the broker otherwise"""
+        dest = cmd.msg[0]
+        endpoint = None
+        param = cmd.msg[2:3]
+        if cmd.msg[1] in (b'GET', b'SET', b'HIST') and len(cmd.msg) > 2:
+            param = [self.param_frame(dest, cmd.msg[2])]
+            if dest != self.name.encode('utf-8'):
+                endpoint = self.lookup(dest)
+        if cmd.urgent:
+            endpoint = None  # through the broker's urgent lane, the peer's direct inbox is shared with bulk traffic
+        if endpoint is not None:
+            msg = [b'', cmd.msg_id] + cmd.msg[1:2] + param + cmd.msg[3:]
+            if cmd.msg[1] == b'SET' and len(msg) > 4:
+                msg[4] = self.pack_value(msg[4], direct=True)
+            self.logger.debug('sending {} directly to {}'.format(msg, endpoint))
+            try:
+                self.pool.send(dest, endpoint, msg)
+                cmd.direct = True
+            except zmq.ZMQError as err:
+                self.logger.warning('could not send to {} at {}: {}'.format(dest, endpoint, err))
+        if not cmd.direct:
+            msg = [b'', cmd.msg_id] + cmd.msg[:2] + param + cmd.msg[3:]
+            if cmd.msg[1] == b'SET' and len(msg) > 5:
+                msg[5] = self.pack_value(msg[5])
+            self.logger.debug('sending {}{}'.format(msg, ' urgently' if cmd.urgent else ''))
+            (self.urgent if cmd.urgent else self.mailbox).send_multipart(msg)
+        cmd.sent = True
+        cmd.sent_time = time.time()
+        self.commands_sent[cmd.msg[1]] = self.commands_sent.get(cmd.msg[1], 0) + 1
+
+    def param_frame(self, dest, name):
+        """ID frame for a parameter of dest if its schema is known, the name otherwise (and ask for the schema)"""
+        entry = self.schemas.get(dest)
+        if entry is None or time.time() >= entry[1]:
+            self.schemas[dest] = [None, time.time() + PEER_TTL]
+            self.mailbox.send_multipart([b'', b'SCHEMA', dest])
+            return name
+        if entry[0] is None:
+            return name
+        return entry[0].id_frame(name) or name
+
+    def direct_failed(self, cmd):
+        """A direct request went unanswered: forget the peer's endpoint for a while and use the broker"""
+        dest = cmd.msg[0]
+        self.logger.warning('no direct reply from {}, falling back to the broker'.format(dest))
+        self.peers[dest] = [None, time.time() + PEER_TTL]
+        self.pool.done(dest)
+        if self.pool.pending.get(dest, 0) == 0:
+            self.pool.close(dest)  # otherwise the replies to the other requests in flight still come on it
+        cmd.direct = False
+        self.send_command(cmd)
+
+    def send(self, msg, timeout=1, urgent=False):
+        """Put a message on the command queue with timeout in seconds, urgent ones skip the bulk traffic"""
+        cmd = Command(None, msg, timeout, urgent)
+        for old in self.cmd_queue.add(cmd):
+            self.logger.info('superseded the unsent SET of {} to {}'.format(old.msg[2].decode('utf-8'), old.get_dest()))
         self.logger.debug('Added msg to queue. Queue is {}'.format(self.cmd_queue))
 
     def reset_socket(self, sock, sockname, endpoint):
@@ -0,0 +1,93 @@
+"""
+Broker endpoints and transport selection
+
+The broker binds every endpoint in names.BROKER_ENDPOINTS that this platform
+supports: tcp for everybody, ipc for devices on its host and inproc for devices
+in its process. A device picks the cheapest one it can reach:
+
+    inproc  the broker bound it in this process (same zmq context)
+    ipc     the socket file exists, i.e. a broker on this host bound it
+    tcp     otherwise
+
+A connect to an ipc or inproc endpoint nobody listens on only fails later, as
+a HI without answer, so devices skip endpoints that failed them last time.
+"""
+
+import os
+
+import zmq
+
+import names
+import shm
+
+_bound = set()  # endpoints bound in this process
+
+
+def transport(endpoint):
+    return endpoint.partition('://')[0]
+
+
+def supported(endpoint):
+    """True if this platform's zmq can use the endpoint's transport"""
+    kind = transport(endpoint)
+    if kind == 'ipc':
+        return zmq.has('ipc')
+    return kind in ('tcp', 'inproc')
+
+
+def is_local(endpoint):
+    """True if a zmq endpoint is on this host, i.e. shared memory can reach it"""
+    kind, sep, address = endpoint.partition('://')
+    if kind in ('ipc', 'inproc'):
+        return True
+    host = address.rsplit(':', 1)[0]
+    return host in ('127.0.0.1', 'localhost', '*', shm.HOSTNAME)
+
+
+def reachable(endpoint):
+    """Best guess whether a broker listens on the endpoint, without connecting"""
+    kind, sep, address = endpoint.partition('://')
+    if not supported(endpoint):
+        return False
+    if kind == 'inproc':
+        return endpoint in _bound
+    if kind == 'ipc':
+        return os.path.exists(address)
+    return True
+
+
+def bind_all(sock, endpoints=None):
+    """Bind sock to every supported endpoint, return the ones that were bound; on an error none stays bound"""
+    if endpoints is None:
+        endpoints = names.BROKER_ENDPOINTS
+    bound = []
+    try:
+        for endpoint in endpoints:
+            if supported(endpoint):
+                sock.bind(endpoint)
+                _bound.add(endpoint)
+                bound.append(endpoint)
+    except zmq.ZMQError:
+        unbind_all(sock, bound)
+        raise
+    return bound
+
+
+def unbind_all(sock, endpoints):
+    for endpoint in endpoints:
+        try:
+            sock.unbind(endpoint)
+        except zmq.ZMQError:
+            pass
+        _bound.discard(endpoint)
+
+
+def pick(endpoints=None, exclude=()):
+    """Cheapest endpoint that looks reachable, the first tcp one if none does"""
+    if endpoints is None:
+        endpoints = names.BROKER_ENDPOINTS
+    order = {'inproc': 0, 'ipc': 1, 'tcp': 2}
+    candidates = [x for x in endpoints if x not in exclude and reachable(x)]
+    if not candidates:
+        return min(endpoints, key=lambda x: transport(x) != 'tcp')
+    return min(candidates, key=lambda x: order.get(transport(x), len(order)))
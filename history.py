@@ -0,0 +1,124 @@
+"""
+Parameter history in preallocated ring buffers
+
+A device keeps the history of a parameter once asked to with
+Device.keep_history(name, capacity). Every change is recorded as a
+(timestamp, value) row of a NumPy array allocated up front, so the memory per
+parameter is capacity * (8 + value size) bytes and never grows; the oldest
+rows are overwritten.
+
+HIST asks a device for the rows of a parameter, selected by option frames in
+key, value pairs (numbers in ASCII):
+
+    LAST n          the last n rows
+    START t, END t  rows with start <= timestamp < end (POSIX times)
+    EVERY k         every k-th row of the selection
+    POINTS n        at most n rows, evenly spaced over the selection
+
+The reply is HST, the parameter frame, the value dtype and the rows as one
+frame of raw array bytes, which decode() turns back into an array without
+copying them. Rows are copied out of the ring once, since it keeps changing.
+Rows that start with b'\x00' are sent after RAW, so they are not mistaken for
+a compressed frame or a shared memory handle, see values.py.
+"""
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+CAPACITY = 10000  # rows kept per parameter by default
+RAW = b'\x00RAW'  # escapes rows that start with b'\x00'
+
+
+def row_dtype(dtype):
+    return np.dtype([('t', '<f8'), ('v', dtype)])
+
+
+def decode(dtype_frame, frame):
+    """Array with fields t and v of a HST reply, a read-only view of frame"""
+    if np is None:
+        raise ImportError('decoding a parameter history needs numpy')
+    if frame[:len(RAW)] == RAW:
+        frame = memoryview(frame)[len(RAW):]
+    return np.frombuffer(frame, row_dtype(dtype_frame.decode('ascii')))
+
+
+def parse_options(frames):
+    """Keyword arguments of History.query from HIST option frames, raises ValueError"""
+    opts = dict(zip(frames[0::2], frames[1::2]))
+    kwargs = {}
+    for key, name, kind in ((b'LAST', 'last', int), (b'START', 'start', float), (b'END', 'end', float),
+                            (b'EVERY', 'every', int), (b'POINTS', 'points', int)):
+        if key in opts:
+            kwargs[name] = kind(opts.pop(key).decode('ascii'))
+    if opts:
+        raise ValueError('unknown HIST options {}'.format(list(opts)))
+    return kwargs
+
+
+class History(object):
+    def __init__(self, capacity=CAPACITY, dtype='f8'):
+        if np is None:
+            raise ImportError('keeping a parameter history needs numpy')
+        self.rows = np.zeros(capacity, row_dtype(dtype))
+        self.capacity = capacity
+        self.head = 0  # row written next
+        self.count = 0  # rows in use
+
+    def __repr__(self):
+        return "History(capacity={},rows={},dtype={})".format(self.capacity, self.count, self.value_dtype())
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def nbytes(self):
+        return self.rows.nbytes
+
+    def value_dtype(self):
+        return self.rows.dtype['v'].str
+
+    def record(self, value, timestamp):
+        """Add a row, overwriting the oldest one if the ring is full; raises if value does not fit the dtype"""
+        self.rows[self.head] = (timestamp, value)
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def position(self, timestamp):
+        """Age order index (0 is the oldest row) of the first row at or after timestamp"""
+        first = self.head - self.count
+        times = self.rows['t']
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if times[(first + mid) % self.capacity] < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def query(self, last=None, start=None, end=None, every=1, points=None):
+        """Copy of the selected rows, oldest first"""
+        lo, hi = 0, self.count
+        if start is not None:
+            lo = self.position(start)
+        if end is not None:
+            hi = self.position(end)
+        if last is not None:
+            lo = max(lo, hi - last)
+        hi = max(lo, hi)
+        step = max(1, every)
+        if points is not None and points > 0:
+            step = max(step, -(-(hi - lo) // points))
+        index = np.arange(lo, hi, step)
+        index += self.head - self.count
+        index %= self.capacity
+        return self.rows[index]
+
+    def encode(self, rows):
+        """dtype frame and data frame of rows from query(), the data a view of their memory unless it needs RAW"""
+        data = rows.view(np.uint8).data
+        if data[:1] == b'\x00':
+            data = RAW + bytes(data)
+        return self.value_dtype().encode('ascii'), data
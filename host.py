@@ -0,0 +1,65 @@
+import zmq
+import time
+
+
+class DeviceHost(object):
+    """
+    Runs many Device objects in one thread
+
+    The devices share the host's poller, so one poll covers every mailbox and
+    each device's state machine is stepped with the result instead of polling
+    (and waiting) on its own.
+    """
+    def __init__(self, timeout=20):
+        self.poller = zmq.Poller()
+        self.devices = []
+        self.timeout = timeout  # longest wait in milliseconds for one poll
+
+    def __repr__(self):
+        return "DeviceHost(devices={})".format([dev.name for dev in self.devices])
+
+    def add(self, dev):
+        """Host a device, it must still be closed so its sockets register with the shared poller"""
+        if dev.state != 'closed':
+            raise ValueError('{} must be closed before it is added to a host'.format(dev.name))
+        dev.poller = self.poller
+        self.devices.append(dev)
+        return dev
+
+    def remove(self, dev):
+        """Stop hosting a closed device, it gets back a poller of its own"""
+        if dev.state != 'closed':
+            raise ValueError('{} must be closed before it is removed from a host'.format(dev.name))
+        self.devices.remove(dev)
+        dev.poller = zmq.Poller()
+
+    def start(self):
+        for dev in self.devices:
+            dev.start()
+        return 0
+
+    def loop(self):
+        """One poll over all devices, then one step of every device's state machine"""
+        timeout = min([dev.poll_timeout(self.timeout) for dev in self.devices] + [self.timeout])
+        sockets = dict(self.poller.poll(timeout))
+        for dev in self.devices:
+            dev.loop(sockets)
+
+    def run(self, duration=None):
+        """Loop for duration seconds, or until every device is closed or rejected"""
+        end = None if duration is None else time.time() + duration
+        while end is None or time.time() < end:
+            self.loop()
+            if all(dev.state in ('closed', 'rejected') for dev in self.devices):
+                break
+
+    def exit(self):
+        """Disconnect every device from the broker, blocks until all of them are closed"""
+        for dev in self.devices:
+            if dev.state == 'idle' or dev.state == 'joining':
+                dev.state = 'leaving'
+            elif dev.state != 'closed':
+                dev.state = 'closing'
+        while any(dev.state != 'closed' for dev in self.devices):
+            self.loop()
+        return 0
@@ -0,0 +1,165 @@
+"""
+Append-only journal of mail_table changes
+
+Records go into a preallocated, memory-mapped file, so an append is a struct
+pack and a slice assignment into the page cache. The pages belong to the OS, so
+the records survive a crash of the broker process (not a power failure).
+
+When the log fills up, or when compact() is called, the live entries are
+rewritten into a fresh file which then replaces the old one.
+
+Record layout, little endian:
+    uint32 length of the rest of the record, 0 marks the end of the log
+    uint8  op, INSERT or DELETE
+    uint8  msg_id length, msg_id
+INSERT records continue with
+    double timestamp
+    uint16 from_addr length, from_addr
+    uint16 to_addr length, to_addr
+    uint16 frame count, then uint32 length and bytes for every frame of msg
+"""
+
+import mmap
+import os
+import struct
+
+JOURNAL_SIZE = 16 * 1024 * 1024  # bytes preallocated for the log
+COMPACT_FRACTION = 0.5  # maybe_compact() rewrites the log once it is this full
+
+INSERT = 1
+DELETE = 2
+
+_len = struct.Struct('<I')
+_head = struct.Struct('<BB')
+_time = struct.Struct('<d')
+_short = struct.Struct('<H')
+
+
+def pack_insert(msg_id, from_addr, to_addr, timestamp, msg):
+    parts = [_head.pack(INSERT, len(msg_id)), msg_id, _time.pack(timestamp),
+             _short.pack(len(from_addr)), from_addr, _short.pack(len(to_addr)), to_addr,
+             _short.pack(len(msg))]
+    for frame in msg:
+        parts.append(_len.pack(len(frame)))
+        parts.append(frame)
+    return b''.join(parts)
+
+
+def pack_delete(msg_id):
+    return _head.pack(DELETE, len(msg_id)) + msg_id
+
+
+def unpack(buf):
+    """Return (op, msg_id, entry) for one record body, entry is None for DELETE"""
+    op, n = _head.unpack_from(buf, 0)
+    pos = _head.size
+    msg_id = bytes(buf[pos:pos + n])
+    pos += n
+    if op == DELETE:
+        return op, msg_id, None
+    timestamp, = _time.unpack_from(buf, pos)
+    pos += _time.size
+    addrs = []
+    for i in range(2):
+        n, = _short.unpack_from(buf, pos)
+        pos += _short.size
+        addrs.append(bytes(buf[pos:pos + n]))
+        pos += n
+    count, = _short.unpack_from(buf, pos)
+    pos += _short.size
+    msg = []
+    for i in range(count):
+        n, = _len.unpack_from(buf, pos)
+        pos += _len.size
+        msg.append(bytes(buf[pos:pos + n]))
+        pos += n
+    return op, msg_id, (addrs[0], addrs[1], timestamp, msg)
+
+
+def read_journal(path):
+    """Replay the log at path, return the mail_table entries still in flight"""
+    table = {}
+    if not os.path.exists(path):
+        return table
+    with open(path, 'rb') as f:
+        buf = f.read()
+    pos = 0
+    while pos + _len.size <= len(buf):
+        n, = _len.unpack_from(buf, pos)
+        if n == 0 or pos + _len.size + n > len(buf):
+            break
+        try:
+            op, msg_id, entry = unpack(memoryview(buf)[pos + _len.size:pos + _len.size + n])
+        except struct.error:
+            break  # torn record at the end of the log
+        if op == INSERT:
+            table[msg_id] = entry
+        else:
+            table.pop(msg_id, None)
+        pos += _len.size + n
+    return table
+
+
+class Journal(object):
+    """Journal of the mail_table given as table, see the module docstring for the format"""
+    def __init__(self, path, table, size=JOURNAL_SIZE):
+        self.path = path
+        self.table = table
+        self.size = size
+        self.recovered = read_journal(path)  # entries left by a previous run
+        self.file = None
+        self.mm = None
+        self.offset = 0
+        self.compact()
+
+    def __repr__(self):
+        return "Journal(path={},used={}/{},recovered={})".format(self.path, self.offset, self.size, len(self.recovered))
+
+    def append(self, body):
+        end = self.offset + _len.size + len(body)
+        if end > self.size:
+            self.compact(len(body))
+            end = self.offset + _len.size + len(body)
+        # body first, so a crash in between leaves the end marker in place
+        self.mm[self.offset + _len.size:end] = body
+        self.mm[self.offset:self.offset + _len.size] = _len.pack(len(body))
+        self.offset = end
+
+    def insert(self, msg_id, from_addr, to_addr, timestamp, msg):
+        self.append(pack_insert(msg_id, from_addr, to_addr, timestamp, msg))
+
+    def delete(self, msg_id):
+        self.append(pack_delete(msg_id))
+
+    def maybe_compact(self):
+        if self.offset > self.size * COMPACT_FRACTION:
+            self.compact()
+
+    def compact(self, extra=0):
+        """Rewrite the live and recovered entries into a fresh log and swap it in"""
+        records = []
+        for entries in (self.recovered, self.table):
+            for msg_id, (from_addr, to_addr, timestamp, msg) in entries.items():
+                body = pack_insert(msg_id, from_addr, to_addr, timestamp, msg)
+                records.append(_len.pack(len(body)) + body)
+        data = b''.join(records)
+        while len(data) + extra + _len.size > self.size * COMPACT_FRACTION:
+            self.size *= 2
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.truncate(self.size)
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        self.close()
+        os.replace(tmp, self.path)
+        self.file = open(self.path, 'r+b')
+        self.mm = mmap.mmap(self.file.fileno(), self.size)
+        self.offset = len(data)
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.file.close()
+            self.mm = None
+            self.file = None
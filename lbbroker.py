@@ -14,6 +14,8 @@ import threading
 
 import zmq
 
+from balancer import LoadBalancer, Worker
+
 NBR_CLIENTS = 10
 NBR_WORKERS = 3
 
@@ -32,19 +34,23 @@ def client_task(ident, context):
         pass
 
 def worker_task(ident, context):
-    """Worker task, using a REQ socket to do load-balancing."""
-    socket = context.socket(zmq.REQ)
+    """Worker task, using a DEALER socket to do load-balancing."""
+    socket = context.socket(zmq.DEALER)
     socket.identity = u"Worker-{}".format(ident).encode("ascii")
     socket.connect("inproc://b")
+    worker = Worker(socket)
 
     # Tell broker we're ready for work
-    socket.send(b"READY")
+    worker.ready()
 
     while True:
-        address, empty, request = socket.recv_multipart()
+        job = worker.recv()
+        if job is None:
+            continue
+        address, request = job
         print("{}: {}".format(socket.identity.decode("ascii"),
-                              request.decode("ascii")))
-        socket.send_multipart([address, b"", b"OK"])
+                              request[0].decode("ascii")))
+        worker.reply(address, [b"OK"])
 
 def main():
     """Load balancer main loop."""
@@ -66,41 +72,11 @@ def main():
         start(worker_task, i, context)
 
     # Initialize main loop state
-    count = NBR_CLIENTS
-    workers = []
-    poller = zmq.Poller()
-    # Only poll for requests from backend until workers are available
-    poller.register(backend, zmq.POLLIN)
+    balancer = LoadBalancer(frontend, backend)
+
+    while balancer.replies < NBR_CLIENTS:
+        balancer.poll()
 
-    while True:
-        sockets = dict(poller.poll())
-
-        if backend in sockets:
-            # Handle worker activity on the backend
-            request = backend.recv_multipart()
-            worker, empty, client = request[:3]
-            if not workers:
-                # Poll for clients now that a worker is available
-                poller.register(frontend, zmq.POLLIN)
-            workers.append(worker)
-            if client != b"READY" and len(request) > 3:
-                # If client reply, send rest back to frontend
-                empty, reply = request[3:]
-                frontend.send_multipart([client, b"", reply])
-                count -= 1
-                if not count:
-                    break
-
-        if frontend in sockets:
-            # Get next client request, route to last-used worker
-            #client, empty, request = frontend.recv_multipart()
-            client, empty, request = frontend.recv_multipart()
-            worker = workers.pop(0)
-            backend.send_multipart([worker, b"", client, b"", request])
-            if not workers:
-                # Don't poll clients if no workers are available
-                poller.unregister(frontend)
-    
     while True:
         pass
 
@@ -2,6 +2,8 @@ import threading
 import zmq
 import time
 
+from balancer import LoadBalancer, Worker
+
 NBR_CLIENTS = 10
 NBR_WORKERS = 3
 
@@ -38,28 +40,26 @@ def worker_task(ident, context=None):
     # Prepare context
     context = context or zmq.Context.instance()
     # Prepare socket for connections
-    socket = context.socket(zmq.REQ)
+    socket = context.socket(zmq.DEALER)
     socket.identity = u"Worker-{}".format(ident).encode('ascii')
     socket.connect("inproc://backend")
+    worker = Worker(socket)
     # Prepare socket for direct control
     controller = context.socket(zmq.SUB)
     controller.connect("tcp://localhost:5555")
     controller.setsockopt(zmq.SUBSCRIBE, b"")
-    # Prepare poller
-    poller = zmq.Poller()
-    poller.register(socket, zmq.POLLIN)
-    poller.register(controller, zmq.POLLIN)
+    worker.poller.register(controller, zmq.POLLIN)
 
     # Tell broker we're ready for work
-    socket.send(b"READY")
+    worker.ready()
 
     while True:
-        socks = dict(poller.poll())
-        if socket in socks:
-            address, empty, request = socket.recv_multipart()
-            print("%s : %s" % (socket.identity, request))
-            socket.send_multipart([address, b"", b"OK"])
-        if controller in socks:
+        job = worker.recv()
+        if job is not None:
+            address, request = job
+            print("%s : %s" % (socket.identity, request[0]))
+            worker.reply(address, [b"OK"])
+        if controller.poll(0):
             break
     socket.close()
     controller.close()
@@ -86,37 +86,10 @@ def main():
         start(worker_task, i, context)
 
     # Initialize main loop
-    count = NBR_CLIENTS
-    workers = []
-    poller = zmq.Poller()
-    # Only poll for requests from backend until workers are available
-    poller.register(backend, zmq.POLLIN)
+    balancer = LoadBalancer(frontend, backend)
 
-    while True:
-        sockets = dict(poller.poll())
-        if backend in sockets:
-            # Handle worker activity on the backend
-            request = backend.recv_multipart()
-            worker, empty, client = request[:3]
-            if not workers:
-                # Poll for clients now that a worker is available
-                poller.register(frontend, zmq.POLLIN)
-            workers.append(worker)
-            if client != b"READY" and len(request) > 3:
-                # If client reply, send rest back to frontend
-                emtpy, reply = request[3:]
-                frontend.send_multipart([client, b"", reply])
-                count -= 1
-                if not count:
-                    break
-        if frontend in sockets:
-            # Get next client request, route to last-used worker
-            client, empty, request = frontend.recv_multipart()
-            worker = workers.pop(0)
-            backend.send_multipart([worker, b"", client, b"", request])
-            if not workers:
-                # Don't poll clients if no workers are available
-                poller.unregister(frontend)
+    while balancer.replies < NBR_CLIENTS:
+        balancer.poll()
     # We are done. Signal all processes to terminate
     for i in range(NBR_CLIENTS):
         controller.send(b"")
@@ -0,0 +1,297 @@
+"""
+Load generator: thousands of simulated devices in one process
+
+Simulated peers speak the Device protocol to a running broker over one poller.
+Devices (--devices) join and answer GET/SET for their parameters; clients
+(--clients) join and send GET/SET requests to the devices. The request mix,
+the choice of target and the arrival process are configurable. Several rates
+can be given to sweep the offered load, e.g. to find the broker's saturation
+point:
+
+    python loadgen.py --devices 500 --clients 2000 --rate 1000,2000,4000,8000
+
+For every step the offered rate, the rate the generator really sustained,
+the completion rate and latency percentiles are printed. When the sustained
+rate falls short of the offered one, the generator itself is the bottleneck.
+
+With --urgent-rate, one client also sends that many GETs per second on the
+broker's urgent lane, which the devices answer on theirs, and their latency
+is printed apart, e.g. to check that it stays flat while the bulk load grows:
+
+    python loadgen.py --payload 65536 --rate 500,1000,2000 --urgent-rate 50
+"""
+
+import argparse
+import bisect
+import pickle
+import random
+import time
+
+import zmq
+
+import names
+
+PREFIX = 'SIM'
+
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+class Arrivals(object):
+    """Request times for a total rate in requests/s, constant, poisson or bursty"""
+    def __init__(self, kind, rate, burst=10):
+        self.kind = kind
+        self.rate = rate
+        self.burst = burst
+        self.left = 0  # requests left in the current burst
+
+    def gap(self):
+        if self.kind == 'constant':
+            return 1 / self.rate
+        elif self.kind == 'poisson':
+            return random.expovariate(self.rate)
+        elif self.kind == 'bursty':
+            # bursts of back-to-back requests, poisson between bursts, same mean rate
+            if self.left > 0:
+                self.left -= 1
+                return 0
+            self.left = self.burst - 1
+            return random.expovariate(self.rate / self.burst)
+        raise ValueError('unknown arrival process {}'.format(self.kind))
+
+
+class Targets(object):
+    """Picks a device for each request, uniformly or following a zipf law"""
+    def __init__(self, names, kind='uniform', s=1.1):
+        self.names = names
+        if kind == 'uniform':
+            self.cum_weights = None
+        elif kind == 'zipf':
+            total = 0
+            self.cum_weights = []
+            for rank in range(1, len(names) + 1):
+                total += 1 / rank ** s
+                self.cum_weights.append(total)
+        else:
+            raise ValueError('unknown target distribution {}'.format(kind))
+
+    def pick(self):
+        if self.cum_weights is None:
+            return random.choice(self.names)
+        x = random.random() * self.cum_weights[-1]
+        return self.names[bisect.bisect(self.cum_weights, x)]
+
+
+class LoadGen(object):
+    def __init__(self, args):
+        self.args = args
+        self.ctx = zmq.Context.instance()
+        self.ctx.max_sockets = args.devices + args.clients + (args.devices + 1 if args.urgent_rate > 0 else 0) + 16
+        self.poller = zmq.Poller()
+        self.peers = {}  # socket -> identity
+        self.devices = [self.add_peer('{}-D{:05}'.format(PREFIX, i)) for i in range(args.devices)]
+        self.clients = [self.add_peer('{}-C{:05}'.format(PREFIX, i)) for i in range(args.clients)]
+        value = pickle.dumps(b'x' * args.payload)
+        self.params = dict(('P{}'.format(i).encode('utf-8'), value) for i in range(args.params))
+        self.param_names = list(self.params)
+        self.targets = Targets([self.peers[sock] for sock in self.devices], args.targets, args.zipf_s)
+        self.urgent = []  # urgent lane sockets of the devices, then of the first client
+        if args.urgent_rate > 0:
+            for sock in self.devices + self.clients[:1]:
+                self.urgent.append(self.add_peer(self.peers[sock].decode('utf-8'), args.urgent_endpoint))
+        self.counter = 0
+        self.reset_stats()
+
+    def add_peer(self, identity, endpoint=None):
+        sock = self.ctx.socket(zmq.DEALER)
+        sock.setsockopt(zmq.LINGER, 0)
+        sock.identity = identity.encode('utf-8')
+        sock.connect(endpoint or self.args.endpoint)
+        self.poller.register(sock, zmq.POLLIN)
+        self.peers[sock] = sock.identity
+        return sock
+
+    def reset_stats(self):
+        self.outstanding = {}  # msg_id -> send time
+        self.latencies = []
+        self.urgent_ids = set()  # outstanding msg_ids sent on the urgent lane
+        self.urgent_latencies = []
+        self.sent = 0
+        self.completed = 0
+        self.errors = 0
+        self.lost = 0
+        self.served = 0  # requests answered by simulated devices
+
+    def join(self, timeout=10):
+        """Say HI from every peer and wait for the OKs"""
+        waiting = set(self.devices + self.clients)  # the urgent lane sockets share their identities
+        for sock in waiting:
+            sock.send_multipart([b'', b'HI'])
+        deadline = time.time() + timeout
+        while waiting and time.time() < deadline:
+            for sock, event in self.poller.poll(100):
+                msg = sock.recv_multipart()
+                if msg[1] == b'OK':
+                    waiting.discard(sock)
+                else:
+                    print('{} could not join: {}'.format(self.peers[sock], msg[1:]))
+                    waiting.discard(sock)
+        if waiting:
+            print('{} peers did not get an answer to HI'.format(len(waiting)))
+
+    def leave(self):
+        for sock in self.devices + self.clients:
+            sock.send_multipart([b'', b'BYE'])
+
+    def request(self):
+        self.counter += 1
+        msg_id = self.counter.to_bytes(16, 'big')
+        param = random.choice(self.param_names)
+        if random.random() < self.args.get_ratio:
+            msg = [b'', msg_id, self.targets.pick(), b'GET', param]
+        else:
+            msg = [b'', msg_id, self.targets.pick(), b'SET', param, self.params[param]]
+        random.choice(self.clients).send_multipart(msg)
+        self.outstanding[msg_id] = time.time()
+        self.sent += 1
+
+    def urgent_request(self):
+        self.counter += 1
+        msg_id = self.counter.to_bytes(16, 'big')
+        self.urgent[-1].send_multipart([b'', msg_id, self.targets.pick(), b'GET', random.choice(self.param_names)])
+        self.outstanding[msg_id] = time.time()
+        self.urgent_ids.add(msg_id)
+
+    def handle(self, sock, msg):
+        msg_id, cmd = msg[1], msg[2]
+        if cmd == b'ACK':
+            return
+        if cmd == b'GET':
+            sock.send_multipart([b'', msg_id, b'RET', msg[3], self.params.get(msg[3], b'')])
+            self.served += 1
+        elif cmd == b'SET':
+            sock.send_multipart([b'', msg_id, b'MET', msg[3], msg[4]])
+            self.served += 1
+        else:
+            sent_time = self.outstanding.pop(msg_id, None)
+            if sent_time is None:
+                return
+            if cmd == b'ERR':
+                self.errors += 1
+            elif msg_id in self.urgent_ids:
+                self.urgent_ids.discard(msg_id)
+                self.urgent_latencies.append(time.time() - sent_time)
+            else:
+                self.completed += 1
+                self.latencies.append(time.time() - sent_time)
+
+    def drain(self, timeout):
+        for sock, event in self.poller.poll(timeout):
+            while True:
+                try:
+                    msg = sock.recv_multipart(zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                self.handle(sock, msg)
+
+    def expire(self, now):
+        for msg_id, sent_time in list(self.outstanding.items()):
+            if now - sent_time > self.args.timeout:
+                del self.outstanding[msg_id]
+                self.lost += 1
+
+    def run(self, rate):
+        """Offer rate requests/s for the configured duration, return the step statistics"""
+        self.reset_stats()
+        arrivals = Arrivals(self.args.arrival, rate, self.args.burst)
+        start = time.time()
+        end = start + self.args.duration
+        next_time = start + arrivals.gap()
+        urgent_gap = 1 / self.args.urgent_rate if self.args.urgent_rate > 0 else None
+        next_urgent = start + urgent_gap if urgent_gap else end
+        next_expire = start + 1
+        while True:
+            now = time.time()
+            if now >= end:
+                break
+            while next_time <= now and next_time < end:
+                self.request()
+                next_time += arrivals.gap()
+            while next_urgent <= now and next_urgent < end:
+                self.urgent_request()
+                next_urgent += urgent_gap
+            if now >= next_expire:
+                self.expire(now)
+                next_expire = now + 1
+            self.drain(max(0, min(next_time, next_urgent, end) - time.time()) * 1000)
+        elapsed = time.time() - start
+        # collect the replies still on their way
+        settle = time.time() + self.args.timeout
+        while self.outstanding and time.time() < settle:
+            self.drain(10)
+        self.lost += len(self.outstanding)
+        return {
+            'offered': rate,
+            'sustained': self.sent / elapsed,
+            'completed': self.completed / elapsed,
+            'errors': self.errors,
+            'lost': self.lost,
+            'served': self.served,
+            'p50': percentile(self.latencies, 50) * 1000,
+            'p99': percentile(self.latencies, 99) * 1000,
+            'max': max(self.latencies) * 1000 if self.latencies else float('nan'),
+            'urgent p50': percentile(self.urgent_latencies, 50) * 1000,
+            'urgent p99': percentile(self.urgent_latencies, 99) * 1000,
+        }
+
+    def close(self):
+        for sock in self.peers:
+            sock.close(linger=100)  # give the BYEs a chance to leave
+        self.ctx.term()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--endpoint', default=names.BROKER_IN)
+    parser.add_argument('--devices', type=int, default=100, help='simulated devices answering requests')
+    parser.add_argument('--clients', type=int, default=1000, help='simulated devices sending requests')
+    parser.add_argument('--params', type=int, default=10, help='parameters per device')
+    parser.add_argument('--payload', type=int, default=8, help='bytes per parameter value')
+    parser.add_argument('--get-ratio', type=float, default=0.9, help='fraction of requests that are GET, the rest are SET')
+    parser.add_argument('--targets', choices=['uniform', 'zipf'], default='uniform')
+    parser.add_argument('--zipf-s', type=float, default=1.1, help='exponent of the zipf target distribution')
+    parser.add_argument('--arrival', choices=['constant', 'poisson', 'bursty'], default='poisson')
+    parser.add_argument('--burst', type=int, default=10, help='requests per burst for --arrival bursty')
+    parser.add_argument('--rate', default='1000', help='total requests/s, a comma separated list sweeps several rates')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per rate')
+    parser.add_argument('--timeout', type=float, default=5, help='seconds before an unanswered request counts as lost')
+    parser.add_argument('--urgent-rate', type=float, default=0, help='GETs/s sent on the urgent lane, their latency is printed apart')
+    parser.add_argument('--urgent-endpoint', default=names.BROKER_URGENT_ENDPOINTS[0])
+    args = parser.parse_args()
+
+    gen = LoadGen(args)
+    gen.join()
+    row_fmt = '{:>10} {:>10} {:>10} {:>8} {:>8} {:>9} {:>9} {:>9}'
+    header = ['offered/s', 'sent/s', 'done/s', 'errors', 'lost', 'p50 ms', 'p99 ms', 'max ms']
+    if args.urgent_rate > 0:
+        row_fmt += ' {:>10} {:>10}'
+        header += ['urgent p50', 'urgent p99']
+    print(row_fmt.format(*header))
+    try:
+        for rate in [float(x) for x in args.rate.split(',')]:
+            stats = gen.run(rate)
+            print(row_fmt.format('{:.0f}'.format(stats['offered']), '{:.0f}'.format(stats['sustained']),
+                                 '{:.0f}'.format(stats['completed']), stats['errors'], stats['lost'],
+                                 '{:.2f}'.format(stats['p50']), '{:.2f}'.format(stats['p99']), '{:.2f}'.format(stats['max']),
+                                 '{:.2f}'.format(stats['urgent p50']), '{:.2f}'.format(stats['urgent p99'])))
+    finally:
+        gen.leave()
+        gen.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,41 @@
 import logging
+import os
 from logging.handlers import RotatingFileHandler
 
+
+class LazyFileHandler(logging.Handler):
+    """Rotating log file opened at the first record, so importing a module that makes a logger creates no file"""
+    def __init__(self, log_filename):
+        logging.Handler.__init__(self)
+        self.log_filename = log_filename
+        self.handler = None
+
+    def emit(self, record):
+        if self.handler is None:
+            # the directory is the working one at the first record, not at import
+            self.handler = RotatingFileHandler(os.path.abspath(self.log_filename), mode='a', maxBytes=5*1024*1024, backupCount=2, encoding=None, delay=0)
+            self.handler.setFormatter(self.formatter)
+        self.handler.emit(record)
+
+    def close(self):
+        if self.handler is not None:
+            self.handler.close()
+        logging.Handler.close(self)
+
+
 def make_logger(log_filename):
     """return a logging object"""
+    # one logger per file, so devices sharing a process do not write each other's logs
+    app_log = logging.getLogger(log_filename)
+    if app_log.handlers:
+        return app_log
     log_formatter = logging.Formatter('%(asctime)s %(levelname)s %(funcName)s(%(lineno)d) %(message)s')
-    logFile = log_filename
-    my_handler = RotatingFileHandler(logFile, mode='a', maxBytes=5*1024*1024, backupCount=2, encoding=None, delay=0)
+    my_handler = LazyFileHandler(log_filename)
     my_handler.setFormatter(log_formatter)
     my_handler.setLevel(logging.DEBUG)
-    
-    app_log = logging.getLogger('root')
+
     app_log.setLevel(logging.DEBUG)
-    
+    app_log.propagate = False
+
     app_log.addHandler(my_handler)
     return app_log
@@ -0,0 +1,187 @@
+"""
+Metrics in the Prometheus text format
+
+One Registry per process (REGISTRY) holds the metrics of the broker and of
+every Device in it, told apart by labels. serve() exports it over HTTP on
+localhost from a background thread:
+
+    curl http://127.0.0.1:9155/metrics
+
+Counters and summaries are plain attributes that only their owner's thread
+updates, so the hot path pays an attribute add and never takes a lock; a
+scrape reads the values as they are. Values that already live elsewhere, like
+the size of the mail table, are read by callbacks at scrape time instead of
+being kept up to date. Callbacks run on the HTTP thread and must only read
+(len() of a dict, a copy of a deque), never iterate state the owner changes.
+"""
+
+import math
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+COUNTER, GAUGE, SUMMARY = 'counter', 'gauge', 'summary'
+
+
+class Counter(object):
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+
+class Summary(object):
+    """Count and sum of observations, e.g. loop durations in seconds"""
+    __slots__ = ('count', 'sum')
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+
+
+def label_value(value):
+    value = value.decode('utf-8', 'replace') if isinstance(value, bytes) else str(value)
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    """{key="value",...} of labels, bytes values such as device identities decoded"""
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, label_value(value)) for key, value in sorted(labels.items())) + '}'
+
+
+def format_value(value):
+    value = float(value)
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(value) if value != int(value) else str(int(value))
+
+
+class Registry(object):
+    def __init__(self):
+        self.lock = threading.Lock()  # registration and scrapes, never updates
+        self.families = {}  # name -> [kind, help, {labels tuple: Counter, Summary or callback}]
+
+    def __repr__(self):
+        return "Registry(metrics={})".format(len(self.families))
+
+    def register(self, name, kind, help, labels, child):
+        with self.lock:
+            family = self.families.setdefault(name, [kind, help, {}])
+            if family[0] != kind:
+                raise ValueError('{} is a {}, not a {}'.format(name, family[0], kind))
+            family[2][tuple(sorted(labels.items()))] = child
+        return child
+
+    def counter(self, name, help, **labels):
+        """A Counter to inc(), registering it again replaces the old one"""
+        return self.register(name, COUNTER, help, labels, Counter())
+
+    def summary(self, name, help, **labels):
+        return self.register(name, SUMMARY, help, labels, Summary())
+
+    def gauge(self, name, help, fn, **labels):
+        """A gauge read by calling fn() at scrape time"""
+        return self.register(name, GAUGE, help, labels, fn)
+
+    def collect(self, name, kind, help, fn, **labels):
+        """A family whose samples fn() returns at scrape time as [(extra labels, value)]"""
+        return self.register(name, kind, help, labels, ('collect', fn))
+
+    def unregister(self, **labels):
+        """Drop every metric with these labels, e.g. of a device that is gone"""
+        items = set(labels.items())
+        with self.lock:
+            for family in self.families.values():
+                for key in [key for key in family[2] if items <= set(key)]:
+                    del family[2][key]
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        lines = []
+        with self.lock:
+            families = [(name, kind, help, list(children.items())) for name, (kind, help, children) in sorted(self.families.items())]
+        for name, kind, help, children in families:
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for key, child in children:
+                labels = dict(key)
+                try:
+                    if isinstance(child, Counter):
+                        lines.append('{}{} {}'.format(name, format_labels(labels), format_value(child.value)))
+                    elif isinstance(child, Summary):
+                        lines.append('{}_count{} {}'.format(name, format_labels(labels), child.count))
+                        lines.append('{}_sum{} {}'.format(name, format_labels(labels), format_value(child.sum)))
+                    elif isinstance(child, tuple):
+                        for extra, value in child[1]():
+                            lines.append('{}{} {}'.format(name, format_labels(dict(labels, **extra)), format_value(value)))
+                    else:
+                        lines.append('{}{} {}'.format(name, format_labels(labels), format_value(child())))
+                except Exception as err:  # one broken callback must not break the scrape
+                    lines.append('# {}{} failed: {}'.format(name, format_labels(labels), err))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class Handler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_servers = {}  # port -> [ThreadingHTTPServer, number of serve() calls not stopped yet]
+
+
+def serve(port, host='127.0.0.1', registry=REGISTRY):
+    """Export registry at http://host:port/metrics from a daemon thread, once per port; return the server"""
+    entry = _servers.get(port)
+    if entry is not None:
+        entry[1] += 1
+        return entry[0]
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    server.registry = registry
+    thread = threading.Thread(target=server.serve_forever, name='metrics', daemon=True)
+    thread.start()
+    entry = [server, 1]
+    _servers[port] = entry
+    if port == 0:
+        _servers[server.server_address[1]] = entry
+    return server
+
+
+def stop(port):
+    """Undo one serve() of port, the server shuts down once every user of it stopped"""
+    entry = _servers.get(port)
+    if entry is None:
+        return
+    entry[1] -= 1
+    if entry[1] > 0:
+        return
+    for key in [key for key, value in _servers.items() if value is entry]:
+        del _servers[key]
+    entry[0].shutdown()
+    entry[0].server_close()
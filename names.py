@@ -1,5 +1,16 @@
 BROKER_IN = "tcp://127.0.0.1:5555"
+BROKER_IPC = "ipc:///tmp/labzmq-broker.ipc"
+BROKER_INPROC = "inproc://labzmq-broker"
+# the broker binds all of these it can, devices pick the cheapest, see endpoints.py
+BROKER_ENDPOINTS = [BROKER_IN, BROKER_IPC, BROKER_INPROC]
+# urgent lane: a second ROUTER the broker serves before the first, for commands that must not wait behind bulk traffic
+BROKER_URGENT_ENDPOINTS = ["tcp://127.0.0.1:5559", "ipc:///tmp/labzmq-broker-urgent.ipc", "inproc://labzmq-broker-urgent"]
 BROKER_OUT = "tcp://127.0.0.1:5556"
+# telemetry: devices publish to the broker's XSUB, clients subscribe at its XPUB, see telemetry.py
+TELEMETRY_IN_ENDPOINTS = ["tcp://127.0.0.1:5557", "ipc:///tmp/labzmq-telemetry-in.ipc", "inproc://labzmq-telemetry-in"]
+TELEMETRY_OUT_ENDPOINTS = ["tcp://127.0.0.1:5558", "ipc:///tmp/labzmq-telemetry-out.ipc", "inproc://labzmq-telemetry-out"]
+# Prometheus metrics of the broker, over HTTP on localhost, see metrics.py
+BROKER_METRICS_PORT = 9155
 
 JOE = "JOE"
 LINDA = "LINDA"
@@ -0,0 +1,112 @@
+"""
+Pool of direct connections to peers
+
+Every peer gets its own DEALER socket, so a reply is attributed to the peer by
+the socket it arrives on. Sockets are connected on first use; once more than
+size of them are open, the least recently used one without requests in flight
+is closed. A closed or failed peer is reconnected by the next send to it, so
+each device keeps only the connections it actually uses and a mesh of hundreds
+of devices does not need n^2 sockets.
+"""
+
+from collections import OrderedDict
+
+import zmq
+
+POOL_SIZE = 64  # idle connections kept open
+
+
+class PeerPool(object):
+    def __init__(self, ctx, poller=None, size=POOL_SIZE):
+        self.ctx = ctx
+        self.poller = poller  # sockets are registered here for POLLIN if given
+        self.size = size
+        self.socks = OrderedDict()  # peer name -> socket, least recently used first
+        self.endpoints = {}  # peer name -> endpoint its socket is connected to
+        self.names = {}  # socket -> peer name
+        self.pending = {}  # peer name -> requests sent and not answered yet
+        self.opened = 0
+        self.evicted = 0
+
+    def __repr__(self):
+        return "PeerPool(size={},open={},opened={},evicted={})".format(self.size, len(self.socks), self.opened, self.evicted)
+
+    def __contains__(self, name):
+        return name in self.socks
+
+    def sockets(self):
+        return list(self.socks.values())
+
+    def peer_of(self, sock):
+        """Name of the peer a socket is connected to, None if it is not one of the pool's"""
+        return self.names.get(sock)
+
+    def get(self, name, endpoint):
+        """Socket connected to a peer, opened if needed, and marked most recently used"""
+        sock = self.socks.get(name)
+        if sock is not None and self.endpoints[name] != endpoint:
+            self.close(name)  # the peer moved
+            sock = None
+        if sock is None:
+            sock = self.ctx.socket(zmq.DEALER)
+            sock.setsockopt(zmq.LINGER, 0)
+            sock.connect(endpoint)
+            if self.poller is not None:
+                self.poller.register(sock, zmq.POLLIN)
+            self.socks[name] = sock
+            self.endpoints[name] = endpoint
+            self.names[sock] = name
+            self.opened += 1
+            self.evict()
+        else:
+            self.socks.move_to_end(name)
+        return sock
+
+    def send(self, name, endpoint, msg, expect_reply=True):
+        """Send msg to a peer, reconnecting once if its socket fails"""
+        try:
+            self.get(name, endpoint).send_multipart(msg, zmq.NOBLOCK)
+        except zmq.ZMQError:
+            self.close(name)
+            self.get(name, endpoint).send_multipart(msg, zmq.NOBLOCK)
+        if expect_reply:
+            self.pending[name] = self.pending.get(name, 0) + 1
+
+    def recv(self, sock):
+        """Receive one message without blocking, return (peer name, msg), raises zmq.Again"""
+        msg = sock.recv_multipart(zmq.NOBLOCK)
+        name = self.names.get(sock)
+        if msg[2:3] != [b'ACK'] and self.pending.get(name, 0) > 0:  # the reply follows an ACK
+            self.pending[name] -= 1
+        return name, msg
+
+    def done(self, name):
+        """Forget one request in flight to a peer, e.g. after it timed out"""
+        if self.pending.get(name, 0) > 1:
+            self.pending[name] -= 1
+        else:
+            self.pending.pop(name, None)
+
+    def evict(self):
+        """Close least recently used sockets without requests in flight until at most size are open"""
+        for name in list(self.socks)[:-1]:  # never the one just used
+            if len(self.socks) <= self.size:
+                break
+            if self.pending.get(name, 0) == 0:
+                self.close(name)
+                self.evicted += 1
+
+    def close(self, name):
+        sock = self.socks.pop(name, None)
+        if sock is None:
+            return
+        del self.endpoints[name]
+        del self.names[sock]
+        self.pending.pop(name, None)
+        if self.poller is not None:
+            self.poller.unregister(sock)
+        sock.close()
+
+    def close_all(self):
+        for name in list(self.socks):
+            self.close(name)
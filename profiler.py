@@ -0,0 +1,151 @@
+"""
+On-demand profiling of a running broker or device
+
+PROF starts a profiling window on the thread that runs the broker's or the
+device's loop, and the reply comes once the window is over, with the path of
+the profile written to disk and a summary of the hottest functions. Options
+follow in key, value pairs (numbers in ASCII):
+
+    SECONDS s       length of the window, SECONDS by default
+    MODE m          cprofile (default), every call is timed; written as a
+                    .prof file for pstats or snakeviz
+                    sample, the stack is sampled every INTERVAL seconds from
+                    another thread, a few percent of overhead; written as
+                    folded stacks (.folded) for flamegraph.pl or speedscope
+
+Nothing is installed while no window is open, so profiling costs nothing
+until it is asked for.
+"""
+
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from itertools import count
+
+CPROFILE, SAMPLE = b'cprofile', b'sample'
+SECONDS = 10  # default window
+MAX_SECONDS = 600
+INTERVAL = 0.005  # seconds between stack samples
+TOP = 20  # functions in the summary
+DIRECTORY = '.'  # where profiles are written
+
+_serial = count(1)  # in file names, so windows started within the same second do not overwrite each other
+
+
+def parse_options(frames):
+    """(seconds, mode) from PROF option frames, raises ValueError"""
+    opts = dict(zip(frames[0::2], frames[1::2]))
+    seconds = float(opts.pop(b'SECONDS', SECONDS))
+    mode = opts.pop(b'MODE', CPROFILE)
+    if opts:
+        raise ValueError('unknown PROF options {}'.format(list(opts)))
+    if not 0 < seconds <= MAX_SECONDS:
+        raise ValueError('SECONDS must be in (0, {}]'.format(MAX_SECONDS))
+    if mode not in (CPROFILE, SAMPLE):
+        raise ValueError('unknown MODE {}'.format(mode))
+    return seconds, mode
+
+
+def options(seconds=SECONDS, mode=CPROFILE):
+    return [b'SECONDS', str(seconds).encode('ascii'), b'MODE', mode]
+
+
+class Sampler(object):
+    """Counts the stacks of one thread, sampled from a thread of its own"""
+    def __init__(self, thread_id, interval=INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()  # tuple of (file, line, function) from the outermost frame -> samples
+        self.samples = 0
+        self.running = False
+        self.thread = None
+
+    def __repr__(self):
+        return "Sampler(interval={},samples={})".format(self.interval, self.samples)
+
+    def enable(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='sampler', daemon=True)
+        self.thread.start()
+
+    def disable(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while self.running:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                break
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                frame = frame.f_back
+            self.stacks[tuple(reversed(stack))] += 1
+            self.samples += 1
+            time.sleep(self.interval)
+
+    def dump(self, path):
+        """Write the stacks in the folded format, one 'f1;f2;f3 samples' line each"""
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write('{} {}\n'.format(';'.join('{} ({}:{})'.format(name, os.path.basename(filename), line)
+                                                  for filename, line, name in stack), count))
+
+    def summary(self, top=TOP):
+        own = Counter()
+        total = Counter()
+        for stack, count in self.stacks.items():
+            own[stack[-1]] += count
+            for entry in set(stack):
+                total[entry] += count
+        lines = ['{} samples every {} s'.format(self.samples, self.interval),
+                 '{:>8} {:>6} {:>6}  function'.format('samples', 'own%', 'cum%')]
+        n = max(1, self.samples)
+        for entry, count in own.most_common(top):
+            filename, line, name = entry
+            lines.append('{:>8} {:>6.1f} {:>6.1f}  {} ({}:{})'.format(count, 100 * count / n, 100 * total[entry] / n,
+                                                                      name, filename, line))
+        return '\n'.join(lines)
+
+
+class Profile(object):
+    """One profiling window, of the thread that creates it"""
+    def __init__(self, name, seconds=SECONDS, mode=CPROFILE, directory=DIRECTORY):
+        self.mode = mode
+        self.started = time.time()
+        self.deadline = self.started + seconds
+        suffix = 'prof' if mode == CPROFILE else 'folded'
+        filename = '{}-{}-{}.{}'.format(name, time.strftime('%Y%m%d-%H%M%S', time.localtime(self.started)), next(_serial), suffix)
+        self.path = os.path.abspath(os.path.join(directory, filename))
+        if mode == CPROFILE:
+            self.profiler = cProfile.Profile()
+        else:
+            self.profiler = Sampler(threading.get_ident())
+        self.profiler.enable()
+
+    def __repr__(self):
+        return "Profile(mode={},path={},left={:.1f})".format(self.mode.decode('ascii'), self.path, self.deadline - time.time())
+
+    def due(self):
+        return time.time() >= self.deadline
+
+    def finish(self, top=TOP):
+        """Stop profiling, write the profile to self.path and return a summary of the top functions"""
+        self.profiler.disable()
+        if self.mode == SAMPLE:
+            self.profiler.dump(self.path)
+            return self.profiler.summary(top)
+        self.profiler.dump_stats(self.path)
+        out = io.StringIO()
+        stats = pstats.Stats(self.profiler, stream=out)
+        stats.sort_stats('tottime').print_stats(top)
+        return '{:.1f} s of cProfile, by own time\n{}'.format(time.time() - self.started, out.getvalue().strip())
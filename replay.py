@@ -0,0 +1,148 @@
+"""
+Replay a broker capture against a running broker
+
+Every identity that sent something in the capture becomes a simulated device:
+a DEALER socket with the same identity that sends what the original device
+sent, at the original pace scaled by --speed (0 replays as fast as possible).
+Messages captured on the urgent lane are sent on it, by a second DEALER with
+the same identity connected to --urgent-endpoint.
+A simulated device also waits until it has received as many messages as the
+original had when it sent each one, so a reply never overtakes its request and
+the replay stays causal at any speed. Messages the simulated devices receive
+are compared with what the broker sent in the capture and any divergence is
+reported.
+
+    python broker.py --capture traffic.cap
+    python replay.py traffic.cap --speed 10
+"""
+
+import argparse
+import time
+from collections import Counter
+
+import zmq
+
+import capture
+import names
+
+CAUSAL_WAIT = 1  # seconds a message waits for the messages that preceded it before it is sent anyway
+
+
+def normalize(frames):
+    """Mask the parts of a message that legitimately change from run to run"""
+    frames = list(frames)
+    for i, frame in enumerate(frames[:-1]):
+        if frame == b'SESSION':
+            frames[i + 1] = b'*'
+    return tuple(frames)
+
+
+def load(path):
+    """Split a capture into what each identity sent and what it was sent"""
+    sent = []  # (timestamp, identity, frames, messages the identity had received by then, lane)
+    expected = {}  # identity -> Counter of normalized messages the broker sent, on either lane
+    delivered = Counter()  # identity -> messages the broker sent it so far
+    for timestamp, direction, lane, identity, frames in capture.read_capture(path):
+        if direction == capture.RECV:
+            sent.append((timestamp, identity, frames, delivered[identity], lane))
+        else:
+            expected.setdefault(identity, Counter())[normalize(frames)] += 1
+            delivered[identity] += 1
+    return sent, expected
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('capture', help='file written by broker.py --capture')
+    parser.add_argument('--speed', type=float, default=1, help='multiple of the original speed, 0 for as fast as possible')
+    parser.add_argument('--endpoint', default=names.BROKER_IN)
+    parser.add_argument('--urgent-endpoint', default=names.BROKER_URGENT_ENDPOINTS[0])
+    parser.add_argument('--settle', type=float, default=1, help='seconds to wait for replies after the last message')
+    parser.add_argument('--show', type=int, default=10, help='divergent messages to print per identity')
+    args = parser.parse_args()
+
+    sent, expected = load(args.capture)
+    if not sent:
+        print('{} holds no messages'.format(args.capture))
+        return
+
+    ctx = zmq.Context.instance()
+    identities = set(record[1] for record in sent) | set(expected)
+    urgent_identities = set(record[1] for record in sent if record[4] == capture.URGENT)
+    ctx.max_sockets = max(ctx.max_sockets, len(identities) + len(urgent_identities) + 16)
+    poller = zmq.Poller()
+    peers = {}  # socket -> identity, on both lanes
+    socks = {}  # (identity, lane) -> socket
+    for identity, lane, endpoint in ([(identity, capture.NORMAL, args.endpoint) for identity in identities] +
+                                     [(identity, capture.URGENT, args.urgent_endpoint) for identity in urgent_identities]):
+        sock = ctx.socket(zmq.DEALER)
+        sock.setsockopt(zmq.LINGER, 0)
+        sock.identity = identity
+        sock.connect(endpoint)
+        poller.register(sock, zmq.POLLIN)
+        peers[sock] = identity
+        socks[(identity, lane)] = sock
+    time.sleep(0.2)  # let the connections come up
+
+    received = dict((identity, Counter()) for identity in identities)
+    count = Counter()  # identity -> messages received so far
+
+    def drain(timeout):
+        for sock, event in poller.poll(timeout):
+            while True:
+                try:
+                    frames = sock.recv_multipart(zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                identity = peers[sock]
+                received[identity][normalize(frames)] += 1
+                count[identity] += 1
+
+    t0 = sent[0][0]
+    start = time.time()
+    late = 0
+    for timestamp, identity, frames, before, lane in sent:
+        if args.speed > 0:
+            due = start + (timestamp - t0) / args.speed
+            while time.time() < due:
+                drain(max(0, min(10, (due - time.time()) * 1000)))
+        else:
+            drain(0)
+        if count[identity] < before:
+            wait_until = time.time() + CAUSAL_WAIT
+            while count[identity] < before and time.time() < wait_until:
+                drain(1)
+            if count[identity] < before:
+                late += 1
+        socks[(identity, lane)].send_multipart(frames)
+    elapsed = time.time() - start
+    settle_until = time.time() + args.settle
+    while time.time() < settle_until:
+        drain(10)
+
+    print('replayed {} messages from {} identities in {:.3f} s ({:.0f} msg/s), original took {:.3f} s'.format(
+        len(sent), len(identities), elapsed, len(sent) / max(elapsed, 1e-9), sent[-1][0] - t0))
+    if late:
+        print('{} messages were sent before the messages that preceded them arrived'.format(late))
+    diverged = 0
+    for identity in sorted(identities):
+        missing = expected.get(identity, Counter()) - received[identity]
+        extra = received[identity] - expected.get(identity, Counter())
+        if not missing and not extra:
+            continue
+        diverged += 1
+        print('{}: {} expected messages missing, {} unexpected'.format(identity, sum(missing.values()), sum(extra.values())))
+        for msg in list(missing)[:args.show]:
+            print('  missing    {}'.format(list(msg)))
+        for msg in list(extra)[:args.show]:
+            print('  unexpected {}'.format(list(msg)))
+    if diverged == 0:
+        print('no divergence')
+
+    for sock in peers:
+        sock.close()
+    ctx.term()
+
+
+if __name__ == '__main__':
+    main()
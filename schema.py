@@ -0,0 +1,110 @@
+"""
+Parameter schemas and integer parameter IDs
+
+A device publishes its parameters at HI (SCHEMA option) as a pickled list of
+(name, type name, access) in a fixed order; a parameter's ID is its index in
+that list. Clients fetch a peer's schema from the broker with SCHEMA name and
+then send the parameter frame as an ID frame instead of the UTF-8 name:
+
+    ID frame: MAGIC, uint16 schema tag, uint16 ID
+
+The tag is taken from a checksum of the schema, so a device that restarted with
+other parameters rejects IDs meant for its old schema (ERR Unknown parameter ID)
+instead of acting on the wrong parameter; the client then sends the request
+again by name. Names keep working everywhere.
+
+A tag has only 16 bits, so two schemas of one device can share it. The broker
+registers every schema a device publishes in a Registry, which raises
+SchemaCollision for such a pair; the broker then withholds the new schema and
+the device moves to a tag no client knows, so stale IDs are refused.
+"""
+
+import pickle
+import struct
+import zlib
+
+MAGIC = b'\x00'  # parameter names are text, so the prefix cannot clash
+READ, WRITE, READ_WRITE = 'r', 'w', 'rw'
+
+_id = struct.Struct('<HH')
+
+
+class SchemaCollision(ValueError):
+    pass
+
+
+def is_id(frame):
+    return frame[:len(MAGIC)] == MAGIC
+
+
+class Schema(object):
+    def __init__(self, entries, tag=None):
+        self.entries = [tuple(entry) for entry in entries]  # (name, type name, access)
+        self.frame = pickle.dumps(self.entries)
+        self.tag = zlib.crc32(self.frame) & 0xffff if tag is None else tag
+        self.names = [entry[0] for entry in self.entries]  # ID -> name
+        self.id_frames = [MAGIC + _id.pack(self.tag, i) for i in range(len(self.entries))]  # ID -> ID frame
+        # name frame or ID frame -> ID, one dict lookup without decoding; IDs of other schemas miss
+        self.indices = dict((name.encode('utf-8'), i) for i, name in enumerate(self.names))
+        self.indices.update((frame, i) for i, frame in enumerate(self.id_frames))
+
+    def __repr__(self):
+        return "Schema(tag={:04x},params={})".format(self.tag, self.names)
+
+    def __len__(self):
+        return len(self.entries)
+
+    @classmethod
+    def from_params(cls, params, access=None):
+        """
+        Schema of a device's params dict, access maps names to READ, WRITE or READ_WRITE (default)
+        A value with type_name and access attributes, e.g. a computed.Computed, describes itself.
+        """
+        access = access or {}
+        return cls([(name, getattr(value, 'type_name', type(value).__name__), access.get(name, getattr(value, 'access', READ_WRITE)))
+                    for name, value in params.items()])
+
+    @classmethod
+    def decode(cls, frame):
+        return cls(pickle.loads(frame))
+
+    def extended(self, entries):
+        """
+        Schema with entries appended, e.g. for params added after HI
+        It keeps the tag, so the IDs peers already have stay valid; the new
+        params are reached by name until the device publishes its schema again.
+        """
+        return Schema(self.entries + [tuple(entry) for entry in entries], self.tag)
+
+    def id_frame(self, name):
+        """ID frame for a parameter name given as bytes, None if the schema does not have it"""
+        i = self.indices.get(name)
+        return None if i is None else self.id_frames[i]
+
+    def index(self, frame):
+        """ID of a parameter from a name or ID frame, None if there is no such parameter in this schema"""
+        return self.indices.get(frame)
+
+    def name_of(self, frame):
+        """Parameter name of a name or ID frame, None for an ID this schema does not know"""
+        if not is_id(frame):
+            return frame.decode('utf-8')
+        i = self.index(frame)
+        return None if i is None else self.names[i]
+
+
+class Registry(object):
+    """The schemas each device published, to catch two of them sharing a tag"""
+    def __init__(self):
+        self.tags = {}  # device identity -> {tag: entries}
+
+    def __repr__(self):
+        return "Registry(devices={})".format(len(self.tags))
+
+    def register(self, owner, schema):
+        """Remember a schema of owner, raise SchemaCollision if an earlier one with other entries has its tag"""
+        known = self.tags.setdefault(owner, {})
+        entries = known.get(schema.tag)
+        if entries is not None and entries != schema.entries:
+            raise SchemaCollision('schema tag {:04x} of {} is also the tag of its earlier schema {}'.format(schema.tag, owner, [entry[0] for entry in entries]))
+        known[schema.tag] = schema.entries
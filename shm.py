@@ -0,0 +1,123 @@
+"""
+Shared-memory transport for large payload frames
+
+A peer on the same host as the broker can replace a large value frame with a
+small handle that names a multiprocessing.shared_memory segment holding the
+bytes. The broker forwards the handle to peers on its host and replaces it with
+the bytes for everybody else, so remote peers never see a handle.
+
+Segment layout: uint64 payload size, uint32 readers left, payload.
+Handle layout: MAGIC, uint64 payload size, segment name.
+
+Readers copy the payload out and count themselves off; the creator unlinks a
+segment once no reader is left, or once it is older than the ttl in case a
+handle got lost on the way. The count is not locked, so a handle is meant for
+the given number of readers reading one after the other.
+"""
+
+import socket
+import struct
+import time
+from multiprocessing import shared_memory, resource_tracker
+
+MAGIC = b'\x00SHM'  # see values.py
+SHM_THRESHOLD = 64 * 1024  # frames at least this big go through shared memory
+SHM_TTL = 10  # seconds before a segment nobody read is unlinked anyway
+
+HOSTNAME = socket.gethostname()
+
+_header = struct.Struct('<QI')
+_handle = struct.Struct('<Q')
+
+_created = set()  # segments created by this process, its resource tracker already knows them
+
+
+def is_handle(frame):
+    return frame[:len(MAGIC)] == MAGIC
+
+
+def _attach(name):
+    """Open an existing segment without handing it to this process's resource tracker"""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:  # track= is new in Python 3.13
+        shm = shared_memory.SharedMemory(name=name)
+        if name not in _created:
+            try:
+                resource_tracker.unregister(shm._name, 'shared_memory')
+            except Exception:
+                pass
+        return shm
+
+
+def read(handle, copy=True):
+    """Copy the payload a handle points to and count this reader off"""
+    size, = _handle.unpack_from(handle, len(MAGIC))
+    name = bytes(handle[len(MAGIC) + _handle.size:]).decode('ascii')
+    shm = _attach(name)
+    data = None
+    try:
+        if copy:
+            data = bytes(shm.buf[_header.size:_header.size + size])
+        length, readers = _header.unpack_from(shm.buf, 0)
+        _header.pack_into(shm.buf, 0, length, max(0, readers - 1))
+    finally:
+        shm.close()
+    return data
+
+
+def release(handle):
+    """Count this reader off without reading, for payloads that are not needed"""
+    read(handle, copy=False)
+
+
+def inline(msg, indices):
+    """Replace the handles among the frames of msg at indices (its value frames) by their payload, for peers on other hosts"""
+    for i in indices:
+        if is_handle(msg[i]):
+            msg[i] = read(msg[i])
+    return msg
+
+
+class SharedPayloads(object):
+    """Creator side: puts payloads in segments and unlinks them when they are done"""
+    def __init__(self, threshold=SHM_THRESHOLD, ttl=SHM_TTL):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.segments = {}  # name -> (SharedMemory, creation time)
+
+    def __repr__(self):
+        return "SharedPayloads(threshold={},segments={})".format(self.threshold, len(self.segments))
+
+    def put(self, data, readers=1):
+        """Copy data into a new segment, return the handle to send instead"""
+        shm = shared_memory.SharedMemory(create=True, size=_header.size + len(data))
+        _header.pack_into(shm.buf, 0, len(data), readers)
+        shm.buf[_header.size:_header.size + len(data)] = data
+        self.segments[shm.name] = (shm, time.time())
+        _created.add(shm.name)
+        return MAGIC + _handle.pack(len(data)) + shm.name.encode('ascii')
+
+    def pack(self, frame):
+        """The frame itself, or a handle to it if it is over the threshold"""
+        if len(frame) >= self.threshold:
+            return self.put(frame)
+        return frame
+
+    def reap(self):
+        """Unlink segments every reader is done with, or that outlived the ttl"""
+        now = time.time()
+        for name, (shm, created) in list(self.segments.items()):
+            length, readers = _header.unpack_from(shm.buf, 0)
+            if readers == 0 or now - created > self.ttl:
+                del self.segments[name]
+                _created.discard(name)
+                shm.close()
+                shm.unlink()
+
+    def close(self):
+        for name, (shm, created) in self.segments.items():
+            _created.discard(name)
+            shm.close()
+            shm.unlink()
+        self.segments.clear()
@@ -0,0 +1,198 @@
+"""
+Chunked streaming of large values
+
+A value frame of STREAM_THRESHOLD bytes or more is replaced by a small header
+frame and the bytes follow in CHK messages of CHUNK_SIZE. The broker remembers
+which two peers a stream connects when it forwards the header and routes the
+chunks and credits between them by stream id, without touching mail_table.
+
+Flow control is credit based: the sender may send chunks below the limit it
+was granted, WINDOW chunks to start with. The receiver raises the limit as
+chunks arrive, asks again for chunks that did not arrive within STALL_TIMEOUT,
+and closes the stream with a DONE credit once the value is complete. A peer
+sends at most CHUNKS_PER_LOOP chunks per loop, so small messages interleave
+with a bulk transfer.
+
+Header: MAGIC, stream id, uint64 size, uint32 chunk count
+Device sends: CHK, stream id, uint32 seq, data
+Device sends: CRD, stream id, uint32 limit, uint32 missing seq...
+"""
+
+import struct
+import time
+
+from MsgID import gen_id
+
+MAGIC = b'\x00STR'  # see values.py
+STREAM_THRESHOLD = 1024 * 1024  # values at least this big are streamed
+CHUNK_SIZE = 256 * 1024
+WINDOW = 8  # chunks in flight per stream
+CHUNKS_PER_LOOP = 4  # chunks sent per call to Streams.pump(), across all streams
+STALL_TIMEOUT = 0.5  # seconds without progress before missing chunks are asked for again
+STREAM_TTL = 30  # seconds without progress before a stream is abandoned
+
+DONE = 0xFFFFFFFF  # limit of the credit that closes a stream
+
+ID_LEN = 16
+_header = struct.Struct('<QI')
+_u32 = struct.Struct('<I')
+
+
+def is_header(frame):
+    return frame[:len(MAGIC)] == MAGIC
+
+
+def stream_id(header):
+    return bytes(header[len(MAGIC):len(MAGIC) + ID_LEN])
+
+
+def make_header(sid, size, nchunks):
+    return MAGIC + sid + _header.pack(size, nchunks)
+
+
+def parse_header(header):
+    """Return (stream id, size, chunk count)"""
+    size, nchunks = _header.unpack_from(header, len(MAGIC) + ID_LEN)
+    return stream_id(header), size, nchunks
+
+
+def is_done(limit):
+    """True for the limit frame of the credit that closes a stream"""
+    return _u32.unpack(limit)[0] == DONE
+
+
+def credit(sid, limit, missing=()):
+    return [b'', b'CRD', sid, _u32.pack(limit)] + [_u32.pack(seq) for seq in missing]
+
+
+class Outgoing(object):
+    def __init__(self, sid, data, chunk_size):
+        self.sid = sid
+        self.data = data
+        self.chunk_size = chunk_size
+        self.nchunks = max(1, -(-len(data) // chunk_size))
+        self.next_seq = 0  # first chunk never sent
+        self.limit = WINDOW  # chunks below this may be sent
+        self.resend = []
+        self.last_activity = time.time()
+
+    def chunk(self, seq):
+        data = self.data[seq * self.chunk_size:(seq + 1) * self.chunk_size]
+        return [b'', b'CHK', self.sid, _u32.pack(seq), data]
+
+    def next_chunk(self):
+        """The next chunk this stream may send, or None"""
+        if self.resend:
+            return self.chunk(self.resend.pop(0))
+        if self.next_seq < min(self.limit, self.nchunks):
+            self.next_seq += 1
+            return self.chunk(self.next_seq - 1)
+        return None
+
+
+class Incoming(object):
+    def __init__(self, sid, size, nchunks, chunk_size, callback):
+        self.sid = sid
+        self.buf = bytearray(size)
+        self.nchunks = nchunks
+        self.chunk_size = chunk_size
+        self.callback = callback
+        self.received = set()
+        self.limit = WINDOW
+        self.last_progress = time.time()
+        self.last_request = self.last_progress
+
+    def missing(self):
+        return [seq for seq in range(min(self.limit, self.nchunks)) if seq not in self.received]
+
+
+class Streams(object):
+    """Streams of one peer, in both directions"""
+    def __init__(self, threshold=STREAM_THRESHOLD, chunk_size=CHUNK_SIZE):
+        self.threshold = threshold
+        self.chunk_size = chunk_size
+        self.outgoing = {}  # stream id -> Outgoing
+        self.incoming = {}  # stream id -> Incoming
+        self.completed = 0
+        self.resent = 0
+
+    def __repr__(self):
+        return "Streams(outgoing={},incoming={},completed={},resent={})".format(
+            len(self.outgoing), len(self.incoming), self.completed, self.resent)
+
+    def pack(self, frame):
+        """The frame itself, or the header of a new stream carrying it if it is over the threshold"""
+        if len(frame) < self.threshold:
+            return frame
+        out = Outgoing(gen_id(), frame, self.chunk_size)
+        self.outgoing[out.sid] = out
+        return make_header(out.sid, len(frame), out.nchunks)
+
+    def expect(self, header, callback):
+        """Start reassembling the stream a header announces, callback gets the bytes when complete"""
+        sid, size, nchunks = parse_header(header)
+        self.incoming[sid] = Incoming(sid, size, nchunks, self.chunk_size, callback)
+
+    def on_chunk(self, sid, seq, data):
+        """Store a chunk, return the messages to send back"""
+        inc = self.incoming.get(sid)
+        if inc is None:
+            return [credit(sid, DONE)]  # nobody waits for this stream, stop the sender
+        seq, = _u32.unpack(seq)
+        if seq not in inc.received:
+            inc.received.add(seq)
+            inc.buf[seq * inc.chunk_size:seq * inc.chunk_size + len(data)] = data
+            inc.last_progress = time.time()
+        if len(inc.received) == inc.nchunks:
+            del self.incoming[sid]
+            self.completed += 1
+            inc.callback(bytes(inc.buf))
+            return [credit(sid, DONE)]
+        if len(inc.received) + WINDOW - inc.limit >= WINDOW // 2:
+            inc.limit = len(inc.received) + WINDOW
+            return [credit(sid, inc.limit)]
+        return []
+
+    def on_credit(self, sid, limit, missing):
+        out = self.outgoing.get(sid)
+        if out is None:
+            return
+        if is_done(limit):
+            del self.outgoing[sid]
+            return
+        limit, = _u32.unpack(limit)
+        out.limit = max(out.limit, limit)
+        out.last_activity = time.time()
+        for seq in missing:
+            seq, = _u32.unpack(seq)
+            if seq < out.next_seq and seq not in out.resend:
+                out.resend.append(seq)
+                self.resent += 1
+
+    def pump(self, budget=CHUNKS_PER_LOOP):
+        """Return the chunks and credits to send now, drop streams that stalled for good"""
+        msgs = []
+        now = time.time()
+        for sid, out in list(self.outgoing.items()):
+            if now - out.last_activity > STREAM_TTL:
+                del self.outgoing[sid]
+        for sid, inc in list(self.incoming.items()):
+            if now - inc.last_progress > STREAM_TTL:
+                del self.incoming[sid]
+            elif now - inc.last_progress > STALL_TIMEOUT and now - inc.last_request > STALL_TIMEOUT:
+                inc.last_request = now
+                msgs.append(credit(sid, inc.limit, inc.missing()[:WINDOW]))
+        # round robin over the outgoing streams until the budget is spent
+        while budget > 0:
+            sent = False
+            for out in list(self.outgoing.values()):
+                msg = out.next_chunk()
+                if msg is not None:
+                    msgs.append(msg)
+                    budget -= 1
+                    sent = True
+                    if budget == 0:
+                        break
+            if not sent:
+                break
+        return msgs
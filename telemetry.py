@@ -0,0 +1,252 @@
+"""
+Periodic telemetry over PUB/SUB
+
+A device publishes the parameters it declared with Device.publish(name, rate)
+at that rate, without being asked. Its XPUB socket connects to the broker's
+XSUB; clients connect a SUB (Subscriber) to the broker's XPUB. The broker
+forwards samples and subscriptions between the two with zmq.proxy, in C, so a
+sample costs one message and no Python in the broker. Subscriptions travel
+back to the devices, which only sample topics someone subscribed to.
+
+A sample is three frames:
+
+    topic   device name, '/', parameter name, e.g. b'JOE/T'
+    header  uint64 sequence number of the topic, float64 POSIX time of the sample
+    value   pickled value
+
+Sequence numbers let a subscriber count the samples it missed (dropped at a
+high water mark or while it was slow); a publisher counts the ticks it missed
+because its loop was late.
+"""
+
+import pickle
+import struct
+import threading
+import time
+
+import zmq
+
+import endpoints
+import names
+
+SEP = b'/'
+RATE_WINDOW = 1  # seconds over which rates are measured
+
+_header = struct.Struct('<Qd')
+
+
+def topic(device, param=None):
+    """Topic of a device's parameter, or the prefix of all its topics if param is None"""
+    device = device if isinstance(device, bytes) else str(device).encode('utf-8')
+    if param is None:
+        return device + SEP
+    return device + SEP + (param if isinstance(param, bytes) else str(param).encode('utf-8'))
+
+
+class Rate(object):
+    """Count of events and their rate over the last full RATE_WINDOW"""
+    def __init__(self):
+        self.total = 0
+        self.rate = 0.0
+        self.count = 0
+        self.start = time.time()
+
+    def __repr__(self):
+        return "Rate(total={},rate={:.1f})".format(self.total, self.rate)
+
+    def add(self, now, n=1):
+        self.total += n
+        self.count += n
+        if now - self.start >= RATE_WINDOW:
+            self.rate = self.count / (now - self.start)
+            self.count = 0
+            self.start = now
+
+
+class Topic(object):
+    def __init__(self, name, rate):
+        self.name = name
+        self.frame = None  # set by the Publisher, it knows the device name
+        self.period = 1.0 / rate
+        self.next_time = 0  # POSIX time the next sample is due
+        self.seq = 0
+        self.sent = Rate()
+        self.missed = 0  # ticks skipped because the loop came too late
+
+    def __repr__(self):
+        return "Topic({},rate={:.1f},sent={},missed={})".format(self.name, 1 / self.period, self.sent, self.missed)
+
+
+class Publisher(object):
+    """The declared parameters of a device and the XPUB socket they are published on"""
+    def __init__(self, device):
+        self.device = device
+        self.topics = {}  # param name -> Topic
+        self.subscriptions = set()  # topic prefixes subscribers asked for
+        self.sock = None
+
+    def __repr__(self):
+        return "Publisher(topics={},subscriptions={})".format(list(self.topics.values()), len(self.subscriptions))
+
+    def declare(self, name, rate):
+        """Publish param name rate times a second, a rate of 0 stops publishing it"""
+        if rate <= 0:
+            self.topics.pop(name, None)
+            return
+        entry = Topic(name, rate)
+        entry.frame = topic(self.device, name)
+        self.topics[name] = entry
+
+    def open(self, ctx, endpoint, poller):
+        self.sock = ctx.socket(zmq.XPUB)
+        self.sock.setsockopt(zmq.LINGER, 0)
+        self.sock.connect(endpoint)
+        poller.register(self.sock, zmq.POLLIN)
+
+    def close(self, poller):
+        if self.sock is None:
+            return
+        poller.unregister(self.sock)
+        self.sock.close()
+        self.sock = None
+        self.subscriptions.clear()
+
+    def on_subscription(self):
+        """Read the (un)subscriptions forwarded by the broker"""
+        while True:
+            try:
+                frame = self.sock.recv(zmq.NOBLOCK)
+            except zmq.Again:
+                break
+            if frame[:1] == b'\x01':
+                self.subscriptions.add(frame[1:])
+            elif frame[:1] == b'\x00':
+                self.subscriptions.discard(frame[1:])
+
+    def wanted(self, entry):
+        return any(entry.frame.startswith(prefix) for prefix in self.subscriptions)
+
+    def due(self, now):
+        """Names of the topics due for a sample that someone subscribed to"""
+        due = []
+        for entry in self.topics.values():
+            if not self.wanted(entry):
+                entry.next_time = 0  # the schedule starts over once someone subscribes
+            elif entry.next_time == 0:
+                entry.next_time = now + entry.period
+                due.append(entry.name)
+            elif now >= entry.next_time:
+                behind = int((now - entry.next_time) / entry.period)
+                entry.missed += behind
+                entry.next_time += (behind + 1) * entry.period
+                due.append(entry.name)
+        return due
+
+    def next_due(self):
+        """POSIX time of the next sample to take, None if nothing is subscribed to"""
+        times = [entry.next_time for entry in self.topics.values() if self.wanted(entry)]
+        return min(times) if times else None
+
+    def publish(self, name, value, timestamp=None):
+        entry = self.topics.get(name)
+        if entry is None or self.sock is None:
+            return
+        timestamp = time.time() if timestamp is None else timestamp
+        entry.seq += 1
+        self.sock.send_multipart([entry.frame, _header.pack(entry.seq, timestamp), pickle.dumps(value)])
+        entry.sent.add(timestamp)
+
+    def stats(self):
+        """param name -> dict of published rate and counts"""
+        return dict((entry.name, {'rate': entry.sent.rate, 'sent': entry.sent.total, 'missed': entry.missed})
+                    for entry in self.topics.values())
+
+
+class Subscriber(object):
+    """SUB socket on the broker's XPUB, counting the rate and the drops of every topic"""
+    def __init__(self, ctx=None, endpoint=None):
+        self.ctx = ctx or zmq.Context.instance()
+        self.endpoint = endpoint or endpoints.pick(names.TELEMETRY_OUT_ENDPOINTS)
+        self.sock = self.ctx.socket(zmq.SUB)
+        self.sock.setsockopt(zmq.LINGER, 0)
+        self.sock.connect(self.endpoint)
+        self.seqs = {}  # topic -> last sequence number received
+        self.received = {}  # topic -> Rate
+        self.dropped = {}  # topic -> samples missed, from gaps in the sequence numbers
+
+    def __repr__(self):
+        return "Subscriber(endpoint={},topics={})".format(self.endpoint, len(self.seqs))
+
+    def subscribe(self, device, param=None):
+        """Receive a device's parameter, or all of its parameters if param is None"""
+        self.sock.setsockopt(zmq.SUBSCRIBE, topic(device, param))
+
+    def unsubscribe(self, device, param=None):
+        self.sock.setsockopt(zmq.UNSUBSCRIBE, topic(device, param))
+
+    def recv(self, flags=0):
+        """(topic, value, timestamp) of the next sample, raises zmq.Again with zmq.NOBLOCK if there is none"""
+        name, header, value = self.sock.recv_multipart(flags)
+        seq, timestamp = _header.unpack(header)
+        last = self.seqs.get(name)
+        if last is not None and seq > last + 1:
+            self.dropped[name] = self.dropped.get(name, 0) + seq - last - 1
+        self.seqs[name] = seq
+        self.received.setdefault(name, Rate()).add(time.time())
+        return name, pickle.loads(value), timestamp
+
+    def stats(self):
+        """topic -> dict of received rate and counts"""
+        return dict((name, {'rate': rate.rate, 'received': rate.total, 'dropped': self.dropped.get(name, 0)})
+                    for name, rate in self.received.items())
+
+    def close(self):
+        self.sock.close()
+
+
+class Proxy(object):
+    """The broker's XSUB/XPUB pair, forwarding in a zmq.proxy thread until stop()"""
+    def __init__(self, ctx, in_endpoints, out_endpoints):
+        self.ctx = ctx
+        self.in_endpoints = in_endpoints
+        self.out_endpoints = out_endpoints
+        self.bound = []
+        self.thread = None
+
+    def __repr__(self):
+        return "Proxy(endpoints={})".format(self.bound)
+
+    def start(self):
+        """Bind both sides, raising any bind error here, and start forwarding"""
+        self.xsub = self.ctx.socket(zmq.XSUB)
+        self.xpub = self.ctx.socket(zmq.XPUB)
+        self.control = self.ctx.socket(zmq.PAIR)
+        self.steer = self.ctx.socket(zmq.PAIR)
+        for sock in (self.xsub, self.xpub, self.control, self.steer):
+            sock.setsockopt(zmq.LINGER, 0)
+        try:
+            self.bound = endpoints.bind_all(self.xsub, self.in_endpoints)
+            self.bound += endpoints.bind_all(self.xpub, self.out_endpoints)
+        except zmq.ZMQError:
+            self.close()
+            raise
+        endpoint = 'inproc://labzmq-telemetry-{}'.format(id(self))
+        self.control.bind(endpoint)
+        self.steer.connect(endpoint)
+        self.thread = threading.Thread(target=zmq.proxy_steerable, args=(self.xsub, self.xpub, None, self.control),
+                                       name='telemetry', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.steer.send(b'TERMINATE')
+            self.thread.join()
+            self.thread = None
+        self.close()
+
+    def close(self):
+        endpoints.unbind_all(self.xsub, [x for x in self.bound if x in self.in_endpoints])
+        endpoints.unbind_all(self.xpub, [x for x in self.bound if x in self.out_endpoints])
+        self.bound = []
+        for sock in (self.xsub, self.xpub, self.control, self.steer):
+            sock.close()
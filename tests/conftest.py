@@ -0,0 +1,81 @@
+import os
+import sys
+import time
+
+import pytest
+import zmq
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import broker  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    """Session files, logs and profiles land in a fresh directory"""
+    import device
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(device, 'SESSION_DIRECTORY', str(tmp_path))
+    return tmp_path
+
+
+@pytest.fixture
+def lanes(tmp_path):
+    """ipc endpoints of a broker's normal and urgent lanes, they survive a restart of the broker"""
+    return ['ipc://{}/broker.ipc'.format(tmp_path)], ['ipc://{}/urgent.ipc'.format(tmp_path)]
+
+
+def make_broker(lanes, **kwargs):
+    b = broker.Broker(endpoints=lanes[0], urgent_endpoints=lanes[1], telemetry=False, **kwargs)
+    b.start()
+    return b
+
+
+@pytest.fixture
+def running_broker(lanes):
+    b = make_broker(lanes)
+    yield b
+    b.stop()
+
+
+def peer(lanes, identity, hello=True):
+    """Raw DEALER with identity on the broker's normal lane, after HI if hello"""
+    sock = zmq.Context.instance().socket(zmq.DEALER)
+    sock.setsockopt(zmq.LINGER, 0)
+    sock.identity = identity
+    sock.connect(lanes[0][0])
+    if hello:
+        sock.send_multipart([b'', b'HI'])
+        assert sock.poll(2000), 'no OK from the broker'
+        assert sock.recv_multipart()[1] == b'OK'
+    return sock
+
+
+def recv(sock, timeout=2):
+    assert sock.poll(timeout * 1000), 'nothing received'
+    return sock.recv_multipart()
+
+
+def make_device(lanes, name, **params):
+    import device
+    d = device.Device(name, **params)
+    d.endpoints = lanes[0]
+    d.urgent_endpoints = lanes[1]
+    return d
+
+
+def run(devices, until=None, timeout=2):
+    """Loop devices until until() is true or timeout seconds passed, return until()"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        for d in devices:
+            d.loop()
+        if until is not None and until():
+            return True
+    return until() if until is not None else None
+
+
+def join(*devices):
+    for d in devices:
+        d.start()
+    assert run(devices, lambda: all(d.state == 'idle' for d in devices), timeout=5)
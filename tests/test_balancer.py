@@ -0,0 +1,56 @@
+import time
+
+import zmq
+
+from balancer import LoadBalancer, Worker
+
+
+def sockets(ctx, kind, count):
+    socks = [ctx.socket(kind) for i in range(count)]
+    for sock in socks:
+        sock.setsockopt(zmq.LINGER, 0)
+    return socks
+
+
+def poll_until(lb, until, timeout=5):
+    deadline = time.time() + timeout
+    while not until() and time.time() < deadline:
+        lb.poll(10)
+    return until()
+
+
+def test_request_of_an_expired_worker_goes_to_the_next_one():
+    ctx = zmq.Context.instance()
+    frontend, backend = sockets(ctx, zmq.ROUTER, 2)
+    frontend.bind('inproc://test-balancer-frontend')
+    backend.bind('inproc://test-balancer-backend')
+    client, = sockets(ctx, zmq.REQ, 1)
+    client.connect('inproc://test-balancer-frontend')
+    silent, alive = [Worker(sock, interval=0.05) for sock in sockets(ctx, zmq.DEALER, 2)]
+    lb = LoadBalancer(frontend, backend, interval=0.05, liveness=2)
+    try:
+        silent.socket.connect('inproc://test-balancer-backend')
+        silent.ready()
+        assert poll_until(lb, lambda: lb.idle)
+        client.send(b'work')
+        assert poll_until(lb, lambda: lb.busy)
+        job = silent.recv(1000)
+        assert job is not None and job[1] == [b'work']
+        alive.socket.connect('inproc://test-balancer-backend')
+        alive.ready()
+        # the silent worker never heartbeats again, the alive one answers whatever it gets
+        def serve():
+            job = alive.recv(0)
+            if job is not None:
+                alive.reply(job[0], [b'done'])
+            return client.poll(0)
+        assert poll_until(lb, serve)
+        assert client.recv() == b'done'
+        assert lb.expired == 1 and lb.requeued == 1 and lb.replies == 1
+        # a late reply of the expired worker is not forwarded a second time
+        silent.reply(job[0], [b'late'])
+        poll_until(lb, lambda: False, timeout=0.2)
+        assert lb.replies == 1 and not client.poll(0)
+    finally:
+        for sock in (frontend, backend, client, silent.socket, alive.socket):
+            sock.close()
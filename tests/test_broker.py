@@ -0,0 +1,60 @@
+import pytest
+import zmq
+
+import broker
+from conftest import make_broker, peer
+
+
+def test_failed_open_releases_the_endpoints(lanes, tmp_path):
+    bad = broker.Broker(endpoints=lanes[0], urgent_endpoints=lanes[1], telemetry=True,
+                        journal_path=str(tmp_path / 'missing' / 'mail.journal'))
+    with pytest.raises(OSError):
+        bad.start()
+    assert bad.frontend is None and bad.urgent is None and bad.proxy is None
+    b = broker.Broker(endpoints=lanes[0], urgent_endpoints=lanes[1], telemetry=True)
+    b.start()
+    try:
+        assert b.proxy is not None, 'the telemetry endpoints are still bound'
+        peer(lanes, b'JOE')
+    finally:
+        b.stop()
+
+
+def test_stop_twice_and_restart(lanes):
+    b = make_broker(lanes)
+    b.stop()
+    b.stop()
+    b = make_broker(lanes)
+    try:
+        peer(lanes, b'JOE')
+    finally:
+        b.stop()
+
+
+class FullLane(object):
+    """Urgent ROUTER whose peer queue is full for the first sends"""
+    def __init__(self, full):
+        self.full = full
+        self.sent = []
+
+    def send_multipart(self, msg, flags=0):
+        if self.full:
+            self.full -= 1
+            raise zmq.Again()
+        self.sent.append(msg)
+
+
+def test_urgent_send_on_a_full_lane_is_held_and_sent_again(monkeypatch):
+    b = broker.Broker(telemetry=False)
+    b.urgent = FullLane(full=2)
+    msg = [b'JOE', b'', b'\x01' * 16, b'GET', b'X']
+    b.encode_send(list(msg), urgent=True)
+    assert b.urgent.sent == [] and len(b.held) == 1
+    b.flush()
+    assert b.urgent.sent == [] and len(b.held) == 1
+    b.flush()
+    assert b.urgent.sent == [msg] and b.held == []
+    b.urgent = FullLane(full=1)
+    monkeypatch.setattr(broker, 'URGENT_HOLD', 0)
+    b.encode_send(list(msg), urgent=True)
+    assert b.urgent.sent == [] and b.held == [] and b.urgent_dropped.value == 1
@@ -0,0 +1,38 @@
+import struct
+
+import zmq
+
+import capture
+import replay
+from conftest import make_broker, peer, recv
+
+
+def test_capture_records_the_lane_replay_sends_on(lanes, tmp_path):
+    path = str(tmp_path / 'traffic.cap')
+    b = make_broker(lanes, capture_path=path)
+    try:
+        joe, bob = peer(lanes, b'JOE'), peer(lanes, b'BOB')
+        urgent = zmq.Context.instance().socket(zmq.DEALER)
+        urgent.setsockopt(zmq.LINGER, 0)
+        urgent.identity = b'BOB'
+        urgent.connect(lanes[1][0])
+        bob.send_multipart([b'', b'\x01' * 16, b'JOE', b'GET', b'X'])
+        urgent.send_multipart([b'', b'\x02' * 16, b'JOE', b'SET', b'X', b'1'])
+        recv(joe)
+        recv(joe)
+        urgent.close()
+    finally:
+        b.stop()
+    lanes_of = dict((frames[1], lane) for timestamp, direction, lane, identity, frames in capture.read_capture(path)
+                    if direction == capture.RECV and identity == b'BOB' and len(frames) > 2)
+    assert lanes_of == {b'\x01' * 16: capture.NORMAL, b'\x02' * 16: capture.URGENT}
+    sent, expected = replay.load(path)
+    assert dict((record[2][1], record[4]) for record in sent if record[1] == b'BOB' and len(record[2]) > 2) == lanes_of
+
+
+def test_captures_of_the_first_format_are_read_as_normal(tmp_path):
+    path = str(tmp_path / 'old.cap')
+    with open(path, 'wb') as f:
+        f.write(capture.MAGIC_V1 + struct.pack('<dBHH', 1.5, capture.RECV, 3, 2) + b'JOE' +
+                struct.pack('<I', 0) + struct.pack('<I', 2) + b'HI')
+    assert list(capture.read_capture(path)) == [(1.5, capture.RECV, capture.NORMAL, b'JOE', [b'', b'HI'])]
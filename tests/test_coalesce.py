@@ -0,0 +1,70 @@
+import pickle
+import time
+
+import broker
+
+from conftest import peer, recv
+
+
+def test_identical_gets_in_flight_share_one_request(running_broker, lanes):
+    joe, bob, sam = peer(lanes, b'JOE'), peer(lanes, b'BOB'), peer(lanes, b'SAM')
+    bob.send_multipart([b'', b'\x01' * 16, b'JOE', b'GET', b'X'])
+    assert recv(bob)[2] == b'ACK'
+    sam.send_multipart([b'', b'\x02' * 16, b'JOE', b'GET', b'X'])
+    assert recv(sam)[2] == b'ACK'
+    assert recv(joe)[1:] == [b'\x01' * 16, b'GET', b'X']
+    assert not joe.poll(200), 'the second GET was forwarded too'
+    joe.send_multipart([b'', b'\x01' * 16, b'RET', b'X', pickle.dumps(7)])
+    assert recv(bob)[1:] == [b'\x01' * 16, b'RET', b'X', pickle.dumps(7)]
+    assert recv(sam)[1:] == [b'\x02' * 16, b'RET', b'X', pickle.dumps(7)]
+    assert running_broker.coalescing_stats() == {'forwarded': 1, 'coalesced': 1}
+
+
+def test_gets_of_other_params_are_not_coalesced(running_broker, lanes):
+    joe, bob = peer(lanes, b'JOE'), peer(lanes, b'BOB')
+    bob.send_multipart([b'', b'\x01' * 16, b'JOE', b'GET', b'X'])
+    bob.send_multipart([b'', b'\x02' * 16, b'JOE', b'GET', b'Y'])
+    assert recv(joe)[2:] == [b'GET', b'X']
+    assert recv(joe)[2:] == [b'GET', b'Y']
+
+
+def test_err_reaches_every_coalesced_get(running_broker, lanes):
+    joe, bob, sam = peer(lanes, b'JOE'), peer(lanes, b'BOB'), peer(lanes, b'SAM')
+    bob.send_multipart([b'', b'\x01' * 16, b'JOE', b'GET', b'X'])
+    assert recv(bob)[2] == b'ACK'
+    sam.send_multipart([b'', b'\x02' * 16, b'JOE', b'GET', b'X'])
+    assert recv(sam)[2] == b'ACK'
+    recv(joe)
+    joe.send_multipart([b'', b'\x01' * 16, b'ERR', b'X is not param'])
+    assert recv(bob)[1:] == [b'\x01' * 16, b'ERR', b'X is not param']
+    assert recv(sam)[1:] == [b'\x02' * 16, b'ERR', b'X is not param']
+
+
+def test_get_is_not_coalesced_onto_a_lost_one(running_broker, lanes, monkeypatch):
+    monkeypatch.setattr(broker, 'GET_COALESCE_AGE', 0.2)
+    joe, bob, sam, cat = (peer(lanes, name) for name in (b'JOE', b'BOB', b'SAM', b'CAT'))
+    bob.send_multipart([b'', b'\x01' * 16, b'JOE', b'GET', b'X'])
+    assert recv(bob)[2] == b'ACK'
+    recv(joe)  # and never answered
+    sam.send_multipart([b'', b'\x02' * 16, b'JOE', b'GET', b'X'])
+    assert recv(sam)[2] == b'ACK'
+    time.sleep(0.3)
+    cat.send_multipart([b'', b'\x03' * 16, b'JOE', b'GET', b'X'])
+    assert recv(cat)[2] == b'ACK'
+    assert recv(joe)[1:] == [b'\x03' * 16, b'GET', b'X']
+    joe.send_multipart([b'', b'\x03' * 16, b'RET', b'X', pickle.dumps(7)])
+    assert recv(cat)[1:] == [b'\x03' * 16, b'RET', b'X', pickle.dumps(7)]
+    assert recv(sam)[1:] == [b'\x02' * 16, b'RET', b'X', pickle.dumps(7)]
+    assert running_broker.coalescing_stats() == {'forwarded': 2, 'coalesced': 1}
+
+
+def test_evicted_device_leaves_no_gets_in_flight(running_broker, lanes):
+    joe, bob, sam = peer(lanes, b'JOE'), peer(lanes, b'BOB'), peer(lanes, b'SAM')
+    bob.send_multipart([b'', b'\x01' * 16, b'JOE', b'GET', b'X'])
+    sam.send_multipart([b'', b'\x02' * 16, b'JOE', b'GET', b'X'])
+    recv(joe)
+    joe.send_multipart([b'', b'BYE'])
+    for sock, msg_id in ((bob, b'\x01' * 16), (sam, b'\x02' * 16)):
+        replies = [recv(sock), recv(sock)]
+        assert [msg_id, b'ERR', b'Device disconnected'] in [reply[1:] for reply in replies]
+    assert running_broker.gets == {} and running_broker.waiters == {}
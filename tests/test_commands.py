@@ -0,0 +1,68 @@
+import pickle
+
+import computed
+import device
+from conftest import join, make_device, run
+
+
+def command(msg, urgent=False):
+    return device.Command(None, msg, urgent=urgent)
+
+
+def test_urgent_commands_come_first():
+    queue = device.CommandQueue()
+    normal = [command([b'JOE', b'GET', b'X']) for i in range(3)]
+    urgent = command([b'JOE', b'GET', b'Y'], urgent=True)
+    for cmd in normal[:2] + [urgent] + normal[2:]:
+        queue.add(cmd)
+    assert [cmd for msg_id, cmd in queue.items()] == [urgent] + normal
+    assert len(queue) == 4 and urgent.msg_id in queue
+    assert queue.pop(urgent.msg_id) is urgent
+    assert [cmd for msg_id, cmd in queue.items()] == normal
+
+
+def test_unsent_set_is_superseded_by_a_newer_one():
+    queue = device.CommandQueue(coalesce=True)
+    first = command([b'JOE', b'SET', b'X', b'1'])
+    other = command([b'JOE', b'SET', b'Y', b'1'])
+    queue.add(first)
+    queue.add(other)
+    last = command([b'JOE', b'SET', b'X', b'2'])
+    assert queue.add(last) == [first]
+    assert first.superseded and queue.superseded == 1
+    assert [cmd for msg_id, cmd in queue.items()] == [other, last]
+
+
+def test_sent_set_is_not_superseded():
+    queue = device.CommandQueue(coalesce=True)
+    first = command([b'JOE', b'SET', b'X', b'1'])
+    queue.add(first)
+    first.sent = True
+    assert queue.add(command([b'JOE', b'SET', b'X', b'2'])) == []
+    assert first.msg_id in queue
+
+
+def test_set_waits_for_the_one_in_flight():
+    queue = device.CommandQueue(coalesce=True, one_in_flight=True)
+    first = command([b'JOE', b'SET', b'X', b'1'])
+    queue.add(first)
+    first.sent = True
+    second = command([b'JOE', b'SET', b'X', b'2'])
+    queue.add(second)
+    assert queue.blocked(second)
+    assert not queue.blocked(command([b'JOE', b'SET', b'Y', b'2']))
+    queue.pop(first.msg_id)  # answered
+    assert not queue.blocked(second)
+
+
+def test_device_sends_only_the_last_set(running_broker, lanes):
+    joe = make_device(lanes, 'COALESCEDEV', X=0)
+    bob = make_device(lanes, 'COALESCECLIENT')
+    bob.cmd_queue = device.CommandQueue(coalesce=True, one_in_flight=True)
+    join(joe, bob)
+    writes = []
+    joe.params['X'] = computed.Computed(lambda: 0, writes.append)
+    for value in range(5):
+        bob.send([b'COALESCEDEV', b'SET', b'X', pickle.dumps(value)])
+    assert run([joe, bob], lambda: not len(bob.cmd_queue))
+    assert writes == [4]
@@ -0,0 +1,90 @@
+import threading
+import time
+
+import zmq
+
+import computed
+
+
+def computer():
+    poller = zmq.Poller()
+    c = computed.Computer(zmq.Context.instance())
+    c.open(poller)
+    return c, poller
+
+
+def wait(c, poller, until, timeout=2):
+    deadline = time.time() + timeout
+    while not until() and time.time() < deadline:
+        if dict(poller.poll(20)):
+            c.dispatch()
+    return until()
+
+
+def test_writes_of_a_param_reach_the_hardware_in_order():
+    hardware = []
+
+    def write(value):
+        time.sleep(0.2 if value == 1 else 0)  # the first write is the slow one
+        hardware.append(value)
+
+    param = computed.Computed(lambda: hardware[-1], write)
+    c, poller = computer()
+    done = []
+    c.set(param, 1, done.append)
+    c.set(param, 2, done.append)
+    assert wait(c, poller, lambda: len(done) == 2)
+    assert hardware == [1, 2] and param.value == 2
+    c.close(poller)
+
+
+def test_cache_policy():
+    reads = []
+    param = computed.Computed(lambda: reads.append(1) or len(reads), max_age=60)
+    c, poller = computer()
+    got = []
+    c.get(param, lambda value, error: got.append(value))
+    assert wait(c, poller, lambda: got == [1])
+    c.get(param, lambda value, error: got.append(value))  # fresh, from the cache
+    assert got == [1, 1] and param.reads == 1 and param.hits == 1
+    param.max_age = 0
+    param.refresh_ahead = True
+    c.get(param, lambda value, error: got.append(value))  # stale: the old value at once, a read for the next GET
+    assert got == [1, 1, 1]
+    assert wait(c, poller, lambda: param.value == 2)
+    c.close(poller)
+
+
+def test_gets_during_a_read_share_it():
+    release = threading.Event()
+    reads = []
+
+    def read():
+        release.wait(2)
+        reads.append(1)
+        return 5
+
+    param = computed.Computed(read)
+    c, poller = computer()
+    got = []
+    for i in range(3):
+        c.get(param, lambda value, error: got.append(value))
+    release.set()
+    assert wait(c, poller, lambda: len(got) == 3)
+    assert got == [5, 5, 5] and reads == [1]
+    c.close(poller)
+
+
+def test_results_after_close_are_dropped():
+    release = threading.Event()
+    param = computed.Computed(lambda: release.wait(2) and 1)
+    c, poller = computer()
+    got = []
+    c.get(param, lambda value, error: got.append(value))
+    c.close(poller)
+    c.open(poller)
+    release.set()
+    time.sleep(0.1)
+    assert not c.results
+    assert not wait(c, poller, lambda: got, timeout=0.2)
+    c.close(poller)
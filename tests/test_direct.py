@@ -0,0 +1,99 @@
+import pickle
+import time
+
+import zmq
+
+import computed
+import peers
+from conftest import join, make_device, run
+
+
+def test_slow_direct_set_runs_once(running_broker, lanes, tmp_path):
+    writes = []
+
+    def slow_write(value):
+        time.sleep(0.8)  # longer than device.DIRECT_TIMEOUT
+        writes.append(value)
+
+    joe = make_device(lanes, 'JOE', X=computed.Computed(lambda: 0, slow_write))
+    joe.direct = 'ipc://{}/joe-direct.ipc'.format(tmp_path)
+    bob = make_device(lanes, 'BOB')
+    join(joe, bob)
+    bob.lookup(b'JOE')
+    assert run([joe, bob], lambda: bob.peers[b'JOE'][0] is not None)
+    bob.send([b'JOE', b'SET', b'X', pickle.dumps(42)], timeout=3)
+    assert run([joe, bob], lambda: not len(bob.cmd_queue), timeout=3)
+    run([joe, bob], timeout=0.5)
+    assert writes == [42]
+
+
+def test_timeout_forgets_one_pending_request(tmp_path):
+    ctx = zmq.Context()
+    pool = peers.PeerPool(ctx)
+    endpoint = 'ipc://{}/peer.ipc'.format(tmp_path)
+    try:
+        pool.send('JOE', endpoint, [b'', b'1', b'GET', b'X'])
+        pool.send('JOE', endpoint, [b'', b'2', b'GET', b'Y'])
+        pool.done('JOE')
+        assert pool.pending['JOE'] == 1
+        pool.done('JOE')
+        assert 'JOE' not in pool.pending
+    finally:
+        pool.close_all()
+        ctx.term()
+
+
+def direct_peer(bob, tmp_path):
+    """Raw ROUTER standing in for JOE's direct inbox, known to bob without a lookup"""
+    sock = zmq.Context.instance().socket(zmq.ROUTER)
+    sock.setsockopt(zmq.LINGER, 0)
+    endpoint = 'ipc://{}/joe-raw.ipc'.format(tmp_path)
+    sock.bind(endpoint)
+    bob.peers[b'JOE'] = [endpoint, time.time() + 60]
+    bob.schemas[b'JOE'] = [None, time.time() + 60]
+    return sock
+
+
+def test_acked_direct_request_that_expires_is_no_longer_pending(running_broker, lanes, tmp_path):
+    bob = make_device(lanes, 'BOB')
+    join(bob)
+    joe = direct_peer(bob, tmp_path)
+    bob.send([b'JOE', b'GET', b'X'], timeout=0.3)
+    assert run([bob], lambda: joe.poll(0))
+    route, empty, msg_id, cmd, param = joe.recv_multipart()
+    joe.send_multipart([route, b'', msg_id, b'ACK'])  # and never answered
+    assert run([bob], lambda: not len(bob.cmd_queue))
+    assert bob.pool.pending.get(b'JOE', 0) == 0
+
+
+def test_fallback_keeps_the_socket_of_other_requests_in_flight(running_broker, lanes, tmp_path):
+    bob = make_device(lanes, 'BOB')
+    join(bob)
+    joe = direct_peer(bob, tmp_path)
+    bob.send([b'JOE', b'GET', b'X'], timeout=3)
+    assert run([bob], lambda: joe.poll(0))
+    route, empty, first, cmd, param = joe.recv_multipart()
+    joe.send_multipart([route, b'', first, b'ACK'])
+    bob.send([b'JOE', b'GET', b'Y'], timeout=3)  # never ACKed, so it goes through the broker
+    assert run([bob], lambda: not bob.peers[b'JOE'][0], timeout=3)
+    assert b'JOE' in bob.pool
+    joe.send_multipart([route, b'', first, b'RET', b'X', pickle.dumps(1)])
+    assert run([bob], lambda: first not in bob.cmd_queue)
+    assert bob.pool.pending.get(b'JOE', 0) == 0
+
+
+def test_malformed_direct_messages_are_dropped(running_broker, lanes, tmp_path):
+    joe = make_device(lanes, 'JOE', X=1)
+    joe.direct = 'ipc://{}/joe-direct.ipc'.format(tmp_path)
+    join(joe)
+    sock = zmq.Context.instance().socket(zmq.DEALER)
+    sock.setsockopt(zmq.LINGER, 0)
+    sock.connect(joe.direct_endpoint)
+    for msg in ([b''], [b'', b'\x01' * 16], [b'', b'\x01' * 16, b'GET'], [b'', b'\x01' * 16, b'SET', b'X']):
+        sock.send_multipart(msg)
+    sock.send_multipart([b'', b'\x02' * 16, b'GET', b'X'])
+    assert run([joe], lambda: sock.poll(0))
+    replies = [sock.recv_multipart()]
+    assert run([joe], lambda: sock.poll(0))
+    replies.append(sock.recv_multipart())
+    assert [reply[1:3] for reply in replies] == [[b'\x02' * 16, b'ACK'], [b'\x02' * 16, b'RET']]
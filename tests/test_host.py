@@ -0,0 +1,51 @@
+import pytest
+import zmq
+
+from conftest import make_device
+from host import DeviceHost
+
+
+class CountingPoller(zmq.Poller):
+    def __init__(self):
+        zmq.Poller.__init__(self)
+        self.polls = 0
+
+    def poll(self, timeout=None):
+        self.polls += 1
+        return zmq.Poller.poll(self, timeout)
+
+
+def test_hosted_devices_share_one_poll_per_loop(running_broker, lanes):
+    host = DeviceHost()
+    host.poller = CountingPoller()
+    joe, bob = host.add(make_device(lanes, 'JOE', X=5)), host.add(make_device(lanes, 'BOB'))
+    host.start()
+    loops = 0
+    while not all(dev.state == 'idle' for dev in host.devices) and loops < 500:
+        host.loop()
+        loops += 1
+    assert joe.state == 'idle' and bob.state == 'idle'
+    bob.send([b'JOE', b'GET', b'X'])
+    while len(bob.cmd_queue) and loops < 1000:
+        host.loop()
+        loops += 1
+    assert len(bob.cmd_queue) == 0 and joe.messages_received[b'GET'] == 1
+    assert host.poller.polls == loops  # neither device polled on its own
+    host.exit()
+    assert joe.state == 'closed' and bob.state == 'closed'
+
+
+def test_only_closed_devices_are_added_or_removed(lanes):
+    host = DeviceHost()
+    joe = host.add(make_device(lanes, 'JOE'))
+    assert joe.poller is host.poller
+    joe.state = 'idle'
+    with pytest.raises(ValueError):
+        host.remove(joe)
+    bob = make_device(lanes, 'BOB')
+    bob.state = 'idle'
+    with pytest.raises(ValueError):
+        host.add(bob)
+    joe.state = 'closed'
+    host.remove(joe)
+    assert joe.poller is not host.poller and host.devices == []
@@ -0,0 +1,56 @@
+import pickle
+import time
+
+import device
+from conftest import make_broker, peer, recv
+
+
+def crash_with_request(lanes, path):
+    """A broker that forwarded BOB's GET to JOE, then stopped with the request journaled"""
+    b = make_broker(lanes, journal_path=path)
+    joe, bob = peer(lanes, b'JOE'), peer(lanes, b'BOB')
+    bob.send_multipart([b'', b'\x01' * 16, b'JOE', b'GET', b'INT'])
+    assert recv(bob)[2] == b'ACK'
+    request = recv(joe)
+    b.stop()
+    return joe, bob, request
+
+
+def test_reply_to_journaled_request_reaches_requester(lanes, tmp_path):
+    path = str(tmp_path / 'mail.journal')
+    joe, bob, request = crash_with_request(lanes, path)
+    b = make_broker(lanes, journal_path=path)
+    try:
+        bob.send_multipart([b'', b'WHERE', b'JOE'])  # reconnected, the broker can reach it
+        assert recv(bob)[1] == b'HERE'
+        # JOE stayed up, so it never says HI to the new broker, it just answers
+        joe.send_multipart([b'', request[1], b'RET', b'INT', pickle.dumps(4)])
+        reply = recv(bob)
+        assert reply[1:3] == [b'\x01' * 16, b'RET']
+        assert not b.jrnl.recovered
+    finally:
+        b.stop()
+
+
+def test_journaled_request_is_retried_to_a_device_that_talks(lanes, tmp_path):
+    path = str(tmp_path / 'mail.journal')
+    joe, bob, request = crash_with_request(lanes, path)
+    b = make_broker(lanes, journal_path=path)
+    try:
+        joe.send_multipart([b'', b'WHERE', b'BOB'])
+        assert recv(joe)[1] == b'HERE'
+        assert recv(joe, timeout=3)[1:] == request[1:]  # retried by the periodic recovery
+    finally:
+        b.stop()
+
+
+def test_reply_to_unknown_request_is_dropped(running_broker, lanes):
+    joe = peer(lanes, b'JOE')
+    joe.send_multipart([b'', b'\x02' * 16, b'RET', b'INT', pickle.dumps(4)])
+    assert not joe.poll(300), 'a reply was mistaken for a request'
+
+
+def test_err_for_forgotten_request_is_ignored():
+    d = device.Device('LONELY')
+    d.handle_message([b'', b'\x03' * 16, b'ERR', b'Broker restarted'])
+    d.handle_message([b'', b'\x03' * 16, b'ERR', b'Device not connected'])
@@ -0,0 +1,13 @@
+import os
+
+import logger
+
+
+def test_log_file_is_created_at_the_first_record(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path / '..')
+    log = logger.make_logger('lazy.log')
+    monkeypatch.chdir(tmp_path)  # e.g. a test's directory, entered after the module was imported
+    assert not os.path.exists('lazy.log')
+    log.info('first')
+    assert os.path.exists(tmp_path / 'lazy.log')
+    assert not os.path.exists(tmp_path / '..' / 'lazy.log')
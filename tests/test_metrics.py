@@ -0,0 +1,54 @@
+import urllib.request
+
+import pytest
+
+import broker
+import device
+import metrics
+from conftest import make_device
+
+
+def test_closed_device_is_no_longer_exported(lanes):
+    joe = make_device(lanes, 'METRICSDEV')
+    joe.start()
+    assert 'device="METRICSDEV"' in metrics.REGISTRY.render()
+    joe.exit()
+    assert 'device="METRICSDEV"' not in metrics.REGISTRY.render()
+    joe.start()
+    try:
+        assert 'device="METRICSDEV"' in metrics.REGISTRY.render()
+    finally:
+        joe.exit()
+
+
+def test_unknown_commands_share_one_label():
+    b = broker.Broker(telemetry=False)
+    for cmd in (b'GET', b'\xff1', b'\xff2', b'RET'):
+        b.timed(cmd, lambda job: None, None)
+    assert sorted(b.command_stats) == [b'GET', b'RET', broker.OTHER]
+
+
+def test_unknown_device_commands_share_one_label():
+    d = device.Device('METRICSLABELS')
+    d.handle_message([b'', b'\x01' * 16, b'\xff1'])
+    d.handle_message([b'', b'\x02' * 16, b'\xff2'])
+    assert d.messages_received == {device.OTHER: 2}
+
+
+def test_metrics_server_outlives_one_of_its_users():
+    server = metrics.serve(0)
+    port = server.server_address[1]
+    assert metrics.serve(port) is server  # e.g. a device of the broker's process
+    metrics.stop(port)
+    assert urllib.request.urlopen('http://127.0.0.1:{}/metrics'.format(port), timeout=2).status == 200
+    metrics.stop(port)
+    with pytest.raises(OSError):
+        urllib.request.urlopen('http://127.0.0.1:{}/metrics'.format(port), timeout=2)
+
+
+def test_brokers_of_a_process_are_told_apart():
+    broker.Broker(endpoints=['inproc://metrics-a'], telemetry=False)
+    broker.Broker(endpoints=['inproc://metrics-b'], telemetry=False)
+    text = metrics.REGISTRY.render()
+    assert 'labzmq_broker_devices{broker="inproc://metrics-a"} 0' in text
+    assert 'labzmq_broker_devices{broker="inproc://metrics-b"} 0' in text
@@ -0,0 +1,29 @@
+import device
+import profiler
+from conftest import peer, recv
+
+
+def test_broker_prof_errors_have_a_msg_id_frame(running_broker, lanes):
+    linda = peer(lanes, b'LINDA')
+    linda.send_multipart([b'', b'PROF', b'SECONDS', b'-1'])
+    reply = recv(linda)
+    assert reply[:3] == [b'', b'', b'ERR']
+    d = device.Device('PROFCLIENT')
+    d.handle_message(reply)  # parsed as an ERR, not as a command called after the error text
+    assert d.messages_received == {b'ERR': 1}
+
+
+def test_profile_of_a_peer_given_by_str():
+    d = device.Device('PROFCLIENT')
+    d.profile('JOE', seconds=1)
+    (msg_id, cmd), = d.cmd_queue.items()
+    assert cmd.msg[:2] == [b'JOE', b'PROF']
+
+
+def test_windows_in_the_same_second_do_not_overwrite_each_other(tmp_path):
+    paths = set()
+    for i in range(2):
+        window = profiler.Profile('broker', 0.01, directory=str(tmp_path))
+        window.finish()
+        paths.add(window.path)
+    assert len(paths) == 2
@@ -0,0 +1,40 @@
+import time
+
+import device
+from conftest import join, make_broker, make_device, run
+
+
+def test_backoff_doubles_up_to_the_cap_with_jitter(monkeypatch):
+    monkeypatch.setattr(device.random, 'random', lambda: 1.0)
+    backoff = device.Backoff(base=0.1, cap=1, jitter=0.5)
+    assert [round(backoff.next(), 3) for i in range(6)] == [0.05, 0.1, 0.2, 0.4, 0.5, 0.5]
+    monkeypatch.setattr(device.random, 'random', lambda: 0.0)
+    assert backoff.next() == 1
+    backoff.reset()
+    assert backoff.next() == 0.1
+
+
+def test_queued_commands_survive_a_reconnect(lanes):
+    joe = make_device(lanes, 'JOE', X=1)
+    joe.join_timeout = 0.05
+    joe.backoff = device.Backoff(base=0.01, cap=0.02)
+    joe.cmd_max_age = 0.5
+    joe.start()
+    assert run([joe], lambda: joe.reconnects >= 2)
+    joe.send([b'BOB', b'GET', b'X'])
+    old, cmd = next(iter(joe.cmd_queue.items()))
+    cmd.created -= 1  # older than cmd_max_age
+    joe.send([b'BOB', b'GET', b'X'])
+    fresh = [msg_id for msg_id in joe.cmd_queue.queue if msg_id != old][0]
+    assert run([joe], lambda: joe.state == 'nobroker' and joe.reconnects >= 3)
+    assert old not in joe.cmd_queue and fresh in joe.cmd_queue
+    b = make_broker(lanes)
+    try:
+        bob = make_device(lanes, 'BOB', X=2)
+        join(bob)
+        assert run([joe, bob], lambda: joe.state == 'idle' and fresh not in joe.cmd_queue, timeout=5)
+        assert joe.backoff.attempts == 0 and joe.downtime > 0
+    finally:
+        joe.exit()
+        bob.exit()
+        b.stop()
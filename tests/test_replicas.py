@@ -0,0 +1,64 @@
+import time
+
+import zmq
+
+from conftest import peer, recv
+
+
+def replica(lanes, identity, service=b'JOE'):
+    sock = peer(lanes, identity, hello=False)
+    sock.send_multipart([b'', b'HI', b'SERVICE', service])
+    assert recv(sock)[1] == b'OK'
+    return sock
+
+
+def test_requests_go_to_the_least_loaded_replica(running_broker, lanes):
+    joe1, joe2 = replica(lanes, b'JOE1'), replica(lanes, b'JOE2')
+    bob = peer(lanes, b'BOB')
+    for i in (1, 2):
+        bob.send_multipart([b'', bytes([i]) * 16, b'JOE', b'SET', b'X', str(i).encode()])
+    assert recv(joe1)[1:3] == [b'\x01' * 16, b'SET']
+    assert recv(joe2)[1:3] == [b'\x02' * 16, b'SET']
+    joe2.send_multipart([b'', b'\x02' * 16, b'MET', b'X'])
+    assert [recv(bob)[2] for i in range(3)] == [b'ACK', b'ACK', b'MET']
+    # JOE1 still works on the first SET, JOE2 is free again
+    bob.send_multipart([b'', b'\x03' * 16, b'JOE', b'SET', b'X', b'3'])
+    assert recv(joe2)[1:3] == [b'\x03' * 16, b'SET']
+    assert not joe1.poll(200)
+
+
+def test_least_recently_used_replica_among_idle_ones(running_broker, lanes):
+    joe1, joe2 = replica(lanes, b'JOE1'), replica(lanes, b'JOE2')
+    bob = peer(lanes, b'BOB')
+    poller = zmq.Poller()
+    poller.register(joe1, zmq.POLLIN)
+    poller.register(joe2, zmq.POLLIN)
+    got = []
+    for i in (1, 2, 3, 4):
+        bob.send_multipart([b'', bytes([i]) * 16, b'JOE', b'SET', b'X', b'0'])
+        sock, = dict(poller.poll(2000))
+        msg = sock.recv_multipart()
+        sock.send_multipart([b'', msg[1], b'MET', b'X'])
+        assert recv(bob)[2] == b'ACK' and recv(bob)[2] == b'MET'
+        got.append(sock.identity)
+    assert got == [b'JOE1', b'JOE2', b'JOE1', b'JOE2']
+
+
+def test_replica_that_leaves_gets_no_more_requests(running_broker, lanes):
+    joe1, joe2 = replica(lanes, b'JOE1'), replica(lanes, b'JOE2')
+    bob = peer(lanes, b'BOB')
+    joe1.send_multipart([b'', b'BYE'])
+    deadline = time.time() + 2
+    while b'JOE1' in running_broker.devs and time.time() < deadline:
+        time.sleep(0.01)
+    for i in (1, 2):
+        bob.send_multipart([b'', bytes([i]) * 16, b'JOE', b'SET', b'X', b'0'])
+        assert recv(joe2)[1] == bytes([i]) * 16
+        assert recv(bob)[2] == b'ACK'
+    joe2.send_multipart([b'', b'BYE'])
+    deadline = time.time() + 2
+    while running_broker.services and time.time() < deadline:
+        time.sleep(0.01)
+    bob.send_multipart([b'', b'\x03' * 16, b'JOE', b'SET', b'X', b'0'])
+    replies = [recv(bob)[1:4] for i in range(3)]
+    assert [b'\x03' * 16, b'ERR', b'Device not connected'] in replies  # the other two failed as JOE2 left
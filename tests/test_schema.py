@@ -0,0 +1,74 @@
+import pickle
+
+import pytest
+
+import device
+import schema
+from conftest import join, make_device
+
+
+def test_param_added_after_hi_is_answered_by_name(monkeypatch):
+    joe = device.Device('SCHEMADEV', X=1)
+    replies = []
+    monkeypatch.setattr(joe, 'reply', lambda msg, route=None, copy=True: replies.append(msg))
+    tag = joe.schema.tag
+    joe.params['Y'] = 2
+    joe.handle_message([b'', b'\x01' * 16, b'GET', b'Y'])
+    assert replies[-1][2:] == [b'RET', b'Y', pickle.dumps(2)]
+    # IDs peers took from the published schema keep working
+    assert joe.schema.tag == tag
+    joe.handle_message([b'', b'\x02' * 16, b'GET', joe.schema.id_frame(b'X')])
+    assert replies[-1][2] == b'RET'
+
+
+def test_unknown_parameter_id_is_retried_by_name(monkeypatch):
+    bob = device.Device('SCHEMACLIENT')
+    bob.schemas[b'JOE'] = [schema.Schema([('X', 'int', schema.READ_WRITE)], tag=1), float('inf')]
+    sent = []
+    monkeypatch.setattr(bob, 'send_command', sent.append)
+    bob.send([b'JOE', b'GET', b'X'])
+    msg_id, cmd = next(iter(bob.cmd_queue.items()))
+    cmd.sent = True
+    bob.handle_message([b'', msg_id, b'ERR', b'Unknown parameter ID'])
+    assert sent == [cmd]
+    assert msg_id in bob.cmd_queue
+    assert b'JOE' not in bob.schemas
+
+
+def colliding_names():
+    """Two parameter names whose one-parameter schemas share a tag"""
+    seen = {}
+    for i in range(100000):
+        name = 'P{}'.format(i)
+        tag = schema.Schema([(name, 'int', schema.READ_WRITE)]).tag
+        if tag in seen:
+            return seen[tag], name
+        seen[tag] = name
+
+
+def test_registry_refuses_a_second_schema_with_the_same_tag():
+    a, b = colliding_names()
+    registry = schema.Registry()
+    registry.register(b'JOE', schema.Schema([(a, 'int', schema.READ_WRITE)]))
+    registry.register(b'JOE', schema.Schema([(a, 'int', schema.READ_WRITE)]))
+    registry.register(b'BOB', schema.Schema([(b, 'int', schema.READ_WRITE)]))
+    with pytest.raises(schema.SchemaCollision):
+        registry.register(b'JOE', schema.Schema([(b, 'int', schema.READ_WRITE)]))
+
+
+def test_device_whose_tag_collides_takes_names_only(running_broker, lanes):
+    a, b = colliding_names()
+    old = make_device(lanes, 'JOE', **{a: 1})
+    join(old)
+    stale_id = old.schema.id_frame(a.encode('utf-8'))
+    old.exit()
+    joe = make_device(lanes, 'JOE', **{b: 2})
+    join(joe)
+    assert b'JOE' not in running_broker.schemas
+    replies = []
+    joe.reply = lambda msg, route=None, copy=True: replies.append(msg)
+    joe.handle_message([b'', b'\x01' * 16, b'GET', stale_id])
+    assert replies[-1][2:] == [b'ERR', b'Unknown parameter ID']
+    joe.handle_message([b'', b'\x02' * 16, b'GET', b.encode('utf-8')])
+    assert replies[-1][2:] == [b'RET', b.encode('utf-8'), pickle.dumps(2)]
+    joe.exit()
@@ -0,0 +1,68 @@
+import pickle
+
+import device
+
+from conftest import join, make_device, peer, recv
+
+
+def hello(sock, *opts):
+    sock.send_multipart([b'', b'HI'] + list(opts))
+    return recv(sock)
+
+
+def test_resumed_session_gets_its_pending_requests(running_broker, lanes):
+    joe = peer(lanes, b'JOE', hello=False)
+    ok = hello(joe)
+    assert ok[1:3] == [b'OK', b'SESSION']
+    token = ok[3]
+    bob = peer(lanes, b'BOB')
+    bob.send_multipart([b'', b'\x01' * 16, b'JOE', b'GET', b'X'])
+    assert recv(bob)[2] == b'ACK'
+    assert recv(joe)[2:] == [b'GET', b'X']
+    joe.close()  # crashed before answering
+    joe = peer(lanes, b'JOE', hello=False)
+    assert hello(joe, b'SESSION', token)[1:4] == [b'OK', b'SESSION', token]
+    assert recv(joe)[1:] == [b'\x01' * 16, b'GET', b'X']
+    joe.send_multipart([b'', b'\x01' * 16, b'RET', b'X', pickle.dumps(1)])
+    assert recv(bob)[1:] == [b'\x01' * 16, b'RET', b'X', pickle.dumps(1)]
+
+
+def test_wrong_token_is_rejected(running_broker, lanes):
+    peer(lanes, b'JOE')
+    intruder = peer(lanes, b'JOE', hello=False)
+    assert hello(intruder, b'SESSION', b'not the token')[1:] == [b'ERR', b'Device already connected']
+
+
+def test_rejoin_without_token_fails_pending_requests(running_broker, lanes):
+    joe = peer(lanes, b'JOE')
+    bob = peer(lanes, b'BOB')
+    bob.send_multipart([b'', b'\x02' * 16, b'JOE', b'GET', b'X'])
+    assert recv(bob)[2] == b'ACK'
+    recv(joe)
+    joe.close()
+    joe = peer(lanes, b'JOE')  # a fresh start, the stale entry is evicted
+    reply = recv(bob)
+    assert reply[1:3] == [b'\x02' * 16, b'ERR']
+
+
+def test_restarted_device_resumes_from_its_session_file(running_broker, lanes):
+    joe = make_device(lanes, 'SESSIONDEV')
+    join(joe)
+    assert joe.session is not None
+    again = make_device(lanes, 'SESSIONDEV')  # e.g. the process restarted without BYE
+    assert again.session == joe.session
+    join(again)
+    assert again.session == joe.session
+    again.exit()
+    assert make_device(lanes, 'SESSIONDEV').session is None
+
+
+def test_session_file_goes_to_the_session_directory(running_broker, lanes, tmp_path, monkeypatch):
+    sessions = tmp_path / 'sessions'
+    sessions.mkdir()
+    monkeypatch.setattr(device, 'SESSION_DIRECTORY', str(sessions))
+    joe = make_device(lanes, 'SESSIONDIRDEV')
+    join(joe)
+    assert (sessions / 'SESSIONDIRDEV.session').read_bytes() == joe.session
+    assert not (tmp_path / 'SESSIONDIRDEV.session').exists()
+    joe.exit()
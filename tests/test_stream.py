@@ -0,0 +1,38 @@
+import struct
+import time
+
+import stream
+
+
+def deliver(sender, receiver, drop=()):
+    """Hand the sender's chunks to the receiver and the credits back until neither has any, skipping chunks in drop once"""
+    drop = set(drop)
+    while True:
+        msgs = sender.pump(budget=100)
+        if not msgs:
+            return
+        for msg in msgs:
+            sid, seq, data = msg[2:]
+            if struct.unpack('<I', seq)[0] in drop:
+                drop.discard(struct.unpack('<I', seq)[0])
+                continue
+            for reply in receiver.on_chunk(sid, seq, data):
+                sender.on_credit(reply[2], reply[3], reply[4:])
+
+
+def test_stream_resumes_after_a_missing_chunk(monkeypatch):
+    monkeypatch.setattr(stream, 'STALL_TIMEOUT', 0.01)
+    sender, receiver = stream.Streams(threshold=10, chunk_size=4), stream.Streams(threshold=10, chunk_size=4)
+    data = bytes(bytearray(range(40)))
+    got = []
+    receiver.expect(sender.pack(data), got.append)
+    deliver(sender, receiver, drop=[3])
+    assert got == [] and receiver.incoming[next(iter(receiver.incoming))].missing() == [3]
+    time.sleep(0.02)
+    credits = receiver.pump()
+    assert len(credits) == 1 and credits[0][4:] == [struct.pack('<I', 3)]
+    sender.on_credit(credits[0][2], credits[0][3], credits[0][4:])
+    assert sender.resent == 1
+    deliver(sender, receiver)
+    assert got == [data]
+    assert sender.outgoing == {} and receiver.incoming == {}
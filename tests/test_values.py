@@ -0,0 +1,81 @@
+import pickle
+import struct
+
+import device
+import shm
+import values
+from conftest import peer, recv
+
+
+def stale_handle():
+    """Handle of a shared memory segment its creator already reaped"""
+    payloads = shm.SharedPayloads(threshold=0)
+    handle = payloads.pack(pickle.dumps(b'x' * 1000))
+    assert shm.is_handle(handle)
+    payloads.close()
+    return handle
+
+
+def test_set_with_reaped_shm_handle_replies_err(monkeypatch):
+    d = device.Device('SHMDEV', X=1)
+    replies = []
+    monkeypatch.setattr(d, 'reply', lambda msg, route=None, copy=True: replies.append(msg))
+    d.handle_message([b'', b'\x01' * 16, b'SET', b'X', stale_handle()])
+    assert replies and replies[0][2] == b'ERR'
+    assert d.params['X'] == 1
+
+
+def test_ret_with_reaped_shm_handle_fails_the_request():
+    d = device.Device('SHMCLIENT')
+    d.send([b'JOE', b'GET', b'X'])
+    msg_id, cmd = next(iter(d.cmd_queue.items()))
+    cmd.sent = True
+    d.handle_message([b'', msg_id, b'RET', b'X', stale_handle()])
+    assert msg_id not in d.cmd_queue
+
+
+def test_frames_that_look_like_markers_pass_the_broker_untouched(running_broker, lanes):
+    joe, bob = peer(lanes, b'JOE'), peer(lanes, b'BOB')
+    # parameter ID frames start with b'\x00' like the markers of compressed frames and shm handles
+    for param in (b'\x00Zz\x01\x00', b'\x00SHM\x01\x00'):
+        bob.send_multipart([b'', b'\x04' * 16, b'JOE', b'GET', param])
+        assert recv(bob)[2] == b'ACK'
+        assert recv(joe)[2:] == [b'GET', param]
+        joe.send_multipart([b'', b'\x04' * 16, b'RET', param, pickle.dumps(1)])
+        assert recv(bob)[2:] == [b'RET', param, pickle.dumps(1)]
+
+
+def test_value_frames_by_command():
+    assert values.indices([b'JOE', b'', b'id', b'SET', b'X', b'v'], 3) == [5]
+    assert values.indices([b'JOE', b'', b'id', b'HST', b'X', b'<f8', b'rows'], 3) == [6]
+    assert values.indices([b'JOE', b'', b'id', b'GET', b'\x00Zz'], 3) == []
+    assert values.indices([b'JOE', b'', b'OK', b'SESSION', b'\x00SHM'], 3) == []
+
+
+def test_history_rows_that_look_like_a_compressed_frame(monkeypatch):
+    joe = device.Device('HISTDEV', X=0.0)
+    joe.keep_history('X')
+    timestamp, = struct.unpack('<d', b'\x00Zz\x00\x00\x00\xf0\x3f')  # rows start with the codec marker
+    joe.histories['X'].record(2.5, timestamp)
+    replies = []
+    monkeypatch.setattr(joe, 'reply', lambda msg, route=None, copy=True: replies.append(msg))
+    joe.handle_message([b'', b'\x05' * 16, b'HIST', b'X', b'LAST', b'1'])
+    assert replies[0][2] == b'HST'
+    client = device.Device('HISTCLIENT')
+    client.send([b'HISTDEV', b'HIST', b'X', b'LAST', b'1'])
+    msg_id, cmd = next(iter(client.cmd_queue.items()))
+    cmd.sent = True
+    client.handle_message([b'', msg_id] + replies[0][2:])
+    rows = client.fetched[('HISTDEV', 'X')]
+    assert list(rows['t']) == [timestamp] and list(rows['v']) == [2.5]
+
+
+def test_malformed_history_reply_fails_the_request():
+    client = device.Device('HISTCLIENT')
+    for dtype, rows in ((b'<f8', b'\x01\x02\x03'), (b'no such dtype', b''), (b'\xff', b'')):
+        client.send([b'HISTDEV', b'HIST', b'X', b'LAST', b'1'])
+        msg_id, cmd = next(iter(client.cmd_queue.items()))
+        cmd.sent = True
+        client.handle_message([b'', msg_id, b'HST', b'X', dtype, rows])
+        assert msg_id not in client.cmd_queue
+    assert client.fetched == {}
@@ -0,0 +1,22 @@
+"""
+Value frames
+
+Parameter values travel as pickles, which start with b'\x80'. A large value
+frame may be replaced by a shared memory handle (shm.py), a stream header
+(stream.py) or a compressed frame (codec.py), told apart by prefixes that all
+start with b'\x00', which no pickle does. Other frames start with b'\x00' too,
+e.g. parameter ID frames, and session tokens may by chance, so only the frames
+VALUE_FRAMES lists for a message's command are ever checked for these
+prefixes. A value frame that is not a pickle, the rows of a HST reply, is
+escaped with history.RAW when it starts with b'\x00'.
+"""
+
+# command -> positions of its value frames, counted from the command frame
+VALUE_FRAMES = {b'SET': (2,), b'RET': (2,), b'MET': (2,), b'HST': (3,)}
+
+
+def indices(msg, cmd_index):
+    """Indices of the value frames of msg, whose command frame is msg[cmd_index]"""
+    if cmd_index >= len(msg):
+        return []
+    return [cmd_index + i for i in VALUE_FRAMES.get(msg[cmd_index], ()) if cmd_index + i < len(msg)]